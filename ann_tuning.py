@@ -0,0 +1,229 @@
+"""
+This module tunes the HNSW index parameters of every collection to a target recall at the lowest search latency.
+
+Collections used to be created with Chroma's default HNSW settings whatever their size, so small folders paid for
+links they do not need while large folders lost recall with the default search ef. The tuner holds out a sample of
+the chunk embeddings of a collection as queries, computes their exact nearest neighbours among the other chunks,
+and builds hnswlib indexes over a grid of M and ef_construction values. For every index it measures recall@k and
+the mean query latency of increasing ef_search values, and keeps the fastest combination reaching the target
+recall. The parameters are written into the index version built with them and used as the hnsw:* metadata of every
+collection created for the database afterwards, each new version copying them from the live one. Chroma reads that
+metadata whenever it loads a collection, so the tuned parameters apply at load without any change to the
+retrievers. Tuning rebuilds the live version with the new parameters through compaction, which copies the stored
+embeddings without embedding anything again.
+
+Functions:
+- load_ann_params(db_directory): Reads the tuned collection metadata of a database.
+- save_ann_params(version_dir, metadata, tuning): Writes the tuned collection metadata of an index version.
+- exact_neighbours(data, queries, k): Computes the exact L2 nearest neighbours of queries.
+- tune(embeddings, k, target_recall, sample_queries): Finds the fastest HNSW parameters reaching the target recall.
+- tune_database(database_dir): Tunes a database, saves its parameters and rebuilds its live version.
+
+Command-line Options:
+- --db_directory: The database directory to tune (default is every database in DATABASE_MAPPING).
+- --target_recall: The recall@k to reach (default is ANN_TARGET_RECALL).
+"""
+
+import json
+import logging
+import os
+import time
+from typing import Optional
+
+import click
+import numpy as np
+
+from constants import (
+    ANN_EF_CONSTRUCTION_VALUES,
+    ANN_EF_SEARCH_VALUES,
+    ANN_M_VALUES,
+    ANN_PARAMS_FILENAME,
+    ANN_RECALL_K,
+    ANN_SAMPLE_QUERIES,
+    ANN_TARGET_RECALL,
+    DATABASE_MAPPING,
+)
+from chroma_store import open_store
+from snapshots import current_version_dir, database_directory
+
+
+def load_ann_params(db_directory: str) -> Optional[dict]:
+    """
+    Read the tuned collection metadata of a database.
+
+    Args:
+        db_directory (str): The database directory, or one of its version directories.
+
+    Returns:
+        Optional[dict]: The hnsw:* collection metadata, None when the database was never tuned.
+    """
+    database_dir = database_directory(db_directory)
+    # The version itself, then the live version a new version is built beside, then the database directory where
+    # the parameters were written before they moved into the versions
+    for directory in (db_directory, current_version_dir(database_dir), database_dir):
+        try:
+            with open(os.path.join(directory, ANN_PARAMS_FILENAME), encoding="utf-8") as file:
+                return json.load(file)["metadata"]
+        except (OSError, ValueError, KeyError):
+            continue
+    return None
+
+
+def save_ann_params(version_dir: str, metadata: Optional[dict], tuning: Optional[dict] = None) -> None:
+    """
+    Write the tuned collection metadata of an index version, so that the versions built after it use it too.
+
+    Args:
+        version_dir (str): The index version directory.
+        metadata (Optional[dict]): The hnsw:* collection metadata its collection was created with. Nothing is
+            written when None.
+        tuning (Optional[dict]): The measurements the parameters were chosen from.
+    """
+    if not metadata:
+        return
+    # Write to a temporary file first so that a crash never leaves a partial file
+    path = os.path.join(version_dir, ANN_PARAMS_FILENAME)
+    with open(path + ".tmp", "w", encoding="utf-8") as file:
+        json.dump({"metadata": metadata, **(tuning or {})}, file)
+    os.replace(path + ".tmp", path)
+
+
+def exact_neighbours(data: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    """
+    Compute the exact nearest neighbours of queries under the L2 distance Chroma uses by default.
+
+    Args:
+        data (np.ndarray): The indexed vectors, one per row.
+        queries (np.ndarray): The query vectors, one per row.
+        k (int): Number of neighbours.
+
+    Returns:
+        np.ndarray: The row numbers of the k nearest vectors of every query, in no particular order.
+    """
+    # ||q - x||^2 up to the constant ||q||^2, for all pairs in one matrix product
+    distances = np.sum(data * data, axis=1)[None, :] - 2.0 * queries @ data.T
+    return np.argpartition(distances, k - 1, axis=1)[:, :k]
+
+
+def tune(
+    embeddings: np.ndarray,
+    k: int = ANN_RECALL_K,
+    target_recall: float = ANN_TARGET_RECALL,
+    sample_queries: int = ANN_SAMPLE_QUERIES,
+) -> dict:
+    """
+    Find the HNSW parameters reaching the target recall@k at the lowest mean query latency.
+
+    Args:
+        embeddings (np.ndarray): The chunk embeddings of the collection, one per row.
+        k (int): Number of neighbours the recall is measured on.
+        target_recall (float): The recall@k to reach.
+        sample_queries (int): Number of chunk embeddings held out as queries.
+
+    Returns:
+        dict: The chosen "M", "ef_construction" and "ef_search", with the measured "recall" and "latency_ms".
+        When no combination reaches the target, the one with the best recall.
+    """
+    # hnswlib ships with chromadb as chroma-hnswlib
+    import hnswlib
+
+    # Held-out queries are searched in an index of the other chunks, as real queries are not in the index
+    rng = np.random.default_rng(0)
+    order = rng.permutation(len(embeddings))
+    n_queries = min(sample_queries, len(embeddings) // 5)
+    queries, data = embeddings[order[:n_queries]], embeddings[order[n_queries:]]
+    k = min(k, len(data))
+    truth = [set(row) for row in exact_neighbours(data, queries, k)]
+
+    results = []
+    for m in ANN_M_VALUES:
+        for ef_construction in ANN_EF_CONSTRUCTION_VALUES:
+            index = hnswlib.Index(space="l2", dim=data.shape[1])
+            index.init_index(max_elements=len(data), ef_construction=ef_construction, M=m)
+            index.add_items(data, np.arange(len(data)))
+            # Single-threaded, the latency of one request rather than the throughput of a batch
+            index.set_num_threads(1)
+            for ef_search in ANN_EF_SEARCH_VALUES:
+                if ef_search < k:
+                    continue
+                index.set_ef(ef_search)
+                start = time.perf_counter()
+                labels, _ = index.knn_query(queries, k=k)
+                latency_ms = (time.perf_counter() - start) * 1000 / len(queries)
+                recall = sum(len(expected & set(found)) for expected, found in zip(truth, labels)) / (k * len(queries))
+                results.append(
+                    {
+                        "M": m,
+                        "ef_construction": ef_construction,
+                        "ef_search": ef_search,
+                        "recall": round(recall, 4),
+                        "latency_ms": round(latency_ms, 4),
+                    }
+                )
+                logging.info(f"M={m} ef_construction={ef_construction} ef_search={ef_search}: {results[-1]}")
+                # A larger ef_search is only slower once the recall is reached
+                if recall >= target_recall:
+                    break
+
+    reached = [result for result in results if result["recall"] >= target_recall]
+    if reached:
+        return min(reached, key=lambda result: result["latency_ms"])
+    return max(results, key=lambda result: (result["recall"], -result["latency_ms"]))
+
+
+def tune_database(database_dir: str, target_recall: float = ANN_TARGET_RECALL) -> Optional[dict]:
+    """
+    Tune the HNSW parameters of a database, save them and rebuild its live version with them.
+
+    Args:
+        database_dir (str): The directory holding the versions of the database.
+        target_recall (float): The recall@k to reach.
+
+    Returns:
+        Optional[dict]: The chosen parameters, None when the collection is too small to tune.
+    """
+    # Imported here as segments imports this module, compaction creates the rebuilt collection with the
+    # parameters chosen below and saves them into the new version
+    from segments import compact
+
+    live = current_version_dir(database_dir)
+    db = open_store(live)
+    embeddings = np.asarray(db._collection.get(include=["embeddings"])["embeddings"] or [], dtype=np.float32)
+    # Below this many chunks a search visits most of the graph anyway
+    if len(embeddings) < 5 * ANN_RECALL_K:
+        return None
+
+    chosen = tune(embeddings, target_recall=target_recall)
+    metadata = {
+        "hnsw:space": "l2",
+        "hnsw:M": chosen["M"],
+        "hnsw:construction_ef": chosen["ef_construction"],
+        "hnsw:search_ef": chosen["ef_search"],
+    }
+
+    # Construction parameters cannot change in place, rebuild the live version as a new snapshot with them
+    compact(database_dir, ann_params=metadata, tuning={"tuning": chosen, "chunks": len(embeddings)})
+    return chosen
+
+
+@click.command()
+@click.option(
+    "--db_directory",
+    default=None,
+    help="Tune this database only, e.g. DB/ModuleA (Default is every database)",
+)
+@click.option(
+    "--target_recall",
+    default=ANN_TARGET_RECALL,
+    type=float,
+    help="Recall@k to reach at the lowest latency",
+)
+def main(db_directory, target_recall):
+    directories = [db_directory] if db_directory else list(DATABASE_MAPPING.values())
+    for directory in directories:
+        chosen = tune_database(directory, target_recall)
+        print(f"{directory}: {chosen or 'too small to tune, skipped'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""
+This module implements a semantic answer cache for the RAG responses served by the API.
+
+Lecturers frequently ask near-identical questions against the same folder, and every one of them costs a full
+LLM generation. The cache keeps previously generated answers keyed by (database, prompt template, model) and
+matches new questions by the cosine similarity of their query embeddings, so a repeated question is answered
+in milliseconds instead of minutes.
+
+Classes:
+- SemanticAnswerCache: Thread-safe cache with a similarity threshold, TTL expiry, LRU size eviction and
+  per-database invalidation. Entries also record the generation of their database, so that ingest jobs running
+  outside the API invalidate them too.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+import numpy as np
+
+from constants import (
+    ANSWER_CACHE_MAX_ENTRIES,
+    ANSWER_CACHE_SIMILARITY_THRESHOLD,
+    ANSWER_CACHE_TTL_SECONDS,
+)
+
+
+class SemanticAnswerCache:
+    def __init__(
+        self,
+        similarity_threshold: float = ANSWER_CACHE_SIMILARITY_THRESHOLD,
+        ttl_seconds: float = ANSWER_CACHE_TTL_SECONDS,
+        max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+    ):
+        """
+        Initializes an empty answer cache.
+
+        Args:
+            similarity_threshold (float): Minimum cosine similarity between two query embeddings for a hit.
+            ttl_seconds (float): Number of seconds after which an entry expires. Use 0 to disable expiry.
+            max_entries (int): Maximum number of entries kept before the least recently used ones are evicted.
+        """
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+
+        # Entries in least-recently-used order, indexed by an increasing entry id
+        self._entries: OrderedDict[int, dict] = OrderedDict()
+        # Entry ids grouped by their (database, template, model, filters) key for fast lookups
+        self._keys: dict[tuple, list[int]] = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+        # Counters reported by stats()
+        self._hits = 0
+        self._misses = 0
+
+    @staticmethod
+    def _normalise(query_vector) -> np.ndarray:
+        """
+        Convert a query embedding into a unit-length float32 vector.
+
+        Args:
+            query_vector: The query embedding as a list or array of floats.
+
+        Returns:
+            np.ndarray: The normalised query embedding.
+        """
+        vector = np.asarray(query_vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def _is_expired(self, entry: dict, now: float) -> bool:
+        return self.ttl_seconds > 0 and now - entry["created_at"] > self.ttl_seconds
+
+    def _remove(self, entry_id: int) -> None:
+        # Drop the entry and its reference in the key index
+        entry = self._entries.pop(entry_id)
+        ids = self._keys[entry["key"]]
+        ids.remove(entry_id)
+        if not ids:
+            del self._keys[entry["key"]]
+
+    def lookup(
+        self, database: str, template: str, model: str, query_vector, generation: Hashable = 0, filters: str = ""
+    ) -> Optional[dict[str, Any]]:
+        """
+        Look up a cached answer for a query.
+
+        Args:
+            database (str): The name of the searched database(s) ("" when RAG is not used).
+            template (str): The name of the selected prompt template.
+            model (str): The identifier of the model that generated the answer.
+            query_vector: The embedding of the user query.
+            generation (Hashable): The current generation of the database(s). Entries of other generations are dropped.
+            filters (str): The metadata filters of the search, serialised ("" when unfiltered).
+
+        Returns:
+            Optional[dict[str, Any]]: The cached entry with "answer", "docs" and "similarity" keys, or None on a miss.
+        """
+        key = (database, template, model, filters)
+        query = self._normalise(query_vector)
+        now = time.monotonic()
+
+        with self._lock:
+            # Purge expired and stale entries for this key before matching
+            for entry_id in list(self._keys.get(key, [])):
+                entry = self._entries[entry_id]
+                if self._is_expired(entry, now) or entry["generation"] != generation:
+                    self._remove(entry_id)
+
+            ids = self._keys.get(key)
+            if not ids:
+                self._misses += 1
+                return None
+
+            # Score every candidate in one matrix-vector product
+            matrix = np.stack([self._entries[entry_id]["vector"] for entry_id in ids])
+            similarities = matrix @ query
+            best = int(np.argmax(similarities))
+
+            if similarities[best] < self.similarity_threshold:
+                self._misses += 1
+                return None
+
+            # Mark the entry as recently used
+            entry_id = ids[best]
+            self._entries.move_to_end(entry_id)
+            self._hits += 1
+            entry = self._entries[entry_id]
+            return {"answer": entry["answer"], "docs": list(entry["docs"]), "similarity": float(similarities[best])}
+
+    def store(
+        self,
+        database: str,
+        template: str,
+        model: str,
+        query_vector,
+        answer: str,
+        docs: list,
+        generation: Hashable = 0,
+        filters: str = "",
+    ) -> None:
+        """
+        Store a generated answer in the cache.
+
+        Args:
+            database (str): The name of the searched database(s) ("" when RAG is not used).
+            template (str): The name of the selected prompt template.
+            model (str): The identifier of the model that generated the answer.
+            query_vector: The embedding of the user query.
+            answer (str): The generated answer.
+            docs (list): The source documents used to generate the answer.
+            generation (Hashable): The generation of the database(s) the answer was generated from.
+            filters (str): The metadata filters of the search, serialised ("" when unfiltered).
+        """
+        key = (database, template, model, filters)
+        entry = {
+            "key": key,
+            "vector": self._normalise(query_vector),
+            "answer": answer,
+            "docs": list(docs),
+            "generation": generation,
+            "created_at": time.monotonic(),
+        }
+
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = entry
+            self._keys.setdefault(key, []).append(entry_id)
+
+            # Evict the least recently used entries once the cache is full
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, database: Optional[str] = None) -> int:
+        """
+        Drop the cached answers of a database, or of every database.
+
+        Args:
+            database (Optional[str]): The database whose answers are dropped. Drops everything when None.
+
+        Returns:
+            int: The number of entries removed.
+        """
+        with self._lock:
+            if database is None:
+                removed = len(self._entries)
+                self._entries.clear()
+                self._keys.clear()
+                return removed
+
+            # Answers searched across several databases are keyed by their comma separated names
+            stale = [
+                entry_id for entry_id, entry in self._entries.items() if database in entry["key"][0].split(",")
+            ]
+            for entry_id in stale:
+                self._remove(entry_id)
+            return len(stale)
+
+    def stats(self) -> dict[str, int]:
+        """
+        Report the size and hit counters of the cache.
+
+        Returns:
+            dict[str, int]: The number of entries, hits and misses.
+        """
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self._hits, "misses": self._misses}
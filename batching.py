@@ -0,0 +1,527 @@
+"""
+This module implements continuous batching for the transformers models (full, GPTQ and AWQ).
+
+A HuggingFacePipeline runs every request on its own, so concurrent prompts queue behind each other and the GPU
+decodes one token of one sequence per forward pass, far below what it can compute. The batching engine runs one
+decode loop in a background thread. Every step decodes one token of every active sequence in a single forward
+pass; a new prompt is prefilled on its own and joins the running batch at the next step, and a finished sequence
+leaves it at once, so the batch never waits for its longest sequence. The key/value cache of every sequence is a
+row of the batch cache, left-padded to the longest row and masked, and rows are dropped and the padding trimmed
+as sequences finish. Aggregate tokens per second grow with the number of concurrent sequences until the forward
+pass becomes compute-bound.
+
+A prompt that fails to prefill, e.g. out of memory, only fails its own request, and a request waiting longer than
+BATCH_REQUEST_TIMEOUT_SECONDS ends with a TimeoutError, so a failure never holds a slot of the request scheduler.
+
+Functions:
+- benchmark(model_id, concurrency, max_new_tokens): Compares single-stream and concurrent throughput.
+- smoke_test(model_id): Checks the batched answers against the answers of one prompt at a time.
+
+Classes:
+- BatchingEngine: Continuous batching decode loop over a transformers causal LM.
+- BatchedHuggingFaceLLM: LangChain LLM generating with a BatchingEngine.
+
+Command-line Options:
+- --model_id: The model to benchmark (default is BATCHING_BENCHMARK_MODEL, a tiny model that runs on CPU).
+- --concurrency: Number of concurrent prompts (default is BATCH_MAX_SIZE).
+- --max_new_tokens: Number of tokens generated per prompt.
+- --check: Run the smoke test instead of the benchmark.
+"""
+
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, List, Optional
+
+import click
+import torch
+import torch.nn.functional as F
+from langchain.callbacks.manager import CallbackManagerForLLMRun
+from langchain.llms.base import LLM
+
+from constants import (
+    BATCH_MAX_SIZE,
+    BATCH_REQUEST_TIMEOUT_SECONDS,
+    BATCHING_BENCHMARK_MODEL,
+    CONTEXT_WINDOW_SIZE,
+    MAX_NEW_TOKENS,
+)
+
+# Sampling settings of the text-generation pipeline the engine replaces
+DEFAULT_TEMPERATURE = 0.2
+DEFAULT_REPETITION_PENALTY = 1.15
+
+
+class _Sequence:
+    def __init__(self, prompt_ids: list[int], max_new_tokens: int, stop: Optional[list[str]], on_token):
+        self.prompt_ids = prompt_ids
+        self.max_new_tokens = max_new_tokens
+        self.stop = stop or []
+        self.on_token = on_token
+        self.generated: list[int] = []
+        self.text = ""
+        self.error: Optional[BaseException] = None
+        self.done = threading.Event()
+
+
+def _pad_time(tensor: torch.Tensor, length: int) -> torch.Tensor:
+    # Left-pad the time dimension of key/value tensors, [batch, heads, time, head dim]
+    missing = length - tensor.shape[-2]
+    return F.pad(tensor, (0, 0, missing, 0)) if missing > 0 else tensor
+
+
+def _pad_mask(mask: torch.Tensor, length: int) -> torch.Tensor:
+    # Left-pad an attention mask, [batch, time], with masked positions
+    missing = length - mask.shape[-1]
+    return F.pad(mask, (missing, 0)) if missing > 0 else mask
+
+
+def _to_tuples(past) -> tuple:
+    # The (key, value) tensors of every layer of a cache: a tuple in older transformers versions, a Cache object
+    # converted by to_legacy_cache in later ones, a Cache object with a list of layers since 5.0
+    if hasattr(past, "layers"):
+        return tuple((layer.keys, layer.values) for layer in past.layers)
+    if hasattr(past, "to_legacy_cache"):
+        past = past.to_legacy_cache()
+    return tuple((key, value) for key, value in past)
+
+
+def _from_tuples(cache_class, cache: tuple):
+    # The Cache object of the model holding the (key, value) tensors of every layer
+    if hasattr(cache_class, "from_legacy_cache"):
+        return cache_class.from_legacy_cache(cache)
+    return cache_class(ddp_cache_data=cache)
+
+
+class BatchingEngine:
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        max_batch_size: int = BATCH_MAX_SIZE,
+        max_new_tokens: int = MAX_NEW_TOKENS,
+        temperature: float = DEFAULT_TEMPERATURE,
+        repetition_penalty: float = DEFAULT_REPETITION_PENALTY,
+        context_window: int = CONTEXT_WINDOW_SIZE,
+    ):
+        """
+        Initializes the engine, its decode loop starts with the first request.
+
+        Args:
+            model: The transformers causal LM.
+            tokenizer: The tokenizer of the model.
+            max_batch_size (int): Number of sequences decoded together, further requests wait for a row.
+            max_new_tokens (int): Default number of tokens generated per request.
+            temperature (float): Sampling temperature, 0 for greedy decoding.
+            repetition_penalty (float): Penalty of the tokens already in a sequence, 1 to disable it.
+            context_window (int): Number of prompt and generated tokens of a sequence.
+        """
+        self.model = model.eval()
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.repetition_penalty = repetition_penalty
+        self.context_window = min(
+            context_window, getattr(model.config, "max_position_embeddings", None) or context_window
+        )
+        eos = getattr(getattr(model, "generation_config", None), "eos_token_id", None)
+        if eos is None:
+            eos = tokenizer.eos_token_id
+        self.eos_ids: set[int] = set(eos if isinstance(eos, (list, tuple)) else [eos]) - {None}
+
+        self._pending: queue.Queue = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        # Cache class of the model, newer transformers versions take a Cache object rather than tuples
+        self._cache_class = None
+        self._closing = False
+        self.tokens_generated = 0
+
+    def submit(
+        self,
+        prompt: str,
+        max_new_tokens: Optional[int] = None,
+        stop: Optional[list[str]] = None,
+        on_token: Optional[Callable[[str], None]] = None,
+    ) -> _Sequence:
+        """
+        Add a prompt to the decode loop.
+
+        Args:
+            prompt (str): The prompt.
+            max_new_tokens (Optional[int]): Number of tokens to generate at most (default is the engine's).
+            stop (Optional[list[str]]): Generation stops at the first of these strings, which is not returned.
+            on_token (Optional[Callable[[str], None]]): Called from the decode loop with the text of every new token.
+                An exception it raises ends the sequence and is raised by generate().
+
+        Returns:
+            _Sequence: The sequence, whose done event is set when it is complete.
+
+        Raises:
+            RuntimeError: If the engine is closed.
+            ValueError: If the prompt leaves no room in the context window for an answer.
+        """
+        if self._closing:
+            raise RuntimeError("The batching engine is closed")
+        prompt_ids = self.tokenizer.encode(prompt)
+        if len(prompt_ids) >= self.context_window:
+            raise ValueError(
+                f"Prompt of {len(prompt_ids)} tokens leaves no room in the context window of {self.context_window}"
+            )
+        sequence = _Sequence(prompt_ids, max_new_tokens or self.max_new_tokens, stop, on_token)
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, daemon=True)
+                self._thread.start()
+        self._pending.put(sequence)
+        return sequence
+
+    def generate(self, prompt: str, timeout: float = BATCH_REQUEST_TIMEOUT_SECONDS, **kwargs: Any) -> str:
+        """
+        Generate the answer of a prompt, decoded in the same batch as the concurrent prompts.
+
+        Args:
+            prompt (str): The prompt.
+            timeout (float): Seconds to wait for the answer.
+            **kwargs: The options of submit().
+
+        Returns:
+            str: The generated text.
+
+        Raises:
+            TimeoutError: If the answer is not complete within the timeout.
+        """
+        sequence = self.submit(prompt, **kwargs)
+        if not sequence.done.wait(timeout):
+            # The decode loop drops the sequence at its next token, or skips it if it was not admitted yet
+            sequence.error = TimeoutError(f"No answer within {timeout} seconds")
+            raise sequence.error
+        if sequence.error is not None:
+            raise sequence.error
+        return sequence.text
+
+    def close(self) -> None:
+        """
+        Stop the decode loop once the running sequences complete, releasing the model.
+        """
+        self._closing = True
+        self._pending.put(None)
+
+    def _forward(self, input_ids, attention_mask, position_ids, cache=None):
+        if cache is not None and self._cache_class is not None:
+            cache = _from_tuples(self._cache_class, cache)
+        output = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=cache,
+            use_cache=True,
+        )
+        past = output.past_key_values
+        if not isinstance(past, tuple):
+            self._cache_class = type(past)
+        # Cached tensors of every layer are [batch, heads, time, head dim]
+        return output.logits[:, -1, :].float(), _to_tuples(past)
+
+    def _sample(self, logits: torch.Tensor, rows: list[_Sequence]) -> list[int]:
+        if self.repetition_penalty != 1.0:
+            for row, sequence in enumerate(rows):
+                seen = torch.tensor(sequence.prompt_ids + sequence.generated, device=logits.device)
+                scores = logits[row, seen]
+                logits[row, seen] = torch.where(
+                    scores < 0, scores * self.repetition_penalty, scores / self.repetition_penalty
+                )
+        if self.temperature <= 0:
+            return logits.argmax(dim=-1).tolist()
+        probabilities = torch.softmax(logits / self.temperature, dim=-1)
+        return torch.multinomial(probabilities, num_samples=1).squeeze(-1).tolist()
+
+    def _append(self, sequence: _Sequence, token: int) -> bool:
+        # Add a token to a sequence, returns True when the sequence is complete
+        if token in self.eos_ids:
+            return True
+        sequence.generated.append(token)
+        self.tokens_generated += 1
+        text = self.tokenizer.decode(sequence.generated, skip_special_tokens=True)
+        # Wait for the rest of a character split over several tokens
+        if not text.endswith("�"):
+            for stop in sequence.stop:
+                if stop in text:
+                    text = text[: text.index(stop)]
+                    self._emit(sequence, text)
+                    return True
+            self._emit(sequence, text)
+        return (
+            sequence.error is not None
+            or len(sequence.generated) >= sequence.max_new_tokens
+            or len(sequence.prompt_ids) + len(sequence.generated) >= self.context_window
+        )
+
+    def _emit(self, sequence: _Sequence, text: str) -> None:
+        new_text, sequence.text = text[len(sequence.text) :], text
+        if not new_text or sequence.on_token is None or sequence.error is not None:
+            return
+        try:
+            sequence.on_token(new_text)
+        except Exception as e:
+            # E.g. the client of a stream went away, the sequence ends and the error reaches its caller
+            sequence.error = e
+
+    def _prefill(self, sequence: _Sequence, device) -> Optional[tuple]:
+        # Evaluate a new prompt on its own, returns its next token, cache and mask, or None once the sequence ended.
+        # Errors only fail this sequence, the running batch goes on
+        if sequence.error is not None:
+            sequence.done.set()
+            return None
+        try:
+            input_ids = torch.tensor([sequence.prompt_ids], device=device)
+            ones = torch.ones_like(input_ids)
+            logits, past = self._forward(input_ids, ones, torch.cumsum(ones, dim=-1) - 1)
+            token = self._sample(logits, [sequence])[0]
+            if self._append(sequence, token):
+                sequence.done.set()
+                return None
+        except Exception as e:
+            logging.exception("Prefill failed")
+            sequence.error = e
+            sequence.done.set()
+            return None
+        return torch.tensor([token], device=device), past, ones
+
+    def _loop(self) -> None:
+        rows: list[_Sequence] = []
+        cache: tuple = ()
+        mask = next_tokens = None
+        closed = False
+        device = self.model.device
+
+        with torch.inference_mode():
+            while True:
+                try:
+                    # Admit waiting prompts into free rows, blocking only when nothing is being decoded
+                    while len(rows) < self.max_batch_size and not closed:
+                        try:
+                            sequence = self._pending.get(block=not rows)
+                        except queue.Empty:
+                            break
+                        if sequence is None:
+                            closed = True
+                            break
+                        # Prefill the prompt on its own, then merge its cache into the batch
+                        prefilled = self._prefill(sequence, device)
+                        if prefilled is None:
+                            continue
+                        token_tensor, past, ones = prefilled
+                        if not rows:
+                            rows, cache, mask, next_tokens = [sequence], past, ones, token_tensor
+                            continue
+                        length = max(mask.shape[-1], ones.shape[-1])
+                        cache = tuple(
+                            (
+                                torch.cat([_pad_time(key, length), _pad_time(new_key, length)]),
+                                torch.cat([_pad_time(value, length), _pad_time(new_value, length)]),
+                            )
+                            for (key, value), (new_key, new_value) in zip(cache, past)
+                        )
+                        mask = torch.cat([_pad_mask(mask, length), _pad_mask(ones, length)])
+                        next_tokens = torch.cat([next_tokens, token_tensor])
+                        rows.append(sequence)
+                    if not rows:
+                        if closed:
+                            return
+                        continue
+
+                    # One decode step for every row, positions skip the left padding of each row
+                    mask = torch.cat([mask, torch.ones_like(mask[:, :1])], dim=-1)
+                    position_ids = (mask.sum(dim=-1, keepdim=True) - 1).long()
+                    logits, cache = self._forward(next_tokens[:, None], mask, position_ids, cache)
+                    tokens = self._sample(logits, rows)
+
+                    finished = [self._append(sequence, token) for sequence, token in zip(rows, tokens)]
+                    if not any(finished):
+                        next_tokens = torch.tensor(tokens, device=device)
+                        continue
+
+                    # Drop the finished rows and the padding no remaining row needs
+                    for sequence, is_finished in zip(rows, finished):
+                        if is_finished:
+                            sequence.done.set()
+                    keep = [row for row, is_finished in enumerate(finished) if not is_finished]
+                    rows = [rows[row] for row in keep]
+                    if not rows:
+                        cache, mask, next_tokens = (), None, None
+                        continue
+                    index = torch.tensor(keep, device=device)
+                    mask = mask[index]
+                    start = int((mask.sum(dim=0) > 0).nonzero()[0])
+                    mask = mask[:, start:]
+                    cache = tuple((key[index, :, start:], value[index, :, start:]) for key, value in cache)
+                    next_tokens = torch.tensor([tokens[row] for row in keep], device=device)
+                except Exception as e:
+                    # Fail the sequences of the batch rather than the loop, later requests start a new batch
+                    logging.exception("Batched generation failed")
+                    for sequence in rows:
+                        sequence.error = e
+                        sequence.done.set()
+                    rows, cache, mask, next_tokens = [], (), None, None
+
+
+class BatchedHuggingFaceLLM(LLM):
+    engine: Any
+    # Number of prompts the request scheduler lets generate at once
+    max_concurrency: int = BATCH_MAX_SIZE
+
+    @property
+    def _llm_type(self) -> str:
+        return "batched_huggingface"
+
+    def _call(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        # Tokens reach the callback handlers, e.g. a TokenStream, as they are decoded
+        on_token = run_manager.on_llm_new_token if run_manager else None
+        return self.engine.generate(prompt, stop=stop, on_token=on_token)
+
+    def get_num_tokens(self, text: str) -> int:
+        return len(self.engine.tokenizer.encode(text, add_special_tokens=False))
+
+
+def smoke_test(model_id: str = BATCHING_BENCHMARK_MODEL) -> None:
+    """
+    Check the engine on a tiny model: greedy answers decoded in one batch match the answers of one prompt at a time,
+    a prompt too long for the context window is rejected, and a failing request leaves the others complete.
+
+    Args:
+        model_id (str): The transformers model to load, on CPU.
+
+    Raises:
+        AssertionError: If a check fails.
+    """
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(model_id)
+    model = AutoModelForCausalLM.from_pretrained(model_id)
+    engine = BatchingEngine(model, tokenizer, max_batch_size=4, max_new_tokens=16, temperature=0, context_window=64)
+    # Prompts of different lengths, so that the rows of the batch are padded
+    prompts = ["Hello", "The lesson plan of the week covers", "One two three four five six", "A"]
+    expected = [engine.generate(prompt) for prompt in prompts]
+
+    answers: list = [None] * len(prompts)
+    failures: list = []
+
+    def fail(text: str) -> None:
+        raise RuntimeError("Client went away")
+
+    def run(index: int) -> None:
+        answers[index] = engine.generate(prompts[index], timeout=120)
+
+    def run_failing() -> None:
+        try:
+            engine.generate(prompts[1], on_token=fail, timeout=120)
+        except RuntimeError as e:
+            failures.append(e)
+
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(len(prompts))]
+    threads.append(threading.Thread(target=run_failing))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert answers == expected, (answers, expected)
+    assert len(failures) == 1, failures
+
+    try:
+        engine.generate("word " * 100, timeout=120)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("A prompt longer than the context window was accepted")
+    # The engine still answers after the rejected prompt
+    assert engine.generate(prompts[0], timeout=120) == expected[0]
+    engine.close()
+
+
+def benchmark(model_id: str, concurrency: int, max_new_tokens: int) -> dict:
+    """
+    Compare the throughput of one prompt at a time with that of concurrent prompts sharing the decode loop.
+
+    Args:
+        model_id (str): The transformers model to load, on CPU.
+        concurrency (int): Number of concurrent prompts.
+        max_new_tokens (int): Number of tokens generated per prompt.
+
+    Returns:
+        dict: The tokens per second of a single stream and of the concurrent streams.
+    """
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(model_id)
+    model = AutoModelForCausalLM.from_pretrained(model_id)
+    # Greedy and without eos so that every prompt generates the same number of tokens
+    engine = BatchingEngine(model, tokenizer, max_batch_size=concurrency, max_new_tokens=max_new_tokens, temperature=0)
+    engine.eos_ids = set()
+    prompts = [f"Question {number}: what is the topic of lesson {number}?" for number in range(concurrency)]
+
+    def throughput(run: Callable[[], None]) -> float:
+        generated = engine.tokens_generated
+        start = time.perf_counter()
+        run()
+        return (engine.tokens_generated - generated) / (time.perf_counter() - start)
+
+    def concurrent() -> None:
+        threads = [threading.Thread(target=engine.generate, args=(prompt,)) for prompt in prompts]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    # Warm up the model before measuring
+    engine.generate(prompts[0], max_new_tokens=2)
+    single = throughput(lambda: [engine.generate(prompt) for prompt in prompts])
+    batched = throughput(concurrent)
+    return {
+        "single_stream_tokens_per_s": round(single, 1),
+        "batched_tokens_per_s": round(batched, 1),
+        "speedup": round(batched / single, 2),
+    }
+
+
+@click.command()
+@click.option(
+    "--model_id",
+    default=BATCHING_BENCHMARK_MODEL,
+    help="Transformers model to benchmark on CPU (Default is a tiny model)",
+)
+@click.option(
+    "--concurrency",
+    default=BATCH_MAX_SIZE,
+    type=int,
+    help="Number of concurrent prompts",
+)
+@click.option(
+    "--max_new_tokens",
+    default=64,
+    type=int,
+    help="Number of tokens generated per prompt",
+)
+@click.option(
+    "--check",
+    is_flag=True,
+    help="Run the smoke test instead of the benchmark",
+)
+def main(model_id, concurrency, max_new_tokens, check):
+    if check:
+        smoke_test(model_id)
+        print("Smoke test passed")
+        return
+    print(benchmark(model_id, concurrency, max_new_tokens))
+
+
+if __name__ == "__main__":
+    main()
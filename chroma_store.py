@@ -0,0 +1,389 @@
+"""
+This module implements the shared Chroma store holding the collections of every database.
+
+Every index directory (a database, one of its versions or one of their delta segments) gets its own Chroma client
+with its own sqlite file, HNSW segments and caches, so dozens of folders mean dozens of clients, file handles and
+caches. With SHARED_CHROMA_CLIENT, all collections live in one persistent store under DB/.chroma instead, opened by
+a single pooled client, and an index directory only names its collection. Creating a collection is one row in the
+shared sqlite file and dropping one deletes its rows and HNSW segment, so new versions and deltas are cheap. The
+chunk store, columnar store, routing vectors and manifests stay in the index directories.
+
+Chroma's persistent client supports a single process, so the shared store is locked by the process that opens it
+and a second process fails to open it rather than corrupting it. The API ingests and compacts in subprocesses and
+therefore keeps the default of one client per directory, where every ingest writes to a new directory.
+
+Directories ingested with a client of their own keep working through that client until they are migrated in
+place: their chunks and embeddings are copied into the shared store, without embedding anything again, and their
+own Chroma files are removed. Migrate while the API is stopped, it keeps the clients it opened.
+
+Functions:
+- get_client(): The Chroma client of the shared store, created once by the process holding its lock.
+- store_name(directory): The name of the collection of an index directory in the shared store.
+- is_own_client_entry(name): Whether a directory entry is a file of a Chroma client of its own.
+- open_store(directory, embedding_function, collection_metadata): Opens the vector store of an index directory.
+- segments_releasable(): Whether the segments of the installed chromadb version can be unloaded.
+- release_store(store): Unloads the segments of an open vector store from the memory of its client.
+- resident_bytes(store): Estimates the memory held by the loaded HNSW index of an open vector store.
+- drop_store(directory): Drops the collection of an index directory.
+- drop_stores(directory): Drops the collections of an index directory and of every directory below it.
+- remove_directory(path): Deletes an index directory and its collections, keeping the shared store.
+- migrate_directory(directory): Moves a directory with its own Chroma client into the shared store.
+
+Command-line Options:
+- --migrate: Migrates every directory of the DB directory that still has its own Chroma client.
+"""
+
+import hashlib
+import logging
+import os
+import re
+import shutil
+import threading
+from contextlib import nullcontext
+from typing import Optional
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+
+import chromadb
+import click
+from chromadb.utils.read_write_lock import ReadWriteLock, WriteRWLock
+from langchain.vectorstores import Chroma
+
+from constants import (
+    CHROMA_SETTINGS,
+    PERSIST_DIRECTORY,
+    SHARED_CHROMA_CLIENT,
+    SHARED_CHROMA_DIRECTORY,
+)
+
+# File of a directory that has a Chroma client of its own
+LEGACY_SQLITE_FILENAME = "chroma.sqlite3"
+# HNSW segments of a client of its own are stored in directories named after their uuid
+_SEGMENT_DIRECTORY_PATTERN = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+_COPY_BATCH_SIZE = 5000
+# Memory of the id, label and sequence id maps kept by the HNSW segment for every element, roughly
+_ID_MAPS_BYTES_PER_ELEMENT = 300
+# chromadb versions whose segment manager internals release_store and resident_bytes were checked against, the
+# version pinned in requirements.txt
+_SEGMENT_MANAGER_VERSIONS = ("0.4.6",)
+
+# File locked by the process using the shared store
+_LOCK_FILENAME = "client.lock"
+
+_client = None
+_client_lock = threading.Lock()
+_lock_file = None
+
+
+def _lock_store() -> None:
+    # Hold an exclusive lock on the shared store for the lifetime of the process
+    global _lock_file
+    os.makedirs(SHARED_CHROMA_DIRECTORY, exist_ok=True)
+    _lock_file = open(os.path.join(SHARED_CHROMA_DIRECTORY, _LOCK_FILENAME), "a+")
+    if fcntl is None:
+        # Windows has no advisory locks, keeping a single process is left to the deployment
+        return
+    try:
+        fcntl.flock(_lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        _lock_file.close()
+        _lock_file = None
+        raise RuntimeError(
+            f"The shared Chroma store {SHARED_CHROMA_DIRECTORY} is open in another process. Stop it, or set "
+            "SHARED_CHROMA_CLIENT = False to give every index directory a client of its own"
+        )
+
+
+def get_client():
+    """
+    Get the Chroma client of the shared store, created on first use and shared by every caller of the process.
+
+    Returns:
+        chromadb.API: The client.
+
+    Raises:
+        RuntimeError: If another process has the shared store open.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _lock_store()
+            _client = chromadb.PersistentClient(path=SHARED_CHROMA_DIRECTORY, settings=CHROMA_SETTINGS)
+        return _client
+
+
+def store_name(directory: str) -> str:
+    """
+    Get the name of the collection of an index directory in the shared store.
+
+    Args:
+        directory (str): The index directory.
+
+    Returns:
+        str: A valid Chroma collection name, readable and unique to the directory.
+    """
+    path = os.path.relpath(os.path.abspath(directory), os.path.abspath(PERSIST_DIRECTORY))
+    digest = hashlib.blake2b(path.encode("utf-8"), digest_size=6).hexdigest()
+    # Chroma names are 3 to 63 characters from [a-zA-Z0-9._-], starting and ending with a letter or digit
+    readable = re.sub(r"[^a-zA-Z0-9_-]+", "_", path)[:48].strip("_-")
+    return f"{readable or 'db'}-{digest}"
+
+
+def is_own_client_entry(name: str) -> bool:
+    """
+    Check whether an entry of an index directory is a file of a Chroma client of its own.
+
+    Args:
+        name (str): The name of the file or directory.
+
+    Returns:
+        bool: True for the sqlite file and the HNSW segment directories of the client.
+    """
+    return name == LEGACY_SQLITE_FILENAME or bool(_SEGMENT_DIRECTORY_PATTERN.match(name))
+
+
+def _has_own_client(directory: str) -> bool:
+    # Directories ingested before the shared store, and not migrated yet
+    return os.path.exists(os.path.join(directory, LEGACY_SQLITE_FILENAME))
+
+
+def open_store(directory: str, embedding_function=None, collection_metadata: Optional[dict] = None) -> Chroma:
+    """
+    Open the vector store of an index directory, creating its collection when it does not exist.
+
+    Args:
+        directory (str): The index directory.
+        embedding_function: The LangChain embeddings, needed to search by text or add texts.
+        collection_metadata (Optional[dict]): The metadata of a new collection, e.g. its HNSW parameters.
+
+    Returns:
+        Chroma: The LangChain vector store.
+    """
+    if not SHARED_CHROMA_CLIENT or _has_own_client(directory):
+        return Chroma(
+            persist_directory=directory,
+            embedding_function=embedding_function,
+            client_settings=CHROMA_SETTINGS,
+            collection_metadata=collection_metadata,
+        )
+    return Chroma(
+        client=get_client(),
+        collection_name=store_name(directory),
+        embedding_function=embedding_function,
+        collection_metadata=collection_metadata,
+    )
+
+
+def segments_releasable() -> bool:
+    """
+    Check whether release_store and resident_bytes can reach the segments of the installed chromadb version. They
+    use the internals of its local segment manager, which chromadb does not keep stable across versions.
+
+    Returns:
+        bool: True for the chromadb versions they were checked against.
+    """
+    return chromadb.__version__ in _SEGMENT_MANAGER_VERSIONS
+
+
+def _loaded_segments(store: Chroma) -> Optional[list]:
+    # The segment manager of the client of the collection and the segments it has loaded, chromadb 0.4.x keeps
+    # every loaded segment in memory until the client stops. None when they cannot be reached
+    if not segments_releasable():
+        return None
+    manager = getattr(store._collection._client, "_manager", None)
+    if not all(hasattr(manager, name) for name in ("_instances", "_segment_cache", "_lock")):
+        # E.g. a client of a Chroma server, whose segments live in the server
+        return None
+    segments = manager._segment_cache.get(store._collection.id, {})
+    return [(manager, segment) for segment in list(segments.values()) if segment["id"] in manager._instances]
+
+
+def release_store(store: Chroma) -> bool:
+    """
+    Unload the segments of an open vector store, freeing the memory of its HNSW index. The store stays usable,
+    its next query loads the segments from disk again.
+
+    Args:
+        store (Chroma): The vector store.
+
+    Returns:
+        bool: False when the segments of its client cannot be unloaded, they then stay loaded until it stops.
+    """
+    loaded = _loaded_segments(store)
+    if loaded is None:
+        return False
+    for manager, segment in loaded:
+        with manager._lock:
+            instance = manager._instances.pop(segment["id"], None)
+            handles = getattr(manager, "_vector_instances_file_handle_cache", None)
+            if handles is not None:
+                handles.cache.pop(store._collection.id, None)
+        if instance is None:
+            continue
+        # Wait for the records being written, the ones not persisted yet are replayed from the embeddings queue
+        # when the segment is loaded again
+        lock = getattr(instance, "_lock", None)
+        with WriteRWLock(lock) if isinstance(lock, ReadWriteLock) else nullcontext():
+            if hasattr(instance, "close_persistent_index"):
+                instance.close_persistent_index()
+            instance.stop()
+    return True
+
+
+def resident_bytes(store: Chroma) -> Optional[int]:
+    """
+    Estimate the memory held by the loaded HNSW index of an open vector store.
+
+    Args:
+        store (Chroma): The vector store.
+
+    Returns:
+        Optional[int]: The estimated size in bytes, 0 when its vector segment is not loaded, None when the
+            segments of its client cannot be reached.
+    """
+    loaded = _loaded_segments(store)
+    if loaded is None:
+        return None
+    total = 0
+    for manager, segment in loaded:
+        instance = manager._instances.get(segment["id"])
+        index = getattr(instance, "_index", None)
+        if index is None:
+            continue
+        # hnswlib allocates its whole capacity: the vector, the level 0 links and the label of every element
+        total += index.get_max_elements() * (index.dim * 4 + index.M * 2 * 4 + 12)
+        total += len(instance._id_to_label) * _ID_MAPS_BYTES_PER_ELEMENT
+    return total
+
+
+def _existing_names() -> set[str]:
+    return {collection.name for collection in get_client().list_collections()}
+
+
+def drop_store(directory: str) -> bool:
+    """
+    Drop the collection of an index directory from the shared store.
+
+    Args:
+        directory (str): The index directory.
+
+    Returns:
+        bool: True when a collection was dropped.
+    """
+    if not SHARED_CHROMA_CLIENT:
+        return False
+    name = store_name(directory)
+    if name not in _existing_names():
+        return False
+    get_client().delete_collection(name)
+    return True
+
+
+def drop_stores(directory: str) -> list[str]:
+    """
+    Drop the collections of an index directory and of every directory below it, e.g. its versions and deltas.
+
+    Args:
+        directory (str): The index directory.
+
+    Returns:
+        list[str]: The names of the dropped collections.
+    """
+    if not SHARED_CHROMA_CLIENT or not os.path.isdir(directory):
+        return []
+    existing = _existing_names()
+    dropped = []
+    for root, _, _ in os.walk(directory):
+        name = store_name(root)
+        if name in existing:
+            get_client().delete_collection(name)
+            dropped.append(name)
+    return dropped
+
+
+def remove_directory(path: str, ignore_errors: bool = False) -> None:
+    """
+    Delete an index directory with its collections. The shared store is kept when it lies below the directory.
+
+    Args:
+        path (str): The directory.
+        ignore_errors (bool): Ignore the errors of deleting files, as shutil.rmtree does.
+    """
+    drop_stores(path)
+    shared = os.path.abspath(SHARED_CHROMA_DIRECTORY)
+    if not shared.startswith(os.path.abspath(path) + os.sep):
+        shutil.rmtree(path, ignore_errors=ignore_errors)
+        return
+
+    # Deleting the files of the open shared store would break its client, empty the directory around it instead
+    for entry in os.listdir(path):
+        entry_path = os.path.abspath(os.path.join(path, entry))
+        if entry_path == shared:
+            continue
+        if shared.startswith(entry_path + os.sep):
+            remove_directory(entry_path, ignore_errors)
+        elif os.path.isdir(entry_path):
+            shutil.rmtree(entry_path, ignore_errors=ignore_errors)
+        else:
+            os.remove(entry_path)
+
+
+def migrate_directory(directory: str) -> int:
+    """
+    Move the collection of a directory with its own Chroma client into the shared store.
+
+    Args:
+        directory (str): The index directory.
+
+    Returns:
+        int: The number of chunks copied.
+    """
+    source = Chroma(persist_directory=directory, client_settings=CHROMA_SETTINGS)._collection
+    data = source.get(include=["embeddings", "documents", "metadatas"])
+    # Keep the tuned HNSW parameters of the collection
+    target = get_client().get_or_create_collection(store_name(directory), metadata=source.metadata or None)
+    for start in range(0, len(data["ids"]), _COPY_BATCH_SIZE):
+        end = start + _COPY_BATCH_SIZE
+        target.add(
+            ids=data["ids"][start:end],
+            embeddings=data["embeddings"][start:end],
+            documents=data["documents"][start:end],
+            metadatas=data["metadatas"][start:end],
+        )
+
+    # Remove the files of the directory's own client, the directory now only names its collection
+    for entry in os.listdir(directory):
+        if entry == LEGACY_SQLITE_FILENAME:
+            os.remove(os.path.join(directory, entry))
+        elif is_own_client_entry(entry):
+            shutil.rmtree(os.path.join(directory, entry), ignore_errors=True)
+    return len(data["ids"])
+
+
+@click.command()
+@click.option(
+    "--migrate",
+    is_flag=True,
+    help="Move every directory of the DB directory that has its own Chroma client into the shared store",
+)
+def main(migrate):
+    if not migrate:
+        for collection in get_client().list_collections():
+            print(f"{collection.name}: {collection.count()} chunks")
+        return
+    shared = os.path.abspath(SHARED_CHROMA_DIRECTORY)
+    for root, directories, _ in os.walk(PERSIST_DIRECTORY):
+        # Do not walk into the shared store itself
+        directories[:] = [name for name in directories if os.path.abspath(os.path.join(root, name)) != shared]
+        if _has_own_client(root):
+            copied = migrate_directory(root)
+            logging.info(f"Migrated {copied} chunks of {root}")
+            print(f"{root}: {copied} chunks migrated to {store_name(root)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""
+This module implements parent/child chunking.
+
+Documents are split twice: into parent spans, stored once and without overlap in a small sqlite chunk store next to
+the collection, and into small child chunks within every parent, which are the only ones embedded and searched.
+At query time the matched children are expanded to their parents, and parents that follow each other in the same
+source are merged into a single window, so the LLM gets coherent context without repeated text.
+
+Functions:
+- split_parent_child(documents, parent_splitter, child_splitter): Splits documents into parents and children.
+- expand_to_parents(documents, store_of): Replaces matched children by their merged, deduplicated parent windows.
+
+Classes:
+- ChunkStore: The parent spans of a collection, stored in sqlite.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+from typing import Callable, Optional
+
+from langchain.docstore.document import Document
+
+from constants import CHUNK_STORE_FILENAME
+
+
+class ChunkStore:
+    def __init__(self, persist_directory: str, extra_directories: Optional[list[str]] = None):
+        """
+        Initializes the chunk store of a collection.
+
+        Args:
+            persist_directory (str): The directory of the collection.
+            extra_directories (Optional[list[str]]): The directories of its delta segments, also searched by get.
+        """
+        self.path = os.path.join(persist_directory, CHUNK_STORE_FILENAME)
+        self.extra_paths = [os.path.join(directory, CHUNK_STORE_FILENAME) for directory in extra_directories or []]
+
+    def write(self, parents: list[Document]) -> None:
+        """
+        Replace the parent spans of the collection.
+
+        Args:
+            parents (list[Document]): The parent spans, with "parent_id" and "parent_index" metadata.
+        """
+        # Build the store next to the final file and rename it, so the API never reads a partial store
+        tmp_path = self.path + ".tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        with sqlite3.connect(tmp_path) as connection:
+            connection.execute("CREATE TABLE parents (id TEXT PRIMARY KEY, text TEXT, metadata TEXT)")
+            connection.executemany(
+                "INSERT OR REPLACE INTO parents VALUES (?, ?, ?)",
+                [(doc.metadata["parent_id"], doc.page_content, json.dumps(doc.metadata)) for doc in parents],
+            )
+        os.replace(tmp_path, self.path)
+
+    def get(self, parent_ids: list[str]) -> dict[str, Document]:
+        """
+        Read parent spans by id.
+
+        Args:
+            parent_ids (list[str]): The ids of the parents to read.
+
+        Returns:
+            dict[str, Document]: The parents found, by id. Empty when the collection has no chunk store.
+        """
+        found: dict[str, Document] = {}
+        for path in [self.path] + self.extra_paths:
+            missing = [parent_id for parent_id in parent_ids if parent_id not in found]
+            if not missing:
+                break
+            found.update(self._read(path, "WHERE id IN (" + ",".join("?" * len(missing)) + ")", missing))
+        return found
+
+    def all(self) -> list[Document]:
+        """
+        Read every parent span of the collection, without its delta segments.
+
+        Returns:
+            list[Document]: The parent spans.
+        """
+        return list(self._read(self.path, "", []).values())
+
+    @staticmethod
+    def _read(path: str, condition: str, parameters: list[str]) -> dict[str, Document]:
+        if not os.path.exists(path):
+            return {}
+        # One short-lived connection per call, sqlite connections cannot be shared between request threads
+        with sqlite3.connect(f"file:{path}?mode=ro", uri=True) as connection:
+            rows = connection.execute(f"SELECT id, text, metadata FROM parents {condition}", parameters).fetchall()
+        return {row[0]: Document(page_content=row[1], metadata=json.loads(row[2])) for row in rows}
+
+
+def split_parent_child(
+    documents: list[Document], parent_splitter, child_splitter
+) -> tuple[list[Document], list[Document]]:
+    """
+    Split documents into parent spans and the child chunks embedded for search.
+
+    Args:
+        documents (list[Document]): The loaded documents.
+        parent_splitter: The LangChain text splitter producing the parent spans.
+        child_splitter: The LangChain text splitter producing the child chunks of every parent.
+
+    Returns:
+        tuple[list[Document], list[Document]]: The parents and the children. Every child carries the "parent_id"
+        and "parent_index" of its parent.
+    """
+    parents, children = [], []
+    for doc in documents:
+        for index, parent in enumerate(parent_splitter.split_documents([doc])):
+            source = str(parent.metadata.get("source", ""))
+            parent.metadata["parent_id"] = hashlib.blake2b(
+                f"{source}:{index}:{parent.page_content}".encode("utf-8"), digest_size=16
+            ).hexdigest()
+            # Position of the parent in its source, used to merge neighbouring parents at query time
+            parent.metadata["parent_index"] = index
+            parents.append(parent)
+            children.extend(child_splitter.split_documents([parent]))
+    return parents, children
+
+
+def expand_to_parents(
+    documents: list[Document], store_of: Callable[[Document], Optional[ChunkStore]]
+) -> list[Document]:
+    """
+    Replace matched children by their parent windows.
+
+    Parents matched several times are kept once, and parents that follow each other in the same source are merged
+    into one window. Windows are ordered by their best matching child. Documents without a parent, e.g. from
+    collections ingested before parent/child chunking, are returned unchanged.
+
+    Args:
+        documents (list[Document]): The matched children, best first.
+        store_of (Callable[[Document], Optional[ChunkStore]]): Gives the chunk store a child comes from.
+
+    Returns:
+        list[Document]: The parent windows and the documents without a parent, best first.
+    """
+    # Read the parents of every matched child, one query per chunk store
+    wanted: dict[int, tuple[ChunkStore, list[str]]] = {}
+    for doc in documents:
+        store = store_of(doc)
+        if store is not None and "parent_id" in doc.metadata:
+            wanted.setdefault(id(store), (store, []))[1].append(doc.metadata["parent_id"])
+    parents: dict[str, Document] = {}
+    for store, parent_ids in wanted.values():
+        parents.update(store.get(list(dict.fromkeys(parent_ids))))
+
+    # Rank of the best child matching every parent, and the documents without a parent at their own rank
+    ranked: dict[tuple, tuple[int, Document]] = {}
+    results: list[tuple[int, Document]] = []
+    for rank, doc in enumerate(documents):
+        parent = parents.get(doc.metadata.get("parent_id"))
+        if parent is None:
+            results.append((rank, doc))
+            continue
+        key = (doc.metadata.get("database"), parent.metadata.get("source"), parent.metadata["parent_index"])
+        ranked.setdefault(key, (rank, parent))
+
+    # Merge the runs of consecutive parents of the same source into one window, ranked by its best child
+    run: list[tuple] = []
+    for key in sorted(ranked, key=lambda key: (str(key[0]), str(key[1]), key[2])) + [None]:
+        if run and (key is None or key[:2] != run[-1][:2] or key[2] != run[-1][2] + 1):
+            spans = [ranked[member][1] for member in run]
+            metadata = {**spans[0].metadata, "parent_ids": ",".join(span.metadata["parent_id"] for span in spans)}
+            if run[0][0] is not None:
+                # Keep the database a federated search recorded on the children
+                metadata["database"] = run[0][0]
+            window = Document(page_content="\n".join(span.page_content for span in spans), metadata=metadata)
+            results.append((min(ranked[member][0] for member in run), window))
+            run = []
+        if key is not None:
+            run.append(key)
+
+    return [doc for _, doc in sorted(results, key=lambda result: result[0])]
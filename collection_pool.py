@@ -0,0 +1,298 @@
+"""
+This module implements the pool of open collections used by the API in place of a plain retriever dictionary.
+
+Searching a Chroma collection loads its HNSW index into memory, where the Chroma client keeps it until it stops,
+so opening every folder of the DB directory at startup makes startup time and resident memory grow with the number
+of folders. The pool opens collections on first use, keeps at most a fixed number of them (and optionally a fixed
+estimated size of their loaded indexes) open with least-recently-used eviction, and records decayed usage counts so
+that the most used collections can be preloaded in the background when the API starts. Closing a collection
+releases its segments through the client: dropping the retriever alone would leave the index in the client's memory.
+Where the client's segments cannot be released or measured (see chroma_store.segments_releasable), the pool falls
+back to plain least-recently-used eviction of at most max_open collections and says so in its logs.
+
+Functions:
+- list_databases(persist_directory): Lists the databases of the DB directory.
+
+Classes:
+- CollectionPool: Dictionary-like, thread-safe pool of lazily opened retrievers.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Iterable, Iterator, Optional
+
+from constants import (
+    COLLECTION_USAGE_FILE,
+    COLLECTION_USAGE_HALF_LIFE_SECONDS,
+    MAX_OPEN_COLLECTIONS,
+    OPEN_COLLECTIONS_MEMORY_BUDGET_BYTES,
+    PERSIST_DIRECTORY,
+)
+from snapshots import is_servable
+from utils import info, warning
+
+
+def list_databases(persist_directory: str = PERSIST_DIRECTORY) -> list[str]:
+    """
+    List the databases of the DB directory.
+
+    Args:
+        persist_directory (str): The directory holding one sub-directory per database.
+
+    Returns:
+        list[str]: The names of the databases.
+    """
+    try:
+        return sorted(
+            name
+            for name in os.listdir(persist_directory)
+            if os.path.isdir(os.path.join(persist_directory, name))
+            and not name.startswith(".")
+            # A database whose first version is still being built cannot be searched yet
+            and is_servable(os.path.join(persist_directory, name))
+        )
+    except OSError:
+        return []
+
+
+class CollectionPool:
+    def __init__(
+        self,
+        opener: Callable[[str], Any],
+        closer: Optional[Callable[[Any], bool]] = None,
+        sizer: Optional[Callable[[Any], Optional[int]]] = None,
+        persist_directory: str = PERSIST_DIRECTORY,
+        max_open: int = MAX_OPEN_COLLECTIONS,
+        memory_budget: int = OPEN_COLLECTIONS_MEMORY_BUDGET_BYTES,
+        usage_file: str = COLLECTION_USAGE_FILE,
+    ):
+        """
+        Initializes an empty pool.
+
+        Args:
+            opener (Callable[[str], Any]): Function opening the retriever of a database from its name.
+            closer (Optional[Callable[[Any], bool]]): Function releasing the memory of a closed retriever, returns
+                False when it could not.
+            sizer (Optional[Callable[[Any], Optional[int]]]): Function estimating the memory held by an open
+                retriever, returns None when it cannot.
+            persist_directory (str): The directory holding one sub-directory per database.
+            max_open (int): Maximum number of collections kept open.
+            memory_budget (int): Maximum estimated memory, in bytes, of the collections kept open, measured by
+                sizer. 0 disables it.
+            usage_file (str): JSON file in which the decayed usage counts are persisted.
+        """
+        self.opener = opener
+        self.closer = closer
+        self.sizer = sizer
+        self.persist_directory = persist_directory
+        self.max_open = max_open
+        self.memory_budget = memory_budget
+        self.usage_file = usage_file
+
+        # Open retrievers, in least-recently-used order
+        self._open: OrderedDict[str, Any] = OrderedDict()
+        self._lock = threading.Lock()
+        # One lock per database so that a collection is never opened twice concurrently
+        self._open_locks: dict[str, threading.Lock] = {}
+
+        # Decayed usage counts by database, with the time they were last updated
+        self._usage: dict[str, tuple[float, float]] = self._load_usage()
+        self._usage_saved_at = time.time()
+        self._unmeasured_warned = False
+
+    def _load_usage(self) -> dict[str, tuple[float, float]]:
+        try:
+            with open(self.usage_file, encoding="utf-8") as file:
+                return {name: tuple(value) for name, value in json.load(file).items()}
+        except (OSError, ValueError):
+            return {}
+
+    def _save_usage(self) -> None:
+        # Write to a temporary file first so that a crash never leaves a partial file
+        try:
+            tmp_path = self.usage_file + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as file:
+                json.dump(self._usage, file)
+            os.replace(tmp_path, self.usage_file)
+        except OSError as e:
+            warning(message=f"Could not save collection usage: {e}")
+
+    def _decayed(self, name: str, now: float) -> float:
+        count, updated_at = self._usage.get(name, (0.0, now))
+        return count * 0.5 ** ((now - updated_at) / COLLECTION_USAGE_HALF_LIFE_SECONDS)
+
+    def _record_use(self, name: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._usage[name] = (self._decayed(name, now) + 1.0, now)
+            # Persist at most once a minute, the counts only need to survive restarts roughly
+            if now - self._usage_saved_at > 60:
+                self._usage_saved_at = now
+                self._save_usage()
+
+    def _evict(self) -> list[tuple[str, Any]]:
+        # Remove the least recently used collections until the pool fits its limits, always keeping one open. The
+        # indexes are measured now rather than when opened, a collection only loads its index on its first search
+        sizes = {}
+        if self.memory_budget and self.sizer is not None:
+            sizes = {name: self.sizer(retriever) for name, retriever in self._open.items()}
+            if None in sizes.values():
+                if not self._unmeasured_warned:
+                    self._unmeasured_warned = True
+                    warning(message="The memory of the open collections cannot be measured, only max_open applies")
+                sizes = {}
+        total = sum(sizes.values())
+        evicted = []
+        while len(self._open) > 1 and (
+            len(self._open) > self.max_open or (self.memory_budget and total > self.memory_budget)
+        ):
+            name, retriever = self._open.popitem(last=False)
+            total -= sizes.get(name, 0)
+            evicted.append((name, retriever))
+        return evicted
+
+    def _close(self, closed: Iterable[tuple[str, Any]]) -> None:
+        # Release the memory of the removed collections, outside the pool lock since writes may be waited for
+        for name, retriever in closed:
+            released = True
+            if self.closer is not None:
+                try:
+                    released = self.closer(retriever)
+                except Exception as e:
+                    warning(message=f"Closed collection '{name}', releasing its index failed: {e}")
+                    continue
+            if released:
+                info(message=f"Closed collection '{name}'")
+            else:
+                warning(message=f"Closed collection '{name}', the Chroma client keeps its index loaded")
+
+    def __getitem__(self, name: str) -> Any:
+        if name not in self:
+            raise KeyError(name)
+        self._record_use(name)
+
+        with self._lock:
+            if name in self._open:
+                self._open.move_to_end(name)
+                return self._open[name]
+            open_lock = self._open_locks.setdefault(name, threading.Lock())
+
+        with open_lock:
+            # Another request may have opened it while this one was waiting
+            with self._lock:
+                if name in self._open:
+                    self._open.move_to_end(name)
+                    return self._open[name]
+
+            retriever = self.opener(name)
+            info(message=f"Opened collection '{name}'")
+
+            with self._lock:
+                self._open[name] = retriever
+                evicted = self._evict()
+            self._close(evicted)
+            return retriever
+
+    def __setitem__(self, name: str, retriever: Any) -> None:
+        # Replace the retriever of a re-ingested collection
+        with self._lock:
+            self._open[name] = retriever
+            self._open.move_to_end(name)
+            evicted = self._evict()
+        self._close(evicted)
+
+    def __delitem__(self, name: str) -> None:
+        with self._lock:
+            closed = [(name, self._open.pop(name))] if name in self._open else []
+        self._close(closed)
+
+    def __contains__(self, name: object) -> bool:
+        return name in self._open or name in list_databases(self.persist_directory)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(list_databases(self.persist_directory))
+
+    def __len__(self) -> int:
+        return len(list_databases(self.persist_directory))
+
+    def clear(self) -> None:
+        """
+        Close every open collection.
+        """
+        with self._lock:
+            closed = list(self._open.items())
+            self._open.clear()
+        self._close(closed)
+
+    def open_names(self) -> list[str]:
+        """
+        List the collections currently open.
+
+        Returns:
+            list[str]: The names of the open collections, least recently used first.
+        """
+        with self._lock:
+            return list(self._open)
+
+    def most_used(self, n: int) -> list[str]:
+        """
+        List the most used databases according to the decayed usage counts.
+
+        Args:
+            n (int): Maximum number of databases returned.
+
+        Returns:
+            list[str]: The names of the most used existing databases, most used first.
+        """
+        now = time.time()
+        existing = set(list_databases(self.persist_directory))
+        with self._lock:
+            ranked = sorted(
+                (name for name in self._usage if name in existing),
+                key=lambda name: self._decayed(name, now),
+                reverse=True,
+            )
+        return ranked[:n]
+
+    def preload(self, n: int, background: bool = True) -> Optional[threading.Thread]:
+        """
+        Open the most used databases ahead of their first request.
+
+        Args:
+            n (int): Number of databases to open. Never more than the pool can keep open.
+            background (bool): Whether to open them in a daemon thread.
+
+        Returns:
+            Optional[threading.Thread]: The preloading thread when running in the background.
+        """
+
+        def _preload() -> None:
+            for name in self.most_used(min(n, self.max_open)):
+                try:
+                    # Open without counting it as a use, preloading must not feed its own ranking
+                    with self._lock:
+                        if name in self._open:
+                            continue
+                        # Never close a collection that requests already opened to make room for a guess
+                        if len(self._open) >= self.max_open:
+                            return
+                    retriever = self.opener(name)
+                    evicted = []
+                    with self._lock:
+                        if name not in self._open:
+                            self._open[name] = retriever
+                            evicted = self._evict()
+                    self._close(evicted)
+                    info(message=f"Preloaded collection '{name}'")
+                except Exception as e:
+                    warning(message=f"Could not preload collection '{name}': {e}")
+
+        if not background:
+            _preload()
+            return None
+        thread = threading.Thread(target=_preload, name="collection-preload", daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,317 @@
+"""
+This module implements the columnar text store of the chunks of a collection.
+
+Chroma stores the text of every chunk, with its 200-character overlap, and its whole metadata dict per row in its
+sqlite segment, plus a full-text index of the text. The columnar store keeps the text of every source document
+once, zlib-compressed and memory-mapped, and every chunk as (document, start, end) offsets into that text. Chunk
+metadata is stored as typed columns: integers and floats as numpy arrays, strings and other values as codes into
+a dictionary of distinct values. The vector index then only holds the chunk ids with their embeddings and the
+flat fields used by where filters. Fetching the chunks of a search reads each document once, in file order.
+
+Files, under columns/ in the collection directory:
+- documents.bin: The compressed documents, back to back, and documents.npy their (n_documents + 1) offsets.
+- spans.npy: The (document, start, end) of every chunk, one row per chunk.
+- ids.json: The chunk ids, in row order.
+- schema.json: The metadata columns, and meta_<column>.npy / meta_<column>.json their codes and dictionaries.
+
+Functions:
+- index_documents(db, chunks, documents, embeddings, persist_directory): Adds chunks to a collection and its store.
+
+Classes:
+- ColumnarStore: The chunk text and metadata of a collection, memory-mapped and reloaded when rewritten.
+"""
+
+import json
+import os
+import shutil
+import threading
+import uuid
+import zlib
+from collections import OrderedDict
+from typing import Any, Optional
+
+import numpy as np
+from langchain.docstore.document import Document
+
+from constants import COLUMNAR_STORE_DIRNAME, COLUMNAR_DOCUMENT_CACHE_SIZE
+from metadata_filters import index_metadata
+
+# Missing values of the typed columns
+_MISSING_INT = np.iinfo(np.int64).min
+_MISSING_CODE = -1
+# Number of chunks added to Chroma per call, below its maximum batch size
+_ADD_BATCH_SIZE = 5000
+
+
+def _column_kind(values: list) -> str:
+    # The narrowest type holding every present value of a metadata key
+    present = [value for value in values if value is not None]
+    if all(isinstance(value, int) and not isinstance(value, bool) for value in present):
+        return "int"
+    if all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in present):
+        return "float"
+    if all(isinstance(value, str) for value in present):
+        return "str"
+    return "json"
+
+
+def _write_column(directory: str, number: int, kind: str, values: list) -> None:
+    path = os.path.join(directory, f"meta_{number}")
+    if kind == "int":
+        np.save(path + ".npy", np.array([_MISSING_INT if v is None else v for v in values], dtype=np.int64))
+        return
+    if kind == "float":
+        np.save(path + ".npy", np.array([np.nan if v is None else v for v in values], dtype=np.float64))
+        return
+    # Dictionary encoding, a source or file name repeated by every chunk of a file is stored once
+    encoded = values if kind == "str" else [None if v is None else json.dumps(v) for v in values]
+    dictionary: dict[str, int] = {}
+    codes = [_MISSING_CODE if v is None else dictionary.setdefault(v, len(dictionary)) for v in encoded]
+    np.save(path + ".npy", np.array(codes, dtype=np.int32))
+    with open(path + ".json", "w", encoding="utf-8") as file:
+        json.dump(list(dictionary), file)
+
+
+class ColumnarStore:
+    def __init__(self, persist_directory: str, extra_directories: Optional[list[str]] = None):
+        """
+        Initializes the columnar store of a collection.
+
+        Args:
+            persist_directory (str): The directory of the collection.
+            extra_directories (Optional[list[str]]): The directories of its delta segments, also searched by get.
+        """
+        self.directory = os.path.join(persist_directory, COLUMNAR_STORE_DIRNAME)
+        self.extra = [ColumnarStore(directory) for directory in extra_directories or []]
+        self._signature: Optional[tuple] = None
+        self._loaded: Optional[dict] = None
+        # Decompressed documents, the chunks of a search often share their source
+        self._documents: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def exists(self) -> bool:
+        # Collections ingested before the columnar store keep their text in Chroma
+        return os.path.exists(os.path.join(self.directory, "schema.json"))
+
+    def write(self, chunks: list[Document], ids: list[str], documents: list[Document]) -> None:
+        """
+        Replace the store with chunks and the documents they were split from.
+
+        Args:
+            chunks (list[Document]): The chunks, in the order of their ids.
+            ids (list[str]): The chunk ids, as added to the vector index.
+            documents (list[Document]): The documents the chunks were split from, matched by their "source"
+                metadata. Chunks found in none of them, e.g. after whitespace normalisation, are stored as
+                documents of their own.
+        """
+        by_source: dict[Any, list[int]] = {}
+        for number, doc in enumerate(documents):
+            if doc is not None:
+                by_source.setdefault(doc.metadata.get("source"), []).append(number)
+
+        # Locate every chunk in its document, keeping only the documents some chunk refers to
+        texts: list[str] = []
+        kept: dict[int, int] = {}
+        spans = np.zeros((len(chunks), 3), dtype=np.int64)
+        cursor: dict[int, int] = {}
+        for row, chunk in enumerate(chunks):
+            text = chunk.page_content
+            found = None
+            for number in by_source.get(chunk.metadata.get("source"), []):
+                content = documents[number].page_content
+                # Chunks come in document order, search from the previous chunk first
+                start = content.find(text, cursor.get(number, 0))
+                if start == -1:
+                    start = content.find(text)
+                if start != -1:
+                    found = (number, start)
+                    cursor[number] = start
+                    break
+            if found is None:
+                spans[row] = (len(texts), 0, len(text))
+                texts.append(text)
+                continue
+            number, start = found
+            if number not in kept:
+                kept[number] = len(texts)
+                texts.append(documents[number].page_content)
+            spans[row] = (kept[number], start, start + len(text))
+
+        # Build the new store beside the final one, then swap the directories
+        tmp_directory = self.directory + ".tmp"
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        os.makedirs(tmp_directory)
+        offsets = [0]
+        with open(os.path.join(tmp_directory, "documents.bin"), "wb") as file:
+            for text in texts:
+                offsets.append(offsets[-1] + file.write(zlib.compress(text.encode("utf-8"))))
+        np.save(os.path.join(tmp_directory, "documents.npy"), np.array(offsets, dtype=np.int64))
+        np.save(os.path.join(tmp_directory, "spans.npy"), spans)
+        with open(os.path.join(tmp_directory, "ids.json"), "w", encoding="utf-8") as file:
+            json.dump(list(ids), file)
+
+        keys = list(dict.fromkeys(key for chunk in chunks for key in chunk.metadata))
+        schema = []
+        for number, key in enumerate(keys):
+            values = [chunk.metadata.get(key) for chunk in chunks]
+            kind = _column_kind(values)
+            _write_column(tmp_directory, number, kind, values)
+            schema.append({"key": key, "kind": kind})
+        # The schema is written last, a store without it is incomplete
+        with open(os.path.join(tmp_directory, "schema.json"), "w", encoding="utf-8") as file:
+            json.dump(schema, file)
+
+        old_directory = self.directory + ".old"
+        shutil.rmtree(old_directory, ignore_errors=True)
+        if os.path.exists(self.directory):
+            os.replace(self.directory, old_directory)
+        os.replace(tmp_directory, self.directory)
+        shutil.rmtree(old_directory, ignore_errors=True)
+
+    def _load(self) -> Optional[dict]:
+        # Reload when the store was rewritten by a new ingest
+        schema_path = os.path.join(self.directory, "schema.json")
+        try:
+            stat = os.stat(schema_path)
+            signature = (stat.st_mtime_ns, stat.st_ino)
+        except OSError:
+            signature = None
+        if signature == self._signature:
+            return self._loaded
+        self._signature, self._loaded = signature, None
+        self._documents.clear()
+        if signature is None:
+            return None
+
+        def path(name: str) -> str:
+            return os.path.join(self.directory, name)
+
+        with open(schema_path, encoding="utf-8") as file:
+            schema = json.load(file)
+        with open(path("ids.json"), encoding="utf-8") as file:
+            rows = {chunk_id: row for row, chunk_id in enumerate(json.load(file))}
+        columns = []
+        for number, column in enumerate(schema):
+            values = np.load(path(f"meta_{number}.npy"), mmap_mode="r")
+            dictionary = None
+            if column["kind"] in ("str", "json"):
+                with open(path(f"meta_{number}.json"), encoding="utf-8") as file:
+                    dictionary = json.load(file)
+            columns.append((column["key"], column["kind"], values, dictionary))
+        # Memory-mapped, only the documents and rows of retrieved chunks are read from disk. numpy cannot map an
+        # empty file, which a store without chunks has
+        blob = b""
+        if os.path.getsize(path("documents.bin")):
+            blob = np.memmap(path("documents.bin"), dtype=np.uint8, mode="r")
+        self._loaded = {
+            "rows": rows,
+            "columns": columns,
+            "spans": np.load(path("spans.npy"), mmap_mode="r"),
+            "offsets": np.load(path("documents.npy"), mmap_mode="r"),
+            "blob": blob,
+        }
+        return self._loaded
+
+    def _document(self, loaded: dict, number: int) -> str:
+        # Decompress a document, keeping the most recently used ones
+        text = self._documents.get(number)
+        if text is not None:
+            self._documents.move_to_end(number)
+            return text
+        start, end = int(loaded["offsets"][number]), int(loaded["offsets"][number + 1])
+        text = zlib.decompress(bytes(loaded["blob"][start:end])).decode("utf-8")
+        self._documents[number] = text
+        if len(self._documents) > COLUMNAR_DOCUMENT_CACHE_SIZE:
+            self._documents.popitem(last=False)
+        return text
+
+    @staticmethod
+    def _metadata(loaded: dict, row: int) -> dict:
+        metadata = {}
+        for key, kind, values, dictionary in loaded["columns"]:
+            value = values[row]
+            if kind == "int":
+                if value != _MISSING_INT:
+                    metadata[key] = int(value)
+            elif kind == "float":
+                if not np.isnan(value):
+                    metadata[key] = float(value)
+            elif value != _MISSING_CODE:
+                metadata[key] = dictionary[value] if kind == "str" else json.loads(dictionary[value])
+        return metadata
+
+    def get(self, ids: list[str]) -> dict[str, Document]:
+        """
+        Read chunks by id.
+
+        Args:
+            ids (list[str]): The ids of the chunks to read.
+
+        Returns:
+            dict[str, Document]: The chunks found, by id, with their text and full metadata.
+        """
+        found: dict[str, Document] = {}
+        with self._lock:
+            loaded = self._load()
+            if loaded is not None:
+                rows = [(loaded["rows"][chunk_id], chunk_id) for chunk_id in ids if chunk_id in loaded["rows"]]
+                # Read in document order, each document is decompressed once
+                for row, chunk_id in sorted(rows, key=lambda item: tuple(loaded["spans"][item[0]])):
+                    number, start, end = (int(value) for value in loaded["spans"][row])
+                    text = self._document(loaded, number)[start:end]
+                    found[chunk_id] = Document(page_content=text, metadata=self._metadata(loaded, row))
+
+        missing = [chunk_id for chunk_id in ids if chunk_id not in found]
+        for store in self.extra:
+            if not missing:
+                break
+            found.update(store.get(missing))
+            missing = [chunk_id for chunk_id in missing if chunk_id not in found]
+        return found
+
+    def documents(self) -> list[Document]:
+        """
+        Read every stored document, with the metadata of its first chunk.
+
+        Returns:
+            list[Document]: The documents, used to rewrite the store when segments are compacted.
+        """
+        with self._lock:
+            loaded = self._load()
+            if loaded is None:
+                return []
+            first: dict[int, int] = {}
+            for row, span in enumerate(loaded["spans"]):
+                first.setdefault(int(span[0]), row)
+            return [
+                Document(page_content=self._document(loaded, number), metadata=self._metadata(loaded, row))
+                for number, row in sorted(first.items())
+            ]
+
+
+def index_documents(db, chunks: list[Document], documents: list[Document], embeddings, persist_directory: str):
+    """
+    Add chunks to a collection, their text and metadata going to its columnar store.
+
+    Args:
+        db: The LangChain Chroma vector store of the collection.
+        chunks (list[Document]): The chunks to embed.
+        documents (list[Document]): The documents the chunks were split from.
+        embeddings: The LangChain embeddings of the collection.
+        persist_directory (str): The directory of the collection.
+
+    Returns:
+        The vector store.
+    """
+    ids = [str(uuid.uuid4()) for _ in chunks]
+    vectors = embeddings.embed_documents([chunk.page_content for chunk in chunks])
+    # Write the text first, a chunk returned by a search always has its text
+    ColumnarStore(persist_directory).write(chunks, ids, documents)
+    for start in range(0, len(chunks), _ADD_BATCH_SIZE):
+        end = start + _ADD_BATCH_SIZE
+        db._collection.add(
+            ids=ids[start:end],
+            embeddings=vectors[start:end],
+            metadatas=[index_metadata(chunk.metadata) for chunk in chunks[start:end]],
+        )
+    return db
@@ -0,0 +1,244 @@
+"""
+This module implements extractive compression of the retrieved context.
+
+Most of the text of a relevant chunk is still unrelated to the question, and on CPU every prompt token costs
+prefill time. The compressor splits the retrieved documents into sentences, scores every sentence against the
+query embedding in one matrix product, and keeps the best sentences, in their original order, up to a token
+budget. Sentence embeddings are computed once at ingest time and stored next to the collection, keyed by a hash
+of the sentence text, so only sentences that were never seen need embedding at query time.
+
+Functions:
+- split_sentences(text): Splits a text into sentences.
+- write_sentence_embeddings(documents, embeddings, persist_directory): Stores the sentence embeddings of a collection.
+- merge_sentence_embeddings(directories, persist_directory): Merges the sentence embeddings of several segments.
+- compress_documents(query_vector, documents, budget, count_tokens, embeddings, store_of): Keeps the best sentences.
+
+Classes:
+- SentenceStore: The sentence embeddings of a collection, memory-mapped and reloaded when rewritten.
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+from typing import Callable, Optional
+
+import numpy as np
+from langchain.docstore.document import Document
+
+from constants import (
+    COMPRESSION_MIN_SIMILARITY,
+    SENTENCE_EMBEDDINGS_FILENAME,
+    SENTENCE_INDEX_FILENAME,
+)
+from context_packer import count_all
+from retrieval import normalise_rows
+
+# Sentence ends, and line breaks which end list items and headings in slides and documents
+_SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+|\n+")
+
+
+def split_sentences(text: str) -> list[str]:
+    """
+    Split a text into sentences.
+
+    Args:
+        text (str): The text to split.
+
+    Returns:
+        list[str]: The non-empty sentences, stripped.
+    """
+    return [sentence.strip() for sentence in _SENTENCE_BOUNDARY.split(text) if sentence.strip()]
+
+
+def _sentence_key(sentence: str) -> str:
+    return hashlib.blake2b(sentence.encode("utf-8"), digest_size=12).hexdigest()
+
+
+def write_sentence_embeddings(documents: list[Document], embeddings, persist_directory: str) -> int:
+    """
+    Embed the sentences of the documents of a collection and store them next to it.
+
+    Args:
+        documents (list[Document]): The documents whose text reaches the prompt, i.e. the parent spans when
+            parent/child chunking is used, otherwise the chunks.
+        embeddings: The LangChain embeddings of the collection.
+        persist_directory (str): The directory of the collection.
+
+    Returns:
+        int: The number of distinct sentences stored.
+    """
+    sentences = list(dict.fromkeys(sentence for doc in documents for sentence in split_sentences(doc.page_content)))
+    if not sentences:
+        return 0
+    matrix = normalise_rows(np.asarray(embeddings.embed_documents(sentences), dtype=np.float32))
+
+    # Write next to the final files and rename them, the index last so readers never see a partial store
+    matrix_path = os.path.join(persist_directory, SENTENCE_EMBEDDINGS_FILENAME)
+    index_path = os.path.join(persist_directory, SENTENCE_INDEX_FILENAME)
+    np.save(matrix_path + ".tmp.npy", matrix)
+    os.replace(matrix_path + ".tmp.npy", matrix_path)
+    with open(index_path + ".tmp", "w", encoding="utf-8") as file:
+        json.dump({_sentence_key(sentence): row for row, sentence in enumerate(sentences)}, file)
+    os.replace(index_path + ".tmp", index_path)
+    return len(sentences)
+
+
+def merge_sentence_embeddings(directories: list[str], persist_directory: str) -> int:
+    """
+    Merge the stored sentence embeddings of several segments into the store of a compacted collection.
+
+    Args:
+        directories (list[str]): The directories of the segments, oldest first.
+        persist_directory (str): The directory of the compacted collection.
+
+    Returns:
+        int: The number of distinct sentences stored.
+    """
+    rows, keys = [], {}
+    for directory in directories:
+        try:
+            with open(os.path.join(directory, SENTENCE_INDEX_FILENAME), encoding="utf-8") as file:
+                index = json.load(file)
+            matrix = np.load(os.path.join(directory, SENTENCE_EMBEDDINGS_FILENAME), mmap_mode="r")
+        except (OSError, ValueError):
+            continue
+        for key, row in index.items():
+            if key not in keys:
+                keys[key] = len(rows)
+                rows.append(np.asarray(matrix[row]))
+    if not rows:
+        return 0
+
+    matrix_path = os.path.join(persist_directory, SENTENCE_EMBEDDINGS_FILENAME)
+    index_path = os.path.join(persist_directory, SENTENCE_INDEX_FILENAME)
+    np.save(matrix_path + ".tmp.npy", np.vstack(rows))
+    os.replace(matrix_path + ".tmp.npy", matrix_path)
+    with open(index_path + ".tmp", "w", encoding="utf-8") as file:
+        json.dump(keys, file)
+    os.replace(index_path + ".tmp", index_path)
+    return len(rows)
+
+
+class SentenceStore:
+    def __init__(self, persist_directory: str):
+        """
+        Initializes the sentence store of a collection.
+
+        Args:
+            persist_directory (str): The directory of the collection.
+        """
+        self.matrix_path = os.path.join(persist_directory, SENTENCE_EMBEDDINGS_FILENAME)
+        self.index_path = os.path.join(persist_directory, SENTENCE_INDEX_FILENAME)
+        self._signature: Optional[tuple] = None
+        self._matrix: Optional[np.ndarray] = None
+        self._index: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _load(self) -> None:
+        # Reload when the index was rewritten by a new ingest
+        try:
+            stat = os.stat(self.index_path)
+            signature = (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+        except OSError:
+            signature = None
+        if signature == self._signature:
+            return
+        self._signature = signature
+        self._matrix, self._index = None, {}
+        if signature is None:
+            return
+        try:
+            with open(self.index_path, encoding="utf-8") as file:
+                self._index = json.load(file)
+            # Memory-mapped, only the rows of retrieved sentences are read from disk
+            self._matrix = np.load(self.matrix_path, mmap_mode="r")
+        except (OSError, ValueError):
+            self._matrix, self._index = None, {}
+
+    def lookup(self, sentences: list[str]) -> list[Optional[np.ndarray]]:
+        """
+        Get the stored embeddings of sentences.
+
+        Args:
+            sentences (list[str]): The sentences.
+
+        Returns:
+            list[Optional[np.ndarray]]: The normalised embedding of every sentence, None when it is not stored.
+        """
+        with self._lock:
+            self._load()
+            matrix, index = self._matrix, self._index
+        if matrix is None:
+            return [None] * len(sentences)
+        rows = [index.get(_sentence_key(sentence)) for sentence in sentences]
+        return [np.asarray(matrix[row]) if row is not None else None for row in rows]
+
+
+def compress_documents(
+    query_vector,
+    documents: list[Document],
+    budget: int,
+    count_tokens: Callable[[str], int],
+    embeddings,
+    store_of: Callable[[Document], Optional[SentenceStore]],
+) -> list[Document]:
+    """
+    Keep the sentences of the documents that are the most similar to the query, up to a token budget.
+
+    Args:
+        query_vector: The query embedding.
+        documents (list[Document]): The retrieved documents, best first.
+        budget (int): The number of tokens the kept sentences may use.
+        count_tokens (Callable[[str], int]): The token counter of the LLM.
+        embeddings: The LangChain embeddings used for sentences that are not stored.
+        store_of (Callable[[Document], Optional[SentenceStore]]): Gives the sentence store a document comes from.
+
+    Returns:
+        list[Document]: The documents reduced to their kept sentences, in their original order. Documents without
+        any kept sentence are dropped.
+    """
+    # Flatten the sentences of every document, remembering the range of each document
+    sentences: list[str] = []
+    ranges: list[range] = []
+    for doc in documents:
+        start = len(sentences)
+        sentences.extend(split_sentences(doc.page_content))
+        ranges.append(range(start, len(sentences)))
+    if not sentences:
+        return documents
+
+    # Stored embeddings first, then one batch for the sentences never seen at ingest time
+    vectors: list[Optional[np.ndarray]] = [None] * len(sentences)
+    for doc, members in zip(documents, ranges):
+        store = store_of(doc)
+        if store is None:
+            continue
+        for index, vector in zip(members, store.lookup(sentences[members.start : members.stop])):
+            vectors[index] = vector
+    missing = [index for index, vector in enumerate(vectors) if vector is None]
+    if missing:
+        for index, vector in zip(missing, embeddings.embed_documents([sentences[index] for index in missing])):
+            vectors[index] = np.asarray(vector, dtype=np.float32)
+
+    # Score every sentence in one matrix-vector product
+    query = np.asarray(query_vector, dtype=np.float32)
+    query = query / (np.linalg.norm(query) or 1.0)
+    scores = normalise_rows(np.vstack(vectors).astype(np.float32)) @ query
+
+    # Keep the best sentences that fit in the budget, counting the candidates in one batch
+    order = [int(index) for index in np.argsort(-scores) if scores[index] >= COMPRESSION_MIN_SIMILARITY]
+    kept, used = set(), 0
+    for index, tokens in zip(order, count_all([sentences[index] for index in order], count_tokens)):
+        if used + tokens > budget:
+            continue
+        kept.add(int(index))
+        used += tokens
+
+    compressed = []
+    for doc, members in zip(documents, ranges):
+        text = " ".join(sentences[index] for index in members if index in kept)
+        if text:
+            compressed.append(Document(page_content=text, metadata=doc.metadata))
+    return compressed
@@ -54,7 +54,12 @@ if not os.path.exists(PERSIST_DIRECTORY):
 
 create_persist_directories(SUB_DIRECTORIES, PERSIST_DIRECTORY)
 
-PERSIST_DIRECTORIES = [os.path.join(PERSIST_DIRECTORY, d) for d in os.listdir(PERSIST_DIRECTORY) if os.path.isdir(os.path.join(PERSIST_DIRECTORY, d))]
+# Hidden directories, e.g. the shared Chroma store, are not databases
+PERSIST_DIRECTORIES = [
+    os.path.join(PERSIST_DIRECTORY, d)
+    for d in os.listdir(PERSIST_DIRECTORY)
+    if os.path.isdir(os.path.join(PERSIST_DIRECTORY, d)) and not d.startswith(".")
+]
 
 # Create a dictionary to map directory names to their full paths
 DATABASE_MAPPING = {os.path.basename(d): d for d in PERSIST_DIRECTORIES}
@@ -79,10 +84,198 @@ MAX_NEW_TOKENS = CONTEXT_WINDOW_SIZE  # int(CONTEXT_WINDOW_SIZE/4)
 N_GPU_LAYERS = 100  # Llama-2-70B has 83 layers
 N_BATCH = 512
 
+# llama.cpp server
+# When enabled, GGUF models are served by a llama-server process decoding LLAMA_SERVER_SLOTS prompts in the same
+# batch, every slot with a context window of CONTEXT_WINDOW_SIZE tokens. Falls back to LlamaCpp when the binary is
+# not found. Off by default, GGUF models run in-process with LlamaCpp
+LLAMA_SERVER_ENABLED = False
+LLAMA_SERVER_BINARY = "llama-server"
+LLAMA_SERVER_HOST = "127.0.0.1"
+LLAMA_SERVER_PORT = 8090  # Further models get the next ports
+LLAMA_SERVER_MAX_MODELS = 8
+LLAMA_SERVER_SLOTS = 4
+LLAMA_SERVER_STARTUP_TIMEOUT_SECONDS = 300
+
+# Prompt prefix cache
+# llama.cpp states after the fixed prefix of every prompt template and after every answer are kept, and the one
+# sharing the longest prefix with a prompt is restored before it is evaluated. The least recently used states
+# spill from memory to disk
+PREFIX_CACHE_ENABLED = True
+PREFIX_CACHE_RAM_BYTES = 2 * 1024**3
+PREFIX_CACHE_DISK_BYTES = 10 * 1024**3
+PREFIX_CACHE_DIRECTORY = os.path.join(MODELS_PATH, "prefix_cache")
+
 ### From experimenting with the Llama-2-7B-Chat-GGML model on 8GB VRAM, these values work:
 # N_GPU_LAYERS = 20
 # N_BATCH = 512
 
+# Context packing
+# Retrieved chunks are merged and packed into the context window, leaving room for the generated answer
+CONTEXT_PACKING_ENABLED = True
+CONTEXT_RESERVED_GENERATION_TOKENS = 1024
+CONTEXT_MAX_TOKENS = 0  # Cap on the context tokens to cut prefill time, 0 fills the context window
+CONTEXT_MIN_OVERLAP_CHARS = 20  # Shortest common text for two chunks of a source to be merged
+
+# Context compression
+# Only the sentences of the retrieved documents most similar to the question are kept in the prompt.
+# Sentence embeddings are computed at ingest time when enabled, which makes ingestion slower.
+COMPRESSION_ENABLED = False
+COMPRESSION_MAX_TOKENS = 768
+COMPRESSION_MIN_SIMILARITY = 0.0
+SENTENCE_EMBEDDINGS_FILENAME = "sentence_embeddings.npy"
+SENTENCE_INDEX_FILENAME = "sentence_index.json"
+
+# Semantic answer cache
+# Answers are reused when a new question is at least this similar (cosine) to a cached one
+ANSWER_CACHE_ENABLED = True
+ANSWER_CACHE_SIMILARITY_THRESHOLD = 0.95
+ANSWER_CACHE_TTL_SECONDS = 24 * 60 * 60  # 0 disables expiry
+ANSWER_CACHE_MAX_ENTRIES = 512
+
+# Retrieval cache
+# Cached search results are invalidated by the generation counters that every ingest job bumps
+GENERATIONS_FILE = os.path.join(PERSIST_DIRECTORY, "generations.json")
+RETRIEVAL_CACHE_MAX_ENTRIES = 1024
+RETRIEVAL_CACHE_BUCKET_DECIMALS = 3
+QUERY_EMBEDDING_CACHE_MAX_ENTRIES = 256
+
+# Columnar chunk store
+# Chunk text and metadata are kept in compressed columnar files beside the collection when enabled, the vector
+# index then only holds ids, embeddings and the fields used by filters. Off by default, Chroma keeps the chunks;
+# collections ingested either way are read either way
+COLUMNAR_CHUNK_STORE = False
+COLUMNAR_STORE_DIRNAME = "columns"
+# Number of decompressed documents kept in memory per collection
+COLUMNAR_DOCUMENT_CACHE_SIZE = 64
+
+# Parent/child chunking
+# Small child chunks are embedded and searched, the matched ones are expanded to their parent spans,
+# which are stored once per collection in CHUNK_STORE_FILENAME. Off by default: the parent text is stored beside the
+# children, whose text the columnar chunk store also keeps, and databases take effect at their next ingest
+PARENT_CHILD_CHUNKING = False
+PARENT_CHUNK_SIZE = 2000
+CHILD_CHUNK_SIZE = 400
+CHILD_CHUNK_OVERLAP = 0
+CHUNK_STORE_FILENAME = "chunk_store.sqlite"
+
+# Retrieval search type
+# "similarity" returns the closest chunks as is, "mmr" re-ranks the MMR_FETCH_K closest chunks for diversity.
+# Prompt templates can opt in to MMR in PROMPT_RETRIEVAL_SETTINGS (prompt_templates/prompt_template_utils.py), and
+# requests with the search_type form field
+RETRIEVAL_SEARCH_TYPE = "similarity"
+MMR_FETCH_K = 20
+MMR_LAMBDA_MULT = 0.5  # 1.0 ranks by relevance only, 0.0 by diversity only
+
+# Federated retrieval
+# Number of threads searching collections concurrently when a request names several databases
+FEDERATED_SEARCH_THREADS = 8
+
+# Automatic database routing
+# Prompts without a selected database are searched in the top-m collections closest to the query when enabled,
+# otherwise they go to the LLM without RAG. Prompts asking for the "auto" databases are always routed
+ROUTING_AUTO_WHEN_UNSELECTED = False
+ROUTING_VECTORS_FILENAME = "routing_vectors.npy"
+ROUTING_SAMPLE_SIZE = 32
+ROUTING_TOP_M = 2
+ROUTING_MIN_SIMILARITY = 0.7
+
+# Index snapshots
+# Re-ingests build a new index version beside the live one, this many previous versions are kept for rollback
+SNAPSHOT_KEEP_VERSIONS = 2
+
+# ANN tuning
+# ann_tuning.py picks the HNSW parameters reaching this recall@k on held-out chunks at the lowest latency
+ANN_TARGET_RECALL = 0.95
+ANN_RECALL_K = 20
+ANN_SAMPLE_QUERIES = 200
+ANN_M_VALUES = (8, 16, 32, 48)
+ANN_EF_CONSTRUCTION_VALUES = (64, 128, 256)
+ANN_EF_SEARCH_VALUES = (10, 20, 40, 80, 160, 320)
+ANN_PARAMS_FILENAME = "ann_params.json"
+
+# Segmented collections
+# Uploads are ingested as delta segments searched beside the base collection, and the segments are compacted
+# into a new index version once there are this many deltas or tombstoned files, or the deltas hold this fraction
+# of the files. Off by default, every ingest rebuilds the database unless it asks for mode=delta
+SEGMENT_DELTA_INGEST = False
+SEGMENT_MAX_DELTAS = 8
+SEGMENT_MAX_TOMBSTONES = 64
+SEGMENT_MAX_DELTA_FRACTION = 0.2
+
+# Open collections
+# Collections are opened on first use and the least recently used ones are closed beyond these limits
+MAX_OPEN_COLLECTIONS = 8
+OPEN_COLLECTIONS_MEMORY_BUDGET_BYTES = 0  # Estimated memory of the loaded HNSW indexes, 0 disables it
+# The most used collections are opened in the background when the API starts
+PRELOAD_COLLECTIONS = 3
+COLLECTION_USAGE_FILE = os.path.join(PERSIST_DIRECTORY, "collection_usage.json")
+COLLECTION_USAGE_HALF_LIFE_SECONDS = 7 * 24 * 60 * 60
+
+# Shared Chroma store
+# Every database, version and delta is a collection of one store opened by a single client. Chroma's persistent
+# client supports a single process, and the API ingests and compacts in subprocesses, so only enable it where one
+# process uses the DB directory, after migrating the existing directories with chroma_store.py --migrate. By
+# default every index directory has a client of its own, and no two processes ever write to the same directory
+SHARED_CHROMA_CLIENT = False
+SHARED_CHROMA_DIRECTORY = os.path.join(PERSIST_DIRECTORY, ".chroma")
+
+# Request scheduler
+# Prompts wait in a bounded queue for one of SCHEDULER_CONCURRENCY generation slots, interactive prompts first.
+# Requests are rejected with a 429 and a Retry-After estimate when the queue is full or their estimated wait
+# exceeds their deadline, and give up with a 503 when they are still queued at their deadline
+SCHEDULER_CONCURRENCY = 1  # Raise only for model backends that generate several answers at once
+SCHEDULER_MAX_QUEUE = 32
+SCHEDULER_DEADLINE_SECONDS = {"interactive": 120, "batch": 900}
+# Prompt templates whose long generations are queued as batch requests
+SCHEDULER_BATCH_TEMPLATES = ("Lesson Plan", "Content Generation")
+# Batch requests waiting longer than this are served before newer interactive prompts
+SCHEDULER_MAX_BATCH_WAIT_SECONDS = 300
+# Number of latest served requests the wait time metrics are computed on
+SCHEDULER_METRICS_WINDOW = 500
+
+# Continuous batching
+# Transformers models (full, GPTQ and AWQ) generate through one decode loop shared by concurrent prompts, new
+# prompts join it as others finish. The request scheduler lets this many prompts generate at once. Off by default,
+# the models generate through the text-generation pipeline
+BATCHING_ENABLED = False
+BATCH_MAX_SIZE = 8
+# A request still waiting for its answer after this long ends with a TimeoutError and frees its row
+BATCH_REQUEST_TIMEOUT_SECONDS = 900
+# Tiny model used by `python batching.py` to measure the throughput of the engine on CPU
+BATCHING_BENCHMARK_MODEL = "sshleifer/tiny-gpt2"
+
+# Speculative decoding
+# A small draft model sharing the tokenizer of the model proposes SPECULATIVE_DRAFT_TOKENS tokens that the model
+# verifies in one forward pass. Transformers models take a transformers draft model and then generate one prompt at
+# a time instead of batching them, GGUF models take the GGUF file of a draft model. None disables it
+SPECULATIVE_DRAFT_MODEL_ID = None  # e.g. "TinyLlama/TinyLlama-1.1B-Chat-v1.0" for Llama 2 models
+SPECULATIVE_DRAFT_MODEL_BASENAME = None  # GGUF draft only, e.g. "tinyllama-1.1b-chat-v1.0.Q4_K_M.gguf"
+SPECULATIVE_DRAFT_TOKENS = 5
+# Model and draft model used by `python speculative.py` to measure the speedup on CPU
+SPECULATIVE_BENCHMARK_MODELS = ("gpt2-large", "distilgpt2")
+
+# Answer streaming
+# /api/prompt_route/stream sends a keep-alive comment when no event was produced for this many seconds
+STREAM_HEARTBEAT_SECONDS = 15
+
+# Generation limits
+# Prompt templates set their token budget, stop strings and structured answer end in PROMPT_GENERATION_SETTINGS
+# (prompt_templates/prompt_template_utils.py). Requests may set max_new_tokens up to GENERATION_MAX_NEW_TOKENS, the
+# budget of prompts without a template, and add GENERATION_MAX_STOP_STRINGS stop strings
+GENERATION_MAX_NEW_TOKENS = MAX_NEW_TOKENS
+GENERATION_MAX_STOP_STRINGS = 4
+
+# Structured output
+# The llama.cpp models decode the answers of the templates with a "grammar" in PROMPT_GENERATION_SETTINGS under that
+# grammar (structured_output.py), so a lesson plan is always valid JSON and the questions always follow the MCQ format
+STRUCTURED_OUTPUT_ENABLED = True
+
+# API startup
+# The embedding model, the LLM and the collections load in the background while the API answers /api/health and
+# /api/ready. Their load times are remembered to estimate when the API will be ready
+STARTUP_TIMINGS_FILE = os.path.join(MODELS_PATH, "startup_timings.json")
+STARTUP_DEFAULT_SECONDS = 60  # Assumed load time of a component before its first startup
+
 
 # https://python.langchain.com/en/latest/_modules/langchain/document_loaders/excel.html#UnstructuredExcelLoader
 DOCUMENT_MAP = {
@@ -249,3 +442,26 @@ MODEL_BASENAME = "capybarahermes-2.5-mistral-7b.Q5_K_M.gguf"
 
 # MODEL_ID = "TheBloke/Llama-2-7B-Chat-AWQ"
 # MODEL_BASENAME = "model.safetensors.awq"
+
+# Model registry
+# The API serves these models, chosen per request with model=<name> or per prompt template in MODEL_TEMPLATE_MAPPING.
+# Models are loaded on first use and kept resident within MODEL_MEMORY_BUDGET_BYTES, the least recently used out
+# first, and unloaded after MODEL_IDLE_TIMEOUT_SECONDS without requests. DEFAULT_MODEL is loaded at startup and
+# never unloaded. "draft_model_id" and "draft_model_basename" set the draft model of speculative decoding,
+# "memory_bytes" gives the memory a model needs before it is loaded (default is the size of its weight files)
+MODEL_REGISTRY = {
+    "default": {
+        "model_id": MODEL_ID,
+        "model_basename": MODEL_BASENAME,
+        "draft_model_id": SPECULATIVE_DRAFT_MODEL_ID,
+        "draft_model_basename": SPECULATIVE_DRAFT_MODEL_BASENAME,
+    },
+    # "small": {
+    #     "model_id": "TheBloke/Mistral-7B-Instruct-v0.1-GGUF",
+    #     "model_basename": "mistral-7b-instruct-v0.1.Q4_K_M.gguf",
+    # },
+}
+DEFAULT_MODEL = "default"
+MODEL_TEMPLATE_MAPPING = {}  # e.g. {"Lesson Plan": "large"}
+MODEL_MEMORY_BUDGET_BYTES = 24 * 1024**3  # 0 disables it
+MODEL_IDLE_TIMEOUT_SECONDS = 30 * 60  # 0 keeps idle models loaded
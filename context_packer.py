@@ -0,0 +1,177 @@
+"""
+This module assembles the context of the "stuff" chain within the context window of the LLM.
+
+The retrieved chunks used to be concatenated as is, so long system prompts such as LESSON_PLAN_PROMPT could
+overflow the llama.cpp context, while overlapping chunks of the same page spent prefill time on repeated text.
+The packer merges chunks of the same source that overlap, drops duplicated text, and keeps the best ranked
+chunks that fit in the token budget left once the prompt and the generation are accounted for.
+
+Functions:
+- make_token_counter(llm): Counts tokens with the tokenizer of the loaded LLM.
+- count_all(texts, count_tokens): Counts the tokens of several texts, in one batch when the counter supports it.
+- merge_overlapping(documents): Merges overlapping chunks of the same source and drops duplicates.
+- context_budget(prompt, question, count_tokens): Computes the number of tokens left for the context.
+- pack_context(documents, budget, count_tokens): Keeps the best ranked documents fitting in the budget.
+"""
+
+import logging
+from typing import Callable
+
+from langchain.docstore.document import Document
+from langchain.prompts import PromptTemplate
+
+from constants import (
+    CONTEXT_MAX_TOKENS,
+    CONTEXT_MIN_OVERLAP_CHARS,
+    CONTEXT_RESERVED_GENERATION_TOKENS,
+    CONTEXT_WINDOW_SIZE,
+)
+
+# Separator the "stuff" chain puts between documents
+DOCUMENT_SEPARATOR = "\n\n"
+
+
+def make_token_counter(llm) -> Callable[[str], int]:
+    """
+    Count tokens with the tokenizer of the loaded LLM.
+
+    Args:
+        llm: The LangChain LLM, a LlamaCpp model, a StreamingPipelineLLM or a BatchedHuggingFaceLLM.
+
+    Returns:
+        Callable[[str], int]: Function giving the number of tokens of a text.
+    """
+    # LangChain LLMs fall back to a GPT-2 tokenizer in get_num_tokens, use the tokenizer of the pipeline
+    pipeline = getattr(llm, "pipeline", None)
+    if pipeline is not None and getattr(pipeline, "tokenizer", None) is not None:
+        tokenizer = pipeline.tokenizer
+        return lambda text: len(tokenizer.encode(text, add_special_tokens=False))
+    # The llama.cpp server counts a batch of texts at once
+    count_tokens = getattr(llm, "count_tokens", None)
+    if count_tokens is not None:
+
+        def counter(text: str) -> int:
+            return count_tokens([text])[0]
+
+        counter.many = count_tokens
+        return counter
+    # LlamaCpp counts with the llama.cpp tokenizer of the GGUF model, the batching engine with the model's own
+    return llm.get_num_tokens
+
+
+def count_all(texts: list[str], count_tokens: Callable[[str], int]) -> list[int]:
+    """
+    Count the tokens of several texts.
+
+    Args:
+        texts (list[str]): The texts.
+        count_tokens (Callable[[str], int]): The token counter of the LLM, counting a batch at once when it has a
+            "many" attribute.
+
+    Returns:
+        list[int]: The number of tokens of every text.
+    """
+    many = getattr(count_tokens, "many", None)
+    if many is not None and texts:
+        return many(texts)
+    return [count_tokens(text) for text in texts]
+
+
+def _overlap(left: str, right: str) -> int:
+    # Longest suffix of left that is a prefix of right, as produced by the text splitter's chunk overlap.
+    # Only the places where the start of right occurs in left are checked.
+    if len(right) < CONTEXT_MIN_OVERLAP_CHARS:
+        return 0
+    probe = right[:CONTEXT_MIN_OVERLAP_CHARS]
+    start = left.find(probe)
+    while start != -1:
+        if right.startswith(left[start:]):
+            return len(left) - start
+        start = left.find(probe, start + 1)
+    return 0
+
+
+def merge_overlapping(documents: list[Document]) -> list[Document]:
+    """
+    Merge overlapping chunks of the same source and drop duplicated text.
+
+    Args:
+        documents (list[Document]): The retrieved documents, best first.
+
+    Returns:
+        list[Document]: The merged documents, ranked by their best chunk.
+    """
+    merged: list[Document] = []
+    for doc in documents:
+        text = doc.page_content
+        source = (doc.metadata.get("database"), doc.metadata.get("source"))
+        for index, kept in enumerate(merged):
+            # Drop a chunk whose text is already part of the context
+            if text in kept.page_content:
+                break
+            if (kept.metadata.get("database"), kept.metadata.get("source")) != source:
+                continue
+            if kept.page_content in text:
+                merged[index] = Document(page_content=text, metadata=kept.metadata)
+                break
+            # Join neighbouring chunks through their common overlap, in either order
+            size = _overlap(kept.page_content, text)
+            if size:
+                merged[index] = Document(page_content=kept.page_content + text[size:], metadata=kept.metadata)
+                break
+            size = _overlap(text, kept.page_content)
+            if size:
+                merged[index] = Document(page_content=text + kept.page_content[size:], metadata=kept.metadata)
+                break
+        else:
+            merged.append(doc)
+    return merged
+
+
+def context_budget(prompt: PromptTemplate, question: str, count_tokens: Callable[[str], int]) -> int:
+    """
+    Compute the number of tokens left for the context in the context window.
+
+    Args:
+        prompt (PromptTemplate): The prompt of the "stuff" chain, with "context" and "question" variables.
+        question (str): The question the prompt is filled with.
+        count_tokens (Callable[[str], int]): The token counter of the LLM.
+
+    Returns:
+        int: The number of context tokens, never negative.
+    """
+    prompt_tokens = count_tokens(prompt.format(context="", question=question))
+    budget = CONTEXT_WINDOW_SIZE - CONTEXT_RESERVED_GENERATION_TOKENS - prompt_tokens
+    # Prefill time grows with every prompt token, an explicit cap trades context for latency
+    if CONTEXT_MAX_TOKENS:
+        budget = min(budget, CONTEXT_MAX_TOKENS)
+    return max(budget, 0)
+
+
+def pack_context(documents: list[Document], budget: int, count_tokens: Callable[[str], int]) -> list[Document]:
+    """
+    Keep the best ranked documents that fit in the token budget, after merging overlaps and duplicates.
+
+    Args:
+        documents (list[Document]): The retrieved documents, best first.
+        budget (int): The number of tokens available for the context.
+        count_tokens (Callable[[str], int]): The token counter of the LLM.
+
+    Returns:
+        list[Document]: The documents to stuff in the prompt, best first.
+    """
+    merged = merge_overlapping(documents)
+    # Count every document in one batch, a remote tokenizer is called once rather than once per document
+    texts = [DOCUMENT_SEPARATOR] + [doc.page_content for doc in merged]
+    separator_tokens, *document_tokens = count_all(texts, count_tokens)
+    packed, used = [], 0
+    for doc, tokens in zip(merged, document_tokens):
+        tokens += separator_tokens if packed else 0
+        # Skip a document that does not fit, a smaller lower ranked one may still fit
+        if used + tokens > budget:
+            continue
+        packed.append(doc)
+        used += tokens
+
+    logging.info(f"Packed {len(packed)} of {len(documents)} documents in {used}/{budget} context tokens")
+    return packed
@@ -35,10 +35,14 @@ def main():
 
     # Extract the answer from the command-line arguments
     answer = sys.argv[1]
-    # Clean the JSON string
-    cleaned_json_string = clean_json_string(answer)
-    # Load the cleaned JSON string
-    data = json.loads(cleaned_json_string)
+    try:
+        # Answers decoded under the lesson plan grammar are valid JSON as they are
+        data = json.loads(answer)
+    except json.JSONDecodeError:
+        # Clean the JSON string
+        cleaned_json_string = clean_json_string(answer)
+        # Load the cleaned JSON string
+        data = json.loads(cleaned_json_string)
 
     # Get all the information from the JSON file
     extractor = LessonPlanExtractor(data)
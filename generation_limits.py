@@ -0,0 +1,253 @@
+"""
+This module implements the generation budgets and stop conditions of the prompt templates.
+
+Every request used to generate up to MAX_NEW_TOKENS, the whole context window, so a short answer or a set of
+multiple choice questions could run on long after its useful part and the model kept decoding tokens the output
+scripts threw away. Every prompt template now has a profile in PROMPT_GENERATION_SETTINGS: its maximum number of new
+tokens, its stop strings, and the structured answer after which generation stops, e.g. once the top-level JSON
+object of a lesson plan is closed. A request can lower or raise the budget within GENERATION_MAX_NEW_TOKENS and add
+stop strings.
+
+The limits are enforced by a LangChain callback handler watching the streamed tokens, so they apply to every
+streaming model and to the chains alike: the handler ends the generation by raising GenerationComplete with the
+answer up to the limit, which stops the decode loop or closes the request of the llama.cpp server at once. The
+transformers pipeline does not stream its tokens to the callbacks, so StreamingPipelineLLM passes them on from a
+stopping criterion of its generation.
+
+Functions:
+- generation_profile(template, max_new_tokens, stop): The generation profile of a request.
+- generate_within_limits(generate, profile, callbacks): Runs a generation under the limits of a profile.
+
+Classes:
+- GenerationLimits: LangChain callback handler ending a generation at its limits.
+- StreamingPipelineLLM: LangChain LLM generating with a transformers pipeline, streaming its tokens to the callbacks.
+- GenerationComplete: Raised in the generation thread when the answer is complete.
+"""
+
+import re
+from typing import Any, Callable, List, Optional
+
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.callbacks.manager import CallbackManagerForLLMRun
+from langchain.llms.base import LLM
+from langchain.llms.utils import enforce_stop_tokens
+
+from constants import GENERATION_MAX_NEW_TOKENS, GENERATION_MAX_STOP_STRINGS, MAX_NEW_TOKENS, STRUCTURED_OUTPUT_ENABLED
+from prompt_templates.prompt_template_utils import PROMPT_GENERATION_SETTINGS
+
+# The feedback on the four options of a question closes it
+_MCQ_QUESTION_END = re.compile(r"### Feedback for Question[^\n]*\n(?:\s*- [a-d]\.[^\n]*\n){4}")
+
+
+class GenerationComplete(Exception):
+    def __init__(self, text: str):
+        """
+        Initializes the end of a generation.
+
+        Args:
+            text (str): The answer up to the limit that ended it.
+        """
+        super().__init__("The answer is complete")
+        self.text = text
+
+
+class _JsonObjectEnd:
+    # Follows the braces of the first JSON object in the text as it grows, strings excepted
+    def __init__(self):
+        self.position = 0
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def __call__(self, text: str) -> Optional[int]:
+        for index in range(self.position, len(text)):
+            character = text[index]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif character == "\\":
+                    self.escaped = True
+                elif character == '"':
+                    self.in_string = False
+            elif character == '"' and self.depth:
+                self.in_string = True
+            elif character == "{":
+                self.depth += 1
+            elif character == "}" and self.depth:
+                self.depth -= 1
+                if not self.depth:
+                    return index + 1
+        self.position = len(text)
+        return None
+
+
+class _MultipleChoiceEnd:
+    # The answer ends once every question of the template has the feedback of its four options
+    def __init__(self, questions: int = 3):
+        self.questions = questions
+
+    def __call__(self, text: str) -> Optional[int]:
+        matches = list(_MCQ_QUESTION_END.finditer(text))
+        if len(matches) < self.questions:
+            return None
+        return matches[self.questions - 1].end()
+
+
+# Structured answers a profile can complete on, by name
+_COMPLETIONS: dict[str, Callable[[], Callable[[str], Optional[int]]]] = {
+    "json": _JsonObjectEnd,
+    "mcq": _MultipleChoiceEnd,
+}
+
+
+def generation_profile(template: str, max_new_tokens: Optional[int] = None, stop: Optional[list[str]] = None) -> dict:
+    """
+    Get the generation profile of a request from its prompt template and its overrides.
+
+    Args:
+        template (str): The selected prompt template.
+        max_new_tokens (Optional[int]): Tokens the request may generate (default is the template's).
+        stop (Optional[list[str]]): Stop strings added to the template's.
+
+    Returns:
+        dict: The max_new_tokens, stop strings, completion and grammar of the request.
+
+    Raises:
+        ValueError: If the overrides are outside GENERATION_MAX_NEW_TOKENS and GENERATION_MAX_STOP_STRINGS.
+    """
+    settings: dict = PROMPT_GENERATION_SETTINGS.get(template, {})
+    if max_new_tokens is not None and not 0 < max_new_tokens <= GENERATION_MAX_NEW_TOKENS:
+        raise ValueError(f"max_new_tokens must be between 1 and {GENERATION_MAX_NEW_TOKENS}")
+    stop = [text for text in stop or [] if text]
+    if len(stop) > GENERATION_MAX_STOP_STRINGS:
+        raise ValueError(f"At most {GENERATION_MAX_STOP_STRINGS} stop strings can be given")
+    return {
+        "max_new_tokens": max_new_tokens or settings.get("max_new_tokens", GENERATION_MAX_NEW_TOKENS),
+        "stop": list(dict.fromkeys(settings.get("stop", []) + stop)),
+        "complete_on": settings.get("complete_on"),
+        "grammar": settings.get("grammar") if STRUCTURED_OUTPUT_ENABLED else None,
+    }
+
+
+class GenerationLimits(BaseCallbackHandler):
+    # Errors raised here must stop the chain, LangChain only logs them otherwise
+    raise_error: bool = True
+
+    def __init__(self, max_new_tokens: int, stop: Optional[list[str]] = None, complete_on: Optional[str] = None):
+        """
+        Initializes the limits of one generation.
+
+        Args:
+            max_new_tokens (int): Number of tokens after which the generation ends.
+            stop (Optional[list[str]]): The generation ends before the first of these strings.
+            complete_on (Optional[str]): The structured answer after which the generation ends, "json" or "mcq".
+        """
+        self.max_new_tokens = max_new_tokens
+        self.stop = stop or []
+        self.complete_on = complete_on
+        self.on_llm_start()
+
+    def on_llm_start(self, *args: Any, **kwargs: Any) -> None:
+        self.text = ""
+        self.tokens = 0
+        self._completion = _COMPLETIONS[self.complete_on]() if self.complete_on else None
+
+    def _end(self, token: str) -> Optional[int]:
+        # Position where the answer ends, None while it goes on
+        ends = []
+        # Only the end of the text can hold a stop string that was not there before
+        start = max(0, len(self.text) - len(token) - max((len(stop) for stop in self.stop), default=0))
+        for stop in self.stop:
+            index = self.text.find(stop, start)
+            if index >= 0:
+                ends.append(index)
+        if self._completion is not None:
+            end = self._completion(self.text)
+            if end is not None:
+                ends.append(end)
+        if self.tokens >= self.max_new_tokens:
+            ends.append(len(self.text))
+        return min(ends) if ends else None
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        self.text += token
+        self.tokens += 1
+        end = self._end(token)
+        if end is not None:
+            raise GenerationComplete(self.text[:end])
+
+
+def generate_within_limits(generate: Callable[[list], Any], profile: dict, callbacks: Optional[list] = None):
+    """
+    Run a generation under the limits of a generation profile.
+
+    Args:
+        generate (Callable[[list], Any]): Runs the LLM or chain with the callback handlers it is given.
+        profile (dict): The generation profile, from generation_profile.
+        callbacks (Optional[list]): Further callback handlers, e.g. a TokenStream. They do not see the tokens
+            after the limit.
+
+    Returns:
+        The result of the generation, or the answer up to the limit (a str) when a limit ended it.
+    """
+    limits = GenerationLimits(profile["max_new_tokens"], profile["stop"], profile["complete_on"])
+    try:
+        return generate([limits] + list(callbacks or []))
+    except GenerationComplete as e:
+        return e.text
+
+
+class _TokenCallback:
+    # Stopping criterion of a transformers generation passing the text of every new token to a callback, which ends
+    # the generation by raising
+    def __init__(self, tokenizer, on_token: Callable[[str], None]):
+        self.tokenizer = tokenizer
+        self.on_token = on_token
+        self.prompt_length: Optional[int] = None
+        self.text = ""
+
+    def __call__(self, input_ids, scores, **kwargs: Any) -> bool:
+        # The first call sees the prompt and the first generated token
+        if self.prompt_length is None:
+            self.prompt_length = input_ids.shape[-1] - 1
+        text = self.tokenizer.decode(input_ids[0, self.prompt_length :], skip_special_tokens=True)
+        # Wait for the rest of a character split over several tokens
+        if not text.endswith("\ufffd") and len(text) > len(self.text):
+            new_text, self.text = text[len(self.text) :], text
+            self.on_token(new_text)
+        return False
+
+
+class StreamingPipelineLLM(LLM):
+    # The transformers text-generation pipeline
+    pipeline: Any
+    max_new_tokens: int = MAX_NEW_TOKENS
+
+    @property
+    def _llm_type(self) -> str:
+        return "huggingface_pipeline"
+
+    def _call(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        from transformers import StoppingCriteriaList
+
+        # Tokens reach the callback handlers as they are generated, e.g. the generation limits and a TokenStream
+        criteria = StoppingCriteriaList(
+            [_TokenCallback(self.pipeline.tokenizer, run_manager.on_llm_new_token)] if run_manager else []
+        )
+        response = self.pipeline(
+            prompt,
+            max_new_tokens=kwargs.get("max_new_tokens", self.max_new_tokens),
+            stopping_criteria=criteria,
+            return_full_text=False,
+        )
+        text: str = response[0]["generated_text"]
+        return enforce_stop_tokens(text, stop) if stop else text
+
+    def get_num_tokens(self, text: str) -> int:
+        return len(self.pipeline.tokenizer.encode(text, add_special_tokens=False))
@@ -6,7 +6,8 @@ Functions:
 - file_log(logentry): Logs ingestion details to a file.
 - load_single_document(file_path: str) -> Document: Loads a single document based on its file path and type.
 - load_document_batch(filepaths): Loads a batch of documents concurrently using a thread pool.
-- load_documents(source_dir: str) -> list[Document]: Recursively loads all documents from a specified source directory.
+- load_documents(source_dir: str, only: Optional[set[str]]) -> list[Document]: Recursively loads all documents from a
+  specified source directory, or only the given files.
 - split_documents(documents: list[Document]) -> tuple[list[Document], list[Document]]: Splits documents into text and 
   Python documents for appropriate processing.
 
@@ -14,6 +15,7 @@ Command-line Options:
 - --device_type: Specifies the device to use for processing (default is 'cuda' if available).
 - --select_directory: Specifies the source directory for document ingestion (default is SOURCE_DIRECTORY).
 - --db_directory: Specifies the directory to store the database (default is PERSIST_DIRECTORY).
+- --delta: Only ingests the files added or changed since the last ingest into a new delta segment of the database.
 
 Workflow:
 1. Loads documents from the specified source directory.
@@ -25,6 +27,7 @@ Workflow:
 import logging
 import os
 from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import Optional
 
 import click
 import torch
@@ -32,12 +35,27 @@ from langchain.docstore.document import Document
 from langchain.text_splitter import Language, RecursiveCharacterTextSplitter
 from langchain.vectorstores import Chroma
 from utils import get_embeddings
+from retrieval import CollectionGenerations
+from routing import write_routing_vectors
+from metadata_filters import add_filter_metadata
+from chunk_store import ChunkStore, split_parent_child
+from snapshots import collection_name
+from compression import write_sentence_embeddings
+from ann_tuning import load_ann_params, save_ann_params
+from columnar_store import index_documents
+from chroma_store import open_store
+from segments import DELTAS_DIRNAME, load_manifest, new_manifest, plan_delta, scan_files, write_manifest
 
 from constants import (
-    CHROMA_SETTINGS,
+    CHILD_CHUNK_OVERLAP,
+    CHILD_CHUNK_SIZE,
+    COLUMNAR_CHUNK_STORE,
+    COMPRESSION_ENABLED,
     DOCUMENT_MAP,
     EMBEDDING_MODEL_NAME,
     INGEST_THREADS,
+    PARENT_CHILD_CHUNKING,
+    PARENT_CHUNK_SIZE,
     PERSIST_DIRECTORY,
     SOURCE_DIRECTORY,
 )
@@ -83,14 +101,16 @@ def load_document_batch(filepaths):
             return (data_list, filepaths)
 
 
-def load_documents(source_dir: str) -> list[Document]:
-    # Loads all documents from the source documents directory, including nested folders
+def load_documents(source_dir: str, only: Optional[set[str]] = None) -> list[Document]:
+    # Loads all documents from the source documents directory, including nested folders, or only the given files
     paths = []
     for root, _, files in os.walk(source_dir):
         for file_name in files:
-            print("Importing: " + file_name)
             file_extension = os.path.splitext(file_name)[1]
             source_file_path = os.path.join(root, file_name)
+            if only is not None and source_file_path not in only:
+                continue
+            print("Importing: " + file_name)
             if file_extension in DOCUMENT_MAP.keys():
                 paths.append(source_file_path)
 
@@ -176,17 +196,46 @@ def split_documents(documents: list[Document]) -> tuple[list[Document], list[Doc
     default=PERSIST_DIRECTORY,
     help="Input file path if db directory is different",
 )
+@click.option(
+    "--delta",
+    is_flag=True,
+    help="Only ingest the files changed since the last ingest into a delta segment of db_directory",
+)
+def main(device_type, select_directory, db_directory, delta):
+    if delta:
+        ingest_delta(device_type, select_directory, db_directory)
+        return
 
-def main(device_type, select_directory, db_directory):
     # Load documents and split in chunks
     logging.info(f"Loading documents from {select_directory}")
+    files = scan_files(select_directory)
     documents = load_documents(select_directory)
+    build_segment(documents, select_directory, get_embeddings(device_type), db_directory)
+
+    # Record the ingested files, later uploads are ingested as delta segments
+    write_manifest(db_directory, new_manifest(files))
+
+    # Invalidate the cached search results of the rewritten collection
+    CollectionGenerations().bump(collection_name(db_directory))
+
+
+def build_segment(documents: list[Document], select_directory: str, embeddings, db_directory: str) -> Chroma:
+    # Split the documents in chunks and write the collection, its chunk store, sentences and routing vectors
+    # Record the file name, type, sub-folder and ingest time used by search filters
+    add_filter_metadata(documents, select_directory)
     text_documents, python_documents = split_documents(documents)
     text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
     python_splitter = RecursiveCharacterTextSplitter.from_language(
         language=Language.PYTHON, chunk_size=880, chunk_overlap=200
     )
-    texts = text_splitter.split_documents(text_documents)
+    parents = []
+    if PARENT_CHILD_CHUNKING:
+        # Embed small children of non-overlapping parent spans, the parents go to the chunk store
+        parent_splitter = RecursiveCharacterTextSplitter(chunk_size=PARENT_CHUNK_SIZE, chunk_overlap=0)
+        child_splitter = RecursiveCharacterTextSplitter(chunk_size=CHILD_CHUNK_SIZE, chunk_overlap=CHILD_CHUNK_OVERLAP)
+        parents, texts = split_parent_child(text_documents, parent_splitter, child_splitter)
+    else:
+        texts = text_splitter.split_documents(text_documents)
     texts.extend(python_splitter.split_documents(python_documents))
     logging.info(f"Loaded {len(documents)} documents from {select_directory}")
     logging.info(f"Split into {len(texts)} chunks of text")
@@ -198,16 +247,61 @@ def main(device_type, select_directory, db_directory):
     their respective huggingface repository, project page or github repository.
     """
 
-    embeddings = get_embeddings(device_type)
-
     logging.info(f"Loaded embeddings from {EMBEDDING_MODEL_NAME}")
 
-    db = Chroma.from_documents(
-        texts,
-        embeddings,
-        persist_directory=db_directory,
-        client_settings=CHROMA_SETTINGS,
-    )
+    # The collection of the directory in the shared Chroma store
+    ann_params = load_ann_params(db_directory)
+    db = open_store(db_directory, embeddings, ann_params)
+    save_ann_params(db_directory, ann_params)
+    if COLUMNAR_CHUNK_STORE:
+        # Keep the chunk text and metadata in the columnar store, the collection only holds ids and vectors
+        index_documents(db, texts, documents, embeddings, db_directory)
+    else:
+        db.add_documents(texts)
+
+    # Store the parent spans the searched children expand to
+    if parents:
+        ChunkStore(db_directory).write(parents)
+
+    # Embed the sentences of the text that reaches the prompt, for context compression
+    if COMPRESSION_ENABLED:
+        write_sentence_embeddings(parents or texts, embeddings, db_directory)
+
+    # Store the representative vectors used to route prompts to this collection
+    write_routing_vectors(db, db_directory)
+    return db
+
+
+def ingest_delta(device_type: str, select_directory: str, db_directory: str) -> None:
+    # Ingest the files added or changed since the last ingest into a new delta segment of the live version
+    manifest = load_manifest(db_directory)
+    if manifest is None:
+        raise click.UsageError(f"{db_directory} has no segments manifest, run a full ingest first")
+    changed, tombstones, files = plan_delta(select_directory, manifest)
+    if not changed and not tombstones:
+        logging.info(f"No changed files in {select_directory}")
+        return
+
+    seq, changed = manifest["next_seq"], set(changed)
+    if changed:
+        name = f"d{seq}"
+        segment_dir = os.path.join(db_directory, DELTAS_DIRNAME, name)
+        documents = load_documents(select_directory, only=changed)
+        build_segment(documents, select_directory, get_embeddings(device_type), segment_dir)
+        manifest["deltas"].append({"name": name, "seq": seq})
+        logging.info(f"Ingested {len(changed)} changed files into delta segment {name}")
+
+    # Hide the older chunks of changed and removed files, then publish the new segment list
+    manifest["tombstones"].update({source: seq for source in tombstones})
+    manifest["files"] = {
+        source: {**stat, "seq": seq if source in changed else manifest["files"][source]["seq"]}
+        for source, stat in files.items()
+    }
+    manifest["next_seq"] = seq + 1
+    write_manifest(db_directory, manifest)
+
+    # Invalidate the cached search results of the changed collection
+    CollectionGenerations().bump(collection_name(db_directory))
 
 
 if __name__ == "__main__":
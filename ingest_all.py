@@ -28,18 +28,31 @@ import click
 import torch
 from langchain.docstore.document import Document
 from langchain.text_splitter import Language, RecursiveCharacterTextSplitter
-from langchain.vectorstores import Chroma
 from utils import get_embeddings
+from retrieval import CollectionGenerations
+from routing import write_routing_vectors
+from metadata_filters import add_filter_metadata
+from chunk_store import ChunkStore, split_parent_child
+from snapshots import SnapshotManager, collection_name, new_version_dir, publish
+from compression import write_sentence_embeddings
+from ann_tuning import load_ann_params, save_ann_params
+from columnar_store import index_documents
+from chroma_store import open_store
+from segments import new_manifest, scan_files, write_manifest
 
 from constants import (
-    CHROMA_SETTINGS,
+    CHILD_CHUNK_OVERLAP,
+    CHILD_CHUNK_SIZE,
+    COLUMNAR_CHUNK_STORE,
+    COMPRESSION_ENABLED,
     DOCUMENT_MAP,
     EMBEDDING_MODEL_NAME,
     INGEST_THREADS,
-    # PERSIST_DIRECTORY,
+    PARENT_CHILD_CHUNKING,
+    PARENT_CHUNK_SIZE,
+    PERSIST_DIRECTORY,
     # SOURCE_DIRECTORY,
     SUB_DIRECTORIES,
-    PERSIST_DIRECTORIES,
 )
 
 
@@ -168,17 +181,31 @@ def split_documents(documents: list[Document]) -> tuple[list[Document], list[Doc
 )
 def main(device_type):
     
-    for dir_index, directories in enumerate(SUB_DIRECTORIES):
+    for directories in SUB_DIRECTORIES:
+        # The database of a source folder has the name of the folder
+        database_directory = os.path.join(PERSIST_DIRECTORY, os.path.basename(directories))
 
         # Load documents and split in chunks
         logging.info(f"Loading documents from {directories}")
+        files = scan_files(directories)
         documents = load_documents(directories)
+        # Record the file name, type, sub-folder and ingest time used by search filters
+        add_filter_metadata(documents, directories)
         text_documents, python_documents = split_documents(documents)
         text_splitter = RecursiveCharacterTextSplitter(chunk_size=1500, chunk_overlap=100)
         python_splitter = RecursiveCharacterTextSplitter.from_language(
             language=Language.PYTHON, chunk_size=1450, chunk_overlap=100
         )
-        texts = text_splitter.split_documents(text_documents)
+        parents = []
+        if PARENT_CHILD_CHUNKING:
+            # Embed small children of non-overlapping parent spans, the parents go to the chunk store
+            parent_splitter = RecursiveCharacterTextSplitter(chunk_size=PARENT_CHUNK_SIZE, chunk_overlap=0)
+            child_splitter = RecursiveCharacterTextSplitter(
+                chunk_size=CHILD_CHUNK_SIZE, chunk_overlap=CHILD_CHUNK_OVERLAP
+            )
+            parents, texts = split_parent_child(text_documents, parent_splitter, child_splitter)
+        else:
+            texts = text_splitter.split_documents(text_documents)
         texts.extend(python_splitter.split_documents(python_documents))
         logging.info(f"Loaded {len(documents)} documents from {directories}")
         logging.info(f"Split into {len(texts)} chunks of text")
@@ -194,12 +221,39 @@ def main(device_type):
 
         logging.info(f"Loaded embeddings from {EMBEDDING_MODEL_NAME}")
 
-        db = Chroma.from_documents(
-            texts,
-            embeddings,
-            persist_directory=PERSIST_DIRECTORIES[dir_index],
-            client_settings=CHROMA_SETTINGS,
-    )
+        # Build a new index version, the live one keeps serving the API until it is published
+        version_directory = new_version_dir(database_directory)
+
+        # The collection of the directory in the shared Chroma store
+        ann_params = load_ann_params(version_directory)
+        db = open_store(version_directory, embeddings, ann_params)
+        save_ann_params(version_directory, ann_params)
+        if COLUMNAR_CHUNK_STORE:
+            # Keep the chunk text and metadata in the columnar store, the collection only holds ids and vectors
+            index_documents(db, texts, documents, embeddings, version_directory)
+        else:
+            db.add_documents(texts)
+
+        # Store the parent spans the searched children expand to
+        if parents:
+            ChunkStore(version_directory).write(parents)
+
+        # Embed the sentences of the text that reaches the prompt, for context compression
+        if COMPRESSION_ENABLED:
+            write_sentence_embeddings(parents or texts, embeddings, version_directory)
+
+        # Store the representative vectors used to route prompts to this collection
+        write_routing_vectors(db, version_directory)
+
+        # Record the ingested files, later uploads are ingested as delta segments
+        write_manifest(version_directory, new_manifest(files))
+
+        # Make the new version live, delete the versions no longer kept for rollback
+        publish(database_directory, version_directory)
+        SnapshotManager().collect(collection_name(version_directory))
+
+        # Invalidate the cached search results of the rewritten collection
+        CollectionGenerations().bump(collection_name(version_directory))
 
 
 if __name__ == "__main__":
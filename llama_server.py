@@ -0,0 +1,330 @@
+"""
+This module serves GGUF models through a llama.cpp server with parallel decoding slots.
+
+A LlamaCpp instance holds one context and decodes one sequence at a time, so concurrent prompts wait for each
+other while most of the memory bandwidth spent reading the weights for every token is wasted. llama-server loads
+the model once, splits its context into slots, and decodes the current token of every busy slot in one batch, so
+the weights are read once per step for all the concurrent prompts. Every request carries its own sampling
+parameters, keeps the prompt cached in its slot for the next request sharing its prefix, and is cancelled when
+its connection is closed, e.g. when the client of a stream went away.
+
+With a draft model the server decodes speculatively, the draft proposing tokens that the model verifies in one
+batch, and the accepted share of the draft tokens is recorded from the timings of every response.
+
+The server of a model is started once per host: processes finding a healthy server of the same model file use it,
+and different models get servers on consecutive ports.
+
+Tokens are counted with the vocabulary of the GGUF file, loaded without its weights by llama-cpp-python, so that
+packing the context of a prompt does not cost a request to the server per chunk. Without llama-cpp-python the
+texts are sent to the server's /tokenize endpoint concurrently, over one connection pool.
+
+Functions:
+- load_llama_server_llm(model_path, n_gpu_layers, callback_manager, draft_model_path): Starts the server, or reuses
+  a running one, and returns its LLM.
+
+Classes:
+- LlamaServer: The llama-server process.
+- LlamaServerLLM: LangChain LLM generating with a llama.cpp server.
+"""
+
+import atexit
+import json
+import logging
+import os
+import shutil
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import requests
+from langchain.callbacks.manager import CallbackManagerForLLMRun
+from langchain.llms.base import LLM
+
+from constants import (
+    CONTEXT_WINDOW_SIZE,
+    LLAMA_SERVER_BINARY,
+    LLAMA_SERVER_HOST,
+    LLAMA_SERVER_MAX_MODELS,
+    LLAMA_SERVER_PORT,
+    LLAMA_SERVER_SLOTS,
+    LLAMA_SERVER_STARTUP_TIMEOUT_SECONDS,
+    MAX_NEW_TOKENS,
+    N_BATCH,
+    SPECULATIVE_DRAFT_TOKENS,
+)
+from speculative import SpeculationStats
+from utils import info, warning
+
+# Sampling parameters a request may set, with the names of the llama.cpp server
+SAMPLING_PARAMETERS = ("temperature", "top_p", "top_k", "repeat_penalty", "seed", "grammar", "n_probs")
+
+
+class LlamaServer:
+    def __init__(
+        self,
+        model_path: str,
+        slots: int = LLAMA_SERVER_SLOTS,
+        n_gpu_layers: int = 0,
+        host: str = LLAMA_SERVER_HOST,
+        port: int = LLAMA_SERVER_PORT,
+        draft_model_path: Optional[str] = None,
+    ):
+        """
+        Initializes the server of a model, started by start().
+
+        Args:
+            model_path (str): The GGUF file.
+            slots (int): Number of sequences decoded in parallel.
+            n_gpu_layers (int): Number of layers offloaded to the GPU.
+            host (str): The address the server listens on.
+            port (int): The port the server listens on.
+            draft_model_path (Optional[str]): The GGUF file of a draft model sharing the vocabulary of the model, to
+                decode speculatively.
+        """
+        self.model_path = model_path
+        self.draft_model_path = draft_model_path
+        self.slots = slots
+        self.n_gpu_layers = n_gpu_layers
+        self.base_url = f"http://{host}:{port}"
+        self.host, self.port = host, port
+        self.process: Optional[subprocess.Popen] = None
+
+    def healthy(self) -> bool:
+        """
+        Check whether the server has loaded its model and accepts requests.
+
+        Returns:
+            bool: True when the server is ready.
+        """
+        try:
+            return requests.get(f"{self.base_url}/health", timeout=2).status_code == 200
+        except requests.RequestException:
+            return False
+
+    def start(self) -> None:
+        """
+        Start the server and wait until its model is loaded, unless a server already runs on the port.
+
+        Raises:
+            RuntimeError: If the server exits or is not ready within LLAMA_SERVER_STARTUP_TIMEOUT_SECONDS.
+        """
+        if self.healthy():
+            info(message=f"Using the llama.cpp server running at {self.base_url}")
+            return
+        command = [
+            LLAMA_SERVER_BINARY,
+            "--model", self.model_path,
+            # Every slot gets a full context window
+            "--ctx-size", str(CONTEXT_WINDOW_SIZE * self.slots),
+            "--parallel", str(self.slots),
+            "--cont-batching",
+            "--batch-size", str(N_BATCH),
+            "--n-gpu-layers", str(self.n_gpu_layers),
+            "--host", self.host,
+            "--port", str(self.port),
+        ]
+        if self.draft_model_path:
+            command += [
+                "--model-draft", self.draft_model_path,
+                "--draft-max", str(SPECULATIVE_DRAFT_TOKENS),
+                "--n-gpu-layers-draft", str(self.n_gpu_layers),
+            ]
+        logging.info(f"Starting llama.cpp server: {' '.join(command)}")
+        self.process = subprocess.Popen(command)
+        atexit.register(self.stop)
+
+        deadline = time.monotonic() + LLAMA_SERVER_STARTUP_TIMEOUT_SECONDS
+        while not self.healthy():
+            if self.process.poll() is not None:
+                raise RuntimeError(f"llama.cpp server exited with code {self.process.returncode}")
+            if time.monotonic() > deadline:
+                self.stop()
+                raise RuntimeError("llama.cpp server did not load the model in time")
+            time.sleep(1)
+        info(message=f"llama.cpp server ready at {self.base_url} with {self.slots} slots")
+
+    def serves(self, model_path: str) -> bool:
+        """
+        Check whether the server running on the port has loaded a model file.
+
+        Args:
+            model_path (str): The GGUF file.
+
+        Returns:
+            bool: True when the server serves this file.
+        """
+        try:
+            props = requests.get(f"{self.base_url}/props", timeout=2).json()
+        except (requests.RequestException, ValueError):
+            return False
+        served = props.get("model_path") or props.get("default_generation_settings", {}).get("model")
+        return bool(served) and os.path.basename(served) == os.path.basename(model_path)
+
+    def stop(self) -> None:
+        # Only stop the server this process started
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+
+class LlamaServerLLM(LLM):
+    base_url: str
+    # Defaults of LangChain's LlamaCpp, a request can override them, e.g. LLM(prompt, temperature=0)
+    temperature: float = 0.8
+    top_p: float = 0.95
+    top_k: int = 40
+    repeat_penalty: float = 1.1
+    max_tokens: int = MAX_NEW_TOKENS
+    # Tokens are always streamed from the server, kept for callers setting it on LlamaCpp
+    streaming: bool = True
+    # Number of prompts the request scheduler lets generate at once
+    max_concurrency: int = LLAMA_SERVER_SLOTS
+    request_timeout: Optional[float] = None
+    # The server process, stopped when the model is unloaded if this process started it
+    server: Any = None
+    # Draft tokens proposed and accepted by the server, with a draft model
+    speculation: Any = None
+    # The GGUF file, whose vocabulary counts tokens without a request to the server
+    model_path: Optional[str] = None
+    # The vocabulary-only llama.cpp model once loaded, False when it cannot be
+    vocab: Any = None
+    # Connection pool of the /tokenize requests when the vocabulary cannot be loaded
+    session: Any = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "llama_server"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"base_url": self.base_url, "temperature": self.temperature, "top_p": self.top_p}
+
+    def _call(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        payload = {
+            "prompt": prompt,
+            "n_predict": kwargs.get("max_tokens", self.max_tokens),
+            "temperature": self.temperature,
+            "top_p": self.top_p,
+            "top_k": self.top_k,
+            "repeat_penalty": self.repeat_penalty,
+            "stop": stop or [],
+            "stream": True,
+            # Keep the prompt in the slot, the next request sharing its prefix only evaluates the rest
+            "cache_prompt": True,
+        }
+        # Sampling parameters of this request only, the other slots keep theirs
+        payload.update({name: value for name, value in kwargs.items() if name in SAMPLING_PARAMETERS})
+
+        text = []
+        with requests.post(
+            f"{self.base_url}/completion", json=payload, stream=True, timeout=self.request_timeout
+        ) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if not line.startswith(b"data: "):
+                    continue
+                event = json.loads(line[len(b"data: ") :])
+                token = event.get("content", "")
+                if token:
+                    text.append(token)
+                    # An error raised here, e.g. by a cancelled stream, closes the connection and frees the slot
+                    if run_manager:
+                        run_manager.on_llm_new_token(token)
+                if event.get("stop"):
+                    # The last event has the timings of the request, with the draft tokens of speculative decoding
+                    timings = event.get("timings") or {}
+                    if self.speculation is not None and timings.get("draft_n"):
+                        self.speculation.record(
+                            timings["draft_n"], timings.get("draft_n_accepted", 0), generations=1
+                        )
+                    break
+        return "".join(text)
+
+    def get_num_tokens(self, text: str) -> int:
+        return self.count_tokens([text])[0]
+
+    def _vocab(self):
+        # Load the vocabulary of the GGUF file once, without its weights
+        if self.vocab is None:
+            self.vocab = False
+            if self.model_path:
+                try:
+                    from llama_cpp import Llama
+
+                    self.vocab = Llama(model_path=self.model_path, vocab_only=True, verbose=False)
+                except Exception as e:
+                    warning(message=f"Tokens are counted by the llama.cpp server, its vocabulary did not load: {e}")
+        return self.vocab or None
+
+    def _remote_count(self, text: str) -> int:
+        response = self.session.post(f"{self.base_url}/tokenize", json={"content": text}, timeout=30)
+        response.raise_for_status()
+        return len(response.json()["tokens"])
+
+    def count_tokens(self, texts: list[str]) -> list[int]:
+        """
+        Count the tokens of several texts, as the server's /tokenize endpoint does.
+
+        Args:
+            texts (list[str]): The texts.
+
+        Returns:
+            list[int]: The number of tokens of every text.
+        """
+        vocab = self._vocab()
+        if vocab is not None:
+            # The server tokenizes without the BOS token
+            return [len(vocab.tokenize(text.encode("utf-8"), add_bos=False)) if text else 0 for text in texts]
+        if self.session is None:
+            self.session = requests.Session()
+        if len(texts) == 1:
+            return [self._remote_count(texts[0])]
+        with ThreadPoolExecutor(max_workers=min(len(texts), self.max_concurrency)) as executor:
+            return list(executor.map(self._remote_count, texts))
+
+
+def load_llama_server_llm(
+    model_path: str, n_gpu_layers: int = 0, callback_manager=None, draft_model_path: Optional[str] = None
+) -> Optional[LlamaServerLLM]:
+    """
+    Start a llama.cpp server for a GGUF model, or reuse the one running, and return its LLM.
+
+    Args:
+        model_path (str): The GGUF file.
+        n_gpu_layers (int): Number of layers offloaded to the GPU.
+        callback_manager: The LangChain callback manager of the LLM.
+        draft_model_path (Optional[str]): The GGUF file of a draft model, to decode speculatively.
+
+    Returns:
+        Optional[LlamaServerLLM]: The LLM, None when the llama-server binary is not installed.
+    """
+    # Every model has a server of its own, on the first port that is free or already serves it
+    for port in range(LLAMA_SERVER_PORT, LLAMA_SERVER_PORT + LLAMA_SERVER_MAX_MODELS):
+        server = LlamaServer(model_path, n_gpu_layers=n_gpu_layers, port=port, draft_model_path=draft_model_path)
+        if not server.healthy() or server.serves(model_path):
+            break
+    else:
+        warning(message="No free port for a llama.cpp server, the GGUF model decodes one prompt at a time")
+        return None
+    if not server.healthy() and shutil.which(LLAMA_SERVER_BINARY) is None:
+        warning(message=f"{LLAMA_SERVER_BINARY} not found, the GGUF model decodes one prompt at a time")
+        return None
+    server.start()
+    return LlamaServerLLM(
+        base_url=server.base_url,
+        max_concurrency=server.slots,
+        server=server,
+        speculation=SpeculationStats() if draft_model_path else None,
+        callback_manager=callback_manager,
+        model_path=model_path,
+    )
@@ -18,11 +18,23 @@ from utils import (
     error
 )
 
-from constants import CONTEXT_WINDOW_SIZE, MAX_NEW_TOKENS, MODELS_PATH, N_BATCH, N_GPU_LAYERS
+from constants import (
+    CONTEXT_WINDOW_SIZE,
+    LLAMA_SERVER_ENABLED,
+    MAX_NEW_TOKENS,
+    MODELS_PATH,
+    N_BATCH,
+    N_GPU_LAYERS,
+    PREFIX_CACHE_ENABLED,
+)
+from llama_server import load_llama_server_llm
 
 callback_manager = CallbackManager([StreamingStdOutCallbackHandler()])
 
-def load_quantized_model_gguf_ggml(model_id, model_basename, device_type, logging):
+
+def load_quantized_model_gguf_ggml(
+    model_id, model_basename, device_type, logging, draft_model_id=None, draft_model_basename=None
+):
     """
     Load a GGUF/GGML quantized model using LlamaCpp.
 
@@ -35,9 +47,12 @@ def load_quantized_model_gguf_ggml(model_id, model_basename, device_type, loggin
     - model_basename (str): The base name of the model file.
     - device_type (str): The type of device where the model will run, e.g., 'mps', 'cuda', etc.
     - logging (logging.Logger): Logger instance for logging messages.
+    - draft_model_id (str, optional): The HuggingFace Hub repository of a GGUF draft model, to decode speculatively.
+    - draft_model_basename (str, optional): The file of the draft model.
 
     Returns:
-    - LlamaCpp: An instance of the LlamaCpp model if successful, otherwise None.
+    - LlamaCpp: An instance of the LlamaCpp model if successful, otherwise None. A LlamaServerLLM when the
+      model is served by a llama.cpp server with parallel slots.
 
     Notes:
     - The function uses the `hf_hub_download` function to download the model from the HuggingFace Hub.
@@ -64,7 +79,40 @@ def load_quantized_model_gguf_ggml(model_id, model_basename, device_type, loggin
         if device_type.lower() == "cuda":
             kwargs["n_gpu_layers"] = N_GPU_LAYERS  # set this based on your GPU
 
-        return LlamaCpp(callback_manager=callback_manager, **kwargs)
+        draft_model_path = None
+        if draft_model_id and draft_model_basename:
+            # A small model of the same vocabulary proposes the tokens the model verifies in one pass
+            draft_model_path = hf_hub_download(
+                repo_id=draft_model_id,
+                filename=draft_model_basename,
+                resume_download=True,
+                cache_dir=MODELS_PATH,
+            )
+
+        llm = None
+        if LLAMA_SERVER_ENABLED:
+            # Concurrent prompts are decoded in the same batch by the slots of a llama.cpp server
+            llm = load_llama_server_llm(
+                model_path, kwargs.get("n_gpu_layers", 0), callback_manager, draft_model_path=draft_model_path
+            )
+        if llm is None:
+            if draft_model_path:
+                # llama-cpp-python verifies draft tokens with the logits of every evaluated token
+                kwargs["logits_all"] = True
+            llm = LlamaCpp(callback_manager=callback_manager, **kwargs)
+            if draft_model_path:
+                # Imported here as it needs llama-cpp-python, which only GGUF models use
+                from speculative import load_llama_draft_model
+
+                llm.client.draft_model = load_llama_draft_model(draft_model_path, kwargs.get("n_gpu_layers", 0))
+        if PREFIX_CACHE_ENABLED:
+            # Imported here as it needs llama-cpp-python, which only GGUF models use
+            from prefix_cache import enable_prefix_cache, template_prefixes, warm_prefixes
+
+            # Restore the state after the system prompt of a template rather than evaluating it for every request
+            enable_prefix_cache(llm)
+            warm_prefixes(llm, template_prefixes())
+        return llm
     except TypeError:
         if "ggml" in model_basename:
             # logging.INFO("If you were using GGML model, LLAMA-CPP Dropped Support, Use GGUF Instead")
@@ -8,7 +8,7 @@ import io
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 
 import requests
-from flask import Flask, render_template, request, jsonify, session, g, Response
+from flask import Flask, render_template, request, jsonify, session, g, Response, stream_with_context
 from werkzeug.utils import secure_filename
 from extensions.lesson_plan.utils import recreate_docx
 
@@ -17,6 +17,7 @@ app.secret_key = "LeafmanZSecretKey"
 
 API_HOST = "http://localhost:5110/api"
 
+
 def get_latest_file(directory):
     try:
         # Walk through all directories and subdirectories
@@ -36,12 +37,14 @@ def get_latest_file(directory):
     except ValueError:
         return None  # Handle the case where no files are found
     
+
 # Initialize selected_folder and selected_prompt_template
 @app.before_request
 def load_selected_values():
     g.selected_folder = session.get('selected_folder', '')
     g.selected_prompt_template = session.get('selected_prompt_template', '')
 
+
 # Proxy API requests from UI to API on localhost:5110
 @app.route("/api/download/<filename>", methods=["GET"])
 def proxy_download(filename):
@@ -56,6 +59,38 @@ def proxy_download(filename):
     else:
         return Response(response.content, status=response.status_code)
     
+
+# Relay the answer stream of the API, each event is forwarded as soon as it arrives
+@app.route("/api/prompt_route/stream", methods=["POST"])
+def proxy_prompt_stream():
+    api_url = f"{API_HOST}/prompt_route/stream"
+    prompt_data = {
+        field: request.form[field]
+        for field in ("user_prompt", "databases", "filters", "bypass_cache")
+        if request.form.get(field)
+    }
+
+    # Do not read the whole body, iterate over the chunks as the API sends them
+    response = requests.post(api_url, data=prompt_data, stream=True)
+    if response.status_code != 200:
+        return Response(response.content, status=response.status_code)
+
+    def relay():
+        try:
+            # chunk_size=None yields the data as it arrives instead of waiting for fixed-size blocks
+            for chunk in response.iter_content(chunk_size=None):
+                yield chunk
+        finally:
+            # Closing the connection when the browser goes away stops the generation in the API
+            response.close()
+
+    return Response(
+        stream_with_context(relay()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 # PAGES #
 @app.route("/", methods=["GET", "POST"])
 def home_page():
@@ -165,7 +200,12 @@ def home_page():
             print(f"Debugging: selected prompt_template after user key in prompt: {g.selected_prompt_template}") # debugging
             print(f"Debugging: selected DB after user key in prompt: {g.selected_folder}") # debugging
             main_prompt_url = f"{API_HOST}/prompt_route"
-            response = requests.post(main_prompt_url, data={"user_prompt": user_prompt})
+            # Forward the optional multi-database selection, metadata filters and cache bypass flag to the API
+            prompt_data = {"user_prompt": user_prompt}
+            for field in ("databases", "filters", "bypass_cache"):
+                if request.form.get(field):
+                    prompt_data[field] = request.form[field]
+            response = requests.post(main_prompt_url, data=prompt_data)
             print(response.status_code)  # print HTTP response status code for debugging
 
             new_output_filename = ""
@@ -215,6 +255,7 @@ def home_page():
         response_dict={"Prompt": "None", "Answer": "None", "Sources": [("ewf", "wef")]},
     )
 
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--port", type=int, default=5111, help="Port to run the UI on. Defaults to 5111.")
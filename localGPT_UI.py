@@ -1,9 +1,13 @@
+import os
 import torch
 import subprocess
 import streamlit as st
 from run_localGPT import load_model
-from langchain.vectorstores import Chroma
-from constants import CHROMA_SETTINGS, EMBEDDING_MODEL_NAME, PERSIST_DIRECTORY, MODEL_ID, MODEL_BASENAME
+from retrieval import CollectionRetriever, QueryEmbeddingCache
+from chroma_store import open_store
+from chunk_store import ChunkStore
+from columnar_store import ColumnarStore
+from constants import EMBEDDING_MODEL_NAME, PERSIST_DIRECTORY, MODEL_ID, MODEL_BASENAME
 from langchain.embeddings import HuggingFaceInstructEmbeddings
 from langchain.chains import RetrievalQA
 from streamlit_extras.add_vertical_space import add_vertical_space
@@ -69,15 +73,19 @@ if "EMBEDDINGS" not in st.session_state:
     st.session_state.EMBEDDINGS = EMBEDDINGS
 
 if "DB" not in st.session_state:
-    DB = Chroma(
-        persist_directory=PERSIST_DIRECTORY,
-        embedding_function=st.session_state.EMBEDDINGS,
-        client_settings=CHROMA_SETTINGS,
-    )
+    DB = open_store(PERSIST_DIRECTORY, st.session_state.EMBEDDINGS)
     st.session_state.DB = DB
 
 if "RETRIEVER" not in st.session_state:
-    RETRIEVER = DB.as_retriever()
+    # The chunk text is read from the columnar store of the collection, and matched children expand to parents
+    RETRIEVER = CollectionRetriever(
+        vectorstore=st.session_state.DB,
+        collection_name=os.path.basename(PERSIST_DIRECTORY),
+        embedder=QueryEmbeddingCache(st.session_state.EMBEDDINGS),
+        chunk_store=ChunkStore(PERSIST_DIRECTORY),
+        text_store=ColumnarStore(PERSIST_DIRECTORY),
+        persist_directory=PERSIST_DIRECTORY,
+    )
     st.session_state.RETRIEVER = RETRIEVER
 
 if "LLM" not in st.session_state:
@@ -113,10 +121,11 @@ if prompt:
     # With a streamlit expander
     with st.expander("Document Similarity Search"):
         # Find the relevant pages
-        search = st.session_state.DB.similarity_search_with_score(prompt)
+        retriever = st.session_state.RETRIEVER
+        search = retriever.search_by_vector(retriever.embedder.embed(prompt))
         # Write out the first
-        for i, doc in enumerate(search):
+        for i, (_, _, doc) in enumerate(search):
             # print(doc)
-            st.write(f"Source Document # {i+1} : {doc[0].metadata['source'].split('/')[-1]}")
-            st.write(doc[0].page_content)
+            st.write(f"Source Document # {i+1} : {doc.metadata['source'].split('/')[-1]}")
+            st.write(doc.page_content)
             st.write("--------------------------------")
@@ -0,0 +1,148 @@
+"""
+This module implements the structured chunk metadata used to narrow searches, e.g. to the slides of one module.
+
+At ingest time every document gets its file name, file type, sub-folder and ingest time as flat metadata fields,
+which Chroma stores in the indexed metadata table of its sqlite segment. At query time the request filters are
+translated into a Chroma `where` clause, so the matching chunk ids are resolved through that index first and only
+their vectors are scored, instead of post-filtering a large top-k.
+
+Functions:
+- add_filter_metadata(documents, source_dir): Adds the filterable metadata fields to loaded documents.
+- index_metadata(metadata): Selects the filterable fields of chunk metadata stored in the vector index.
+- build_where_filter(filters): Translates request filters into a Chroma where clause.
+- parse_filters(raw): Parses the JSON filters of a request.
+"""
+
+import json
+import os
+import time
+from typing import Any, Optional
+
+from langchain.docstore.document import Document
+
+# Request filter keys and the metadata fields they match
+FILTER_FIELDS = {
+    "source": "source",
+    "file_name": "file_name",
+    "file_type": "file_type",
+    "folder": "folder",
+    "page": "page",
+}
+# Request filter keys matching a range of ingest times, in seconds since the epoch
+RANGE_FILTERS = {
+    "ingested_after": ("ingested_at", "$gte"),
+    "ingested_before": ("ingested_at", "$lte"),
+}
+
+
+def add_filter_metadata(documents: list[Document], source_dir: str) -> list[Document]:
+    """
+    Add the filterable metadata fields to loaded documents, before they are split so every chunk inherits them.
+
+    Args:
+        documents (list[Document]): The loaded documents, None entries are skipped.
+        source_dir (str): The directory the documents were loaded from.
+
+    Returns:
+        list[Document]: The same documents, updated in place.
+    """
+    ingested_at = int(time.time())
+    for doc in documents:
+        if doc is None:
+            continue
+        source = doc.metadata["source"]
+        folder = os.path.relpath(os.path.dirname(source), source_dir)
+        doc.metadata.update(
+            {
+                "file_name": os.path.basename(source),
+                "file_type": os.path.splitext(source)[1].lower(),
+                # Sub-folder within the ingested directory, "" for files at its top level
+                "folder": "" if folder == "." else folder.replace(os.sep, "/"),
+                "ingested_at": ingested_at,
+            }
+        )
+    return documents
+
+
+def index_metadata(metadata: dict) -> dict:
+    """
+    Select the metadata fields of a chunk that where filters need in the vector index.
+
+    Args:
+        metadata (dict): The full metadata of the chunk.
+
+    Returns:
+        dict: The filterable fields present in the metadata.
+    """
+    fields = set(FILTER_FIELDS.values()) | {field for field, _ in RANGE_FILTERS.values()}
+    return {key: value for key, value in metadata.items() if key in fields}
+
+
+def _match(field: str, value: Any) -> dict:
+    # A list of values matches any of them, Chroma 0.4.6 has no $in operator
+    if isinstance(value, list):
+        if len(value) == 1:
+            return {field: {"$eq": value[0]}}
+        return {"$or": [{field: {"$eq": item}} for item in value]}
+    return {field: {"$eq": value}}
+
+
+def build_where_filter(filters: Optional[dict]) -> Optional[dict]:
+    """
+    Translate request filters into a Chroma where clause.
+
+    Example: {"file_type": [".pptx", ".pdf"], "folder": "Module3", "ingested_after": 1700000000}
+
+    Args:
+        filters (Optional[dict]): The request filters, keyed by FILTER_FIELDS and RANGE_FILTERS names.
+
+    Returns:
+        Optional[dict]: The where clause, or None when there is nothing to filter on.
+
+    Raises:
+        ValueError: If a filter key is unknown or a value has an unsupported type.
+    """
+    if not filters:
+        return None
+
+    conditions = []
+    for key, value in filters.items():
+        if key in FILTER_FIELDS:
+            values = value if isinstance(value, list) else [value]
+            # bool is a subclass of int, but true and false are neither strings nor numbers here
+            valid = all(isinstance(item, (str, int, float)) and not isinstance(item, bool) for item in values)
+            if not values or not valid:
+                raise ValueError(f"Filter '{key}' must be a string, a number or a list of them")
+            conditions.append(_match(FILTER_FIELDS[key], value))
+        elif key in RANGE_FILTERS:
+            if not isinstance(value, (int, float)) or isinstance(value, bool):
+                raise ValueError(f"Filter '{key}' must be a number of seconds since the epoch")
+            field, operator = RANGE_FILTERS[key]
+            conditions.append({field: {operator: value}})
+        else:
+            known = sorted(FILTER_FIELDS) + sorted(RANGE_FILTERS)
+            raise ValueError(f"Unknown filter '{key}', expected one of {known}")
+
+    # Chroma requires at least two conditions in an $and
+    return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+
+def parse_filters(raw: Optional[str]) -> Optional[dict]:
+    """
+    Parse the JSON filters of a request.
+
+    Args:
+        raw (Optional[str]): The JSON object sent in the "filters" form field.
+
+    Returns:
+        Optional[dict]: The filters, or None when the field is empty.
+
+    Raises:
+        ValueError: If the field is not a JSON object.
+    """
+    if not raw or not raw.strip():
+        return None
+    filters = json.loads(raw)
+    if not isinstance(filters, dict):
+        raise ValueError("Filters must be a JSON object")
+    return filters
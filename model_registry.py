@@ -0,0 +1,493 @@
+"""
+This module implements the registry of the models served by the API.
+
+The API used to load the model named by MODEL_ID and MODEL_BASENAME at import time, so serving another model meant
+editing constants.py and restarting, with minutes of downtime. The registry declares several models by name,
+loads a model when a request first names it, and keeps the loaded models resident within a memory budget: when a
+model does not fit, the least recently used models that no request is using are unloaded, and models left idle
+for too long are unloaded in the background. Requests lease the model they use, so a model is never unloaded
+while it generates, and a model generates for at most as many requests at once as it supports, its
+max_concurrency, e.g. one for the transformers pipelines and in-process llama.cpp models, which are not thread-safe.
+Replacing the model behind a name loads the new one in the background while the old one keeps
+serving, then swaps them atomically; the old model is unloaded once its last request completes.
+
+Functions:
+- estimate_model_bytes(spec): Estimates the memory a model will use before it is loaded.
+- model_memory_bytes(llm): Estimates the memory a loaded model uses.
+- release_model(llm): Frees the memory and processes of a model.
+- speculation_stats(llm): The draft token acceptance of a model decoding speculatively.
+
+Classes:
+- ModelRegistry: The named models, loaded on demand and evicted within a memory budget.
+"""
+
+import gc
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Optional
+
+from huggingface_hub import HfApi
+from huggingface_hub.constants import HUGGINGFACE_HUB_CACHE
+
+from constants import (
+    DEFAULT_MODEL,
+    MODELS_PATH,
+    MODEL_IDLE_TIMEOUT_SECONDS,
+    MODEL_MEMORY_BUDGET_BYTES,
+    MODEL_REGISTRY,
+)
+from utils import info, warning
+
+# Idle models are looked for this often
+_REAP_INTERVAL_SECONDS = 60
+
+# Extensions of the weight files of transformers models, safetensors are loaded in preference to the others
+_WEIGHT_EXTENSIONS = (".safetensors", ".bin", ".pt")
+
+
+def _weight_files_bytes(files: list[tuple[str, int]], basename: Optional[str]) -> int:
+    # Size of the files a model loads among the (name, size) files of its repository
+    if basename:
+        named = [size for name, size in files if os.path.basename(name) == basename]
+        if named:
+            return sum(named)
+    for extension in _WEIGHT_EXTENSIONS:
+        weights = [size for name, size in files if name.endswith(extension) and "training_args" not in name]
+        if weights:
+            return sum(weights)
+    return 0
+
+
+def _cached_files(repo_id: str) -> list[tuple[str, int]]:
+    # Files of the latest snapshot of a repository in the Hugging Face caches the loaders download to
+    folder = "models--" + repo_id.replace("/", "--")
+    for cache in (MODELS_PATH, HUGGINGFACE_HUB_CACHE):
+        snapshots = os.path.join(cache, folder, "snapshots")
+        if not os.path.isdir(snapshots):
+            continue
+        revisions = [os.path.join(snapshots, revision) for revision in os.listdir(snapshots)]
+        if not revisions:
+            continue
+        files = []
+        for root, _, names in os.walk(max(revisions, key=os.path.getmtime)):
+            # The snapshot links to the downloaded blobs, getsize follows the links
+            files += [(name, os.path.getsize(os.path.join(root, name))) for name in names]
+        if files:
+            return files
+    return []
+
+
+def _repository_bytes(repo_id: str, basename: Optional[str]) -> int:
+    # Weights in the local caches, else the sizes the hub lists for the repository
+    size = _weight_files_bytes(_cached_files(repo_id), basename)
+    if size:
+        return size
+    try:
+        siblings = HfApi().model_info(repo_id, files_metadata=True).siblings or []
+    except Exception as e:
+        warning(message=f"Could not get the size of {repo_id}: {e}")
+        return 0
+    return _weight_files_bytes([(sibling.rfilename, sibling.size or 0) for sibling in siblings], basename)
+
+
+def estimate_model_bytes(spec: dict) -> int:
+    """
+    Estimate the memory a model will use before it is loaded, from the size of its weight files and those of its
+    draft model.
+
+    Args:
+        spec (dict): The specification of the model.
+
+    Returns:
+        int: The size of the weights, 0 when unknown.
+    """
+    total = 0
+    for repo_id, basename in (
+        (spec.get("model_id"), spec.get("model_basename")),
+        (spec.get("draft_model_id"), spec.get("draft_model_basename")),
+    ):
+        if repo_id:
+            total += _repository_bytes(repo_id, basename)
+    return total
+
+
+def model_memory_bytes(llm) -> int:
+    """
+    Estimate the memory a loaded model uses.
+
+    Args:
+        llm: The LangChain LLM.
+
+    Returns:
+        int: The size of the GGUF file of llama.cpp models, the footprint of transformers models, 0 when unknown.
+    """
+    # llama.cpp maps the GGUF file, in process or in its server
+    server = getattr(llm, "server", None)
+    client = getattr(llm, "client", None)
+    for path in (getattr(server, "model_path", None), getattr(client, "model_path", None)):
+        if path and os.path.exists(path):
+            return os.path.getsize(path)
+    # Transformers models, with the draft model of speculative decoding
+    holder = getattr(llm, "engine", None) or getattr(llm, "decoder", None) or getattr(llm, "pipeline", None)
+    models = [getattr(holder, "model", None), getattr(holder, "draft_model", None)]
+    return sum(int(model.get_memory_footprint()) for model in models if hasattr(model, "get_memory_footprint"))
+
+
+def release_model(llm) -> None:
+    """
+    Free the memory and processes of a model no request uses any more.
+
+    Args:
+        llm: The LangChain LLM.
+    """
+    engine = getattr(llm, "engine", None)
+    if engine is not None and hasattr(engine, "close"):
+        engine.close()
+    server = getattr(llm, "server", None)
+    if server is not None:
+        server.stop()
+    client = getattr(llm, "client", None)
+    if client is not None and hasattr(client, "close"):
+        client.close()
+    gc.collect()
+    try:
+        import torch
+
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    except ImportError:
+        pass
+
+
+def speculation_stats(llm) -> Optional[dict]:
+    """
+    Get the draft token acceptance of a model decoding speculatively.
+
+    Args:
+        llm: The LangChain LLM.
+
+    Returns:
+        Optional[dict]: The acceptance metrics, None when the model has no draft model.
+    """
+    # In-process llama.cpp models keep them in their draft model
+    speculation = getattr(llm, "speculation", None) or getattr(
+        getattr(getattr(llm, "client", None), "draft_model", None), "speculation", None
+    )
+    return speculation.stats() if speculation is not None else None
+
+
+class _Resident:
+    def __init__(self, llm, spec: dict, estimated_bytes: int = 0):
+        self.llm = llm
+        self.spec = spec
+        self.memory_bytes = spec.get("memory_bytes") or model_memory_bytes(llm) or estimated_bytes
+        # Requests generating at once, models without max_concurrency take one at a time
+        self.max_concurrency = max(1, int(getattr(llm, "max_concurrency", 1) or 1))
+        self.slots = threading.BoundedSemaphore(self.max_concurrency)
+        self.leases = 0
+        self.last_used = time.monotonic()
+        # Replaced by a newer model, unloaded when its last lease is released
+        self.retired = False
+
+
+class ModelRegistry:
+    def __init__(
+        self,
+        loader: Callable[[dict], Any],
+        specs: Optional[dict] = None,
+        memory_budget_bytes: int = MODEL_MEMORY_BUDGET_BYTES,
+        idle_timeout_seconds: float = MODEL_IDLE_TIMEOUT_SECONDS,
+        pinned: tuple = (DEFAULT_MODEL,),
+    ):
+        """
+        Initializes the registry, no model is loaded until it is used.
+
+        Args:
+            loader (Callable[[dict], Any]): Loads the LLM of a model specification, e.g. {"model_id": ...,
+                "model_basename": ...}.
+            specs (Optional[dict]): The specifications of the models by name (default is MODEL_REGISTRY).
+            memory_budget_bytes (int): The memory the resident models may use, 0 for no limit.
+            idle_timeout_seconds (float): Models unused for this long are unloaded, 0 to keep them.
+            pinned (tuple): Names of the models never unloaded for lack of memory or use.
+        """
+        self._loader = loader
+        self._specs: dict = dict(MODEL_REGISTRY if specs is None else specs)
+        self.memory_budget_bytes = memory_budget_bytes
+        self.idle_timeout_seconds = idle_timeout_seconds
+        self.pinned = set(pinned)
+        # Least recently used first
+        self._models: "OrderedDict[str, _Resident]" = OrderedDict()
+        self._loading: dict[str, threading.Event] = {}
+        self._errors: dict[str, str] = {}
+        self._lock = threading.Lock()
+        if idle_timeout_seconds:
+            threading.Thread(target=self._reap, daemon=True).start()
+
+    def names(self) -> list[str]:
+        """
+        Get the names of the declared models.
+
+        Returns:
+            list[str]: The names.
+        """
+        with self._lock:
+            return list(self._specs)
+
+    def key(self, name: str) -> str:
+        """
+        Get the key identifying the model behind a name, used to keep answers of different models apart.
+
+        Args:
+            name (str): The name of the model.
+
+        Returns:
+            str: The model id and file of the model.
+        """
+        with self._lock:
+            spec = self._specs[name]
+        return f"{spec['model_id']}/{spec.get('model_basename')}"
+
+    def _evict(self, needed_bytes: int, keep: str) -> None:
+        # Unload the least recently used models that are not in use until the new model fits, called with the lock
+        if not self.memory_budget_bytes:
+            return
+        used = sum(resident.memory_bytes for resident in self._models.values())
+        for name, resident in list(self._models.items()):
+            if used + needed_bytes <= self.memory_budget_bytes:
+                break
+            if name == keep or name in self.pinned or resident.leases:
+                continue
+            del self._models[name]
+            used -= resident.memory_bytes
+            info(message=f"Model '{name}' unloaded to free {resident.memory_bytes / 1024**3:.1f} GB")
+            release_model(resident.llm)
+        if used + needed_bytes > self.memory_budget_bytes:
+            warning(message="Resident models exceed the memory budget, the models in use cannot be unloaded")
+
+    def load(self, name: str):
+        """
+        Get the LLM of a model, loading it when it is not resident. Concurrent callers wait for the same load.
+
+        Args:
+            name (str): The name of the model.
+
+        Returns:
+            The LangChain LLM.
+
+        Raises:
+            KeyError: If no model has this name.
+            RuntimeError: If the model failed to load.
+        """
+        while True:
+            with self._lock:
+                if name not in self._specs:
+                    raise KeyError(f"Unknown model '{name}', expected one of {list(self._specs)}")
+                if name in self._models:
+                    self._models.move_to_end(name)
+                    return self._models[name].llm
+                loading = self._loading.get(name)
+                if loading is None:
+                    loading = self._loading[name] = threading.Event()
+                    spec = self._specs[name]
+                    break
+            # Another request is loading the model
+            loading.wait()
+            with self._lock:
+                if name not in self._models and name in self._errors:
+                    raise RuntimeError(self._errors[name])
+
+        try:
+            self._install(name, spec)
+        finally:
+            with self._lock:
+                del self._loading[name]
+            loading.set()
+        with self._lock:
+            return self._models[name].llm
+
+    def _install(self, name: str, spec: dict) -> None:
+        # Load a model and make it the one served under its name, retiring the model it replaces.
+        # Models are unloaded before the load so that both are never resident beyond the budget
+        needed: int = spec.get("memory_bytes") or (estimate_model_bytes(spec) if self.memory_budget_bytes else 0)
+        if self.memory_budget_bytes and not needed:
+            warning(message=f"Memory of model '{name}' unknown, set its memory_bytes to unload models before it loads")
+        with self._lock:
+            self._evict(needed, keep=name)
+        info(message=f"Loading model '{name}': {spec['model_id']}/{spec.get('model_basename')}")
+        started = time.monotonic()
+        try:
+            resident = _Resident(self._loader(spec), spec, needed)
+        except Exception as e:
+            with self._lock:
+                self._errors[name] = f"Model '{name}' failed to load: {e}"
+            raise RuntimeError(self._errors[name]) from e
+
+        with self._lock:
+            self._errors.pop(name, None)
+            previous = self._models.pop(name, None)
+            self._specs[name] = spec
+            self._models[name] = resident
+            self._evict(0, keep=name)
+        info(message=f"Model '{name}' loaded in {time.monotonic() - started:.0f} seconds")
+        if previous is not None:
+            self._retire(previous)
+
+    def _retire(self, resident: _Resident) -> None:
+        with self._lock:
+            resident.retired = True
+            unused = resident.leases == 0
+        if unused:
+            release_model(resident.llm)
+
+    def load_async(self, name: str) -> threading.Thread:
+        """
+        Load a model in the background, e.g. before the requests that will use it.
+
+        Args:
+            name (str): The name of the model.
+
+        Returns:
+            threading.Thread: The loading thread.
+        """
+        thread = threading.Thread(target=self.load, args=(name,), daemon=True)
+        thread.start()
+        return thread
+
+    def replace(self, name: str, spec: dict) -> threading.Thread:
+        """
+        Load a new model for a name in the background and swap it in once loaded. Requests keep using the current
+        model until then, and those already running finish with it.
+
+        Args:
+            name (str): The name of the model, declared or new.
+            spec (dict): The specification of the new model.
+
+        Returns:
+            threading.Thread: The loading thread.
+
+        Raises:
+            RuntimeError: If a model is already loading for the name.
+        """
+        with self._lock:
+            if name in self._loading:
+                raise RuntimeError(f"Model '{name}' is already loading")
+            loading = self._loading[name] = threading.Event()
+
+        def run() -> None:
+            try:
+                self._install(name, spec)
+            except RuntimeError as e:
+                warning(message=str(e))
+            finally:
+                with self._lock:
+                    del self._loading[name]
+                loading.set()
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def unload(self, name: str) -> bool:
+        """
+        Unload a model, once the requests using it complete.
+
+        Args:
+            name (str): The name of the model.
+
+        Returns:
+            bool: True when the model was resident.
+        """
+        with self._lock:
+            resident = self._models.pop(name, None)
+        if resident is None:
+            return False
+        self._retire(resident)
+        return True
+
+    @contextmanager
+    def lease(self, name: str) -> Iterator[Any]:
+        """
+        Use a model for a request, it is not unloaded before the block ends. Waits while the model already
+        generates for its max_concurrency requests.
+
+        Args:
+            name (str): The name of the model.
+
+        Yields:
+            The LangChain LLM.
+        """
+        while True:
+            self.load(name)
+            with self._lock:
+                # The model may have been unloaded between loading and leasing it
+                resident = self._models.get(name)
+                if resident is not None:
+                    resident.leases += 1
+                    break
+        try:
+            with resident.slots:
+                yield resident.llm
+        finally:
+            with self._lock:
+                resident.leases -= 1
+                resident.last_used = time.monotonic()
+                release = resident.retired and resident.leases == 0
+            if release:
+                release_model(resident.llm)
+
+    def _reap(self) -> None:
+        while True:
+            time.sleep(_REAP_INTERVAL_SECONDS)
+            now = time.monotonic()
+            with self._lock:
+                idle = [
+                    name
+                    for name, resident in self._models.items()
+                    if name not in self.pinned
+                    and not resident.leases
+                    and now - resident.last_used > self.idle_timeout_seconds
+                ]
+            for name in idle:
+                info(message=f"Model '{name}' unloaded after {self.idle_timeout_seconds:.0f} seconds idle")
+                self.unload(name)
+
+    def status(self) -> list[dict]:
+        """
+        Get the state of every declared model.
+
+        Returns:
+            list[dict]: The name, model, state ("resident", "loading", "failed" or "unloaded"), memory, active
+            requests, concurrency and idle time of every model.
+        """
+        now = time.monotonic()
+        with self._lock:
+            states = []
+            for name, spec in self._specs.items():
+                resident = self._models.get(name)
+                state = {
+                    "name": name,
+                    "model_id": spec["model_id"],
+                    "model_basename": spec.get("model_basename"),
+                    "state": "resident" if resident else "loading" if name in self._loading else "unloaded",
+                    "pinned": name in self.pinned,
+                }
+                if name in self._errors and not resident:
+                    state.update(state="failed", error=self._errors[name])
+                if resident:
+                    state.update(
+                        memory_bytes=resident.memory_bytes,
+                        active_requests=resident.leases,
+                        max_concurrency=resident.max_concurrency,
+                        idle_seconds=round(now - resident.last_used),
+                    )
+                    speculation = speculation_stats(resident.llm)
+                    if speculation is not None:
+                        state["speculation"] = speculation
+                    # The replacement of a resident model is loading
+                    if name in self._loading:
+                        state["replacing"] = True
+                states.append(state)
+            return states
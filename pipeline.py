@@ -1,7 +1,6 @@
 # Standard library imports
 import logging
 import os
-import shutil
 import subprocess
 import argparse
 import time
@@ -14,7 +13,6 @@ from flask import Flask, jsonify, request, Response
 from werkzeug.utils import secure_filename
 from langchain.chains import RetrievalQA, LLMChain
 from langchain.embeddings import HuggingFaceInstructEmbeddings
-from langchain.vectorstores import Chroma
 
 # Local application imports
 from utils import (
@@ -24,20 +22,25 @@ from utils import (
     error
 )
 from run_localGPT import load_model
+from collection_pool import CollectionPool
+from snapshots import current_version_dir
+from retrieval import CollectionRetriever, QueryEmbeddingCache
+from chroma_store import open_store, remove_directory
+from chunk_store import ChunkStore
+from columnar_store import ColumnarStore
 from prompt_templates.prompt_template_utils import (
     get_prompt_template,
     PROMPT_TEMPLATE_MAPPING,
     LESSON_PLAN_PROMPT
 )
 from constants import (
-    CHROMA_SETTINGS, 
     EMBEDDING_MODEL_NAME,  
-    DATABASE_MAPPING,
     PERSIST_DIRECTORY,
     PERSIST_DIRECTORIES, 
     MODEL_ID, 
     MODEL_BASENAME,
     SOURCE_DIRECTORY,
+    PRELOAD_COLLECTIONS,
 )
 
 # Initialize a lock for handling API requests
@@ -61,8 +64,10 @@ logging.info(f"Display Source Documents set to: {SHOW_SOURCES}")
 # Initialize embeddings using HuggingFaceInstructEmbeddings
 EMBEDDINGS = HuggingFaceInstructEmbeddings(model_name=EMBEDDING_MODEL_NAME, model_kwargs={"device": DEVICE_TYPE})
 
-# Initialize retriever dictionary and debugging variables
-RETRIEVER_DICT: dict = {}
+# Query embeddings shared by every retriever
+QUERY_EMBEDDER = QueryEmbeddingCache(EMBEDDINGS)
+
+# Initialize debugging variables
 DB_SELECTED: str = ""  # For debugging
 PROMPT_TEMPLATE_SELECTED: str = ""  # For debugging
 
@@ -72,16 +77,36 @@ LLM = load_model(device_type=DEVICE_TYPE, model_id=MODEL_ID, model_basename=MODE
 # Get the prompt template and memory
 prompt, memory = get_prompt_template(promptTemplate_type="mistral", history=False)
 
-# Iterate over each directory in the database mapping
-for dir_name, dir_path in DATABASE_MAPPING.items():
-    # Initialize Chroma database with embeddings and settings
-    DB = Chroma(persist_directory=dir_path, embedding_function=EMBEDDINGS, client_settings=CHROMA_SETTINGS)
-    
-    # Get the retriever from the database
-    retriever = DB.as_retriever()
-    
-    # Store the retriever in the dictionary
-    RETRIEVER_DICT[dir_name] = retriever
+
+def open_retriever(dir_name: str) -> CollectionRetriever:
+    """
+    Open the vector store of a database and create its retriever.
+
+    Args:
+        dir_name (str): The name of the database.
+
+    Returns:
+        CollectionRetriever: The retriever used by the QA chains.
+    """
+    # Initialize Chroma database with embeddings and settings, from its live index version
+    persist_directory = current_version_dir(os.path.join(PERSIST_DIRECTORY, dir_name))
+    DB = open_store(persist_directory, EMBEDDINGS)
+    # The chunk text is read from the columnar store of the collection, and matched children expand to parents
+    return CollectionRetriever(
+        vectorstore=DB,
+        collection_name=dir_name,
+        embedder=QUERY_EMBEDDER,
+        chunk_store=ChunkStore(persist_directory),
+        text_store=ColumnarStore(persist_directory),
+        persist_directory=persist_directory,
+    )
+
+
+# Databases are opened on first use, the most used ones are preloaded in the background
+RETRIEVER_DICT = CollectionPool(
+    open_retriever, closer=CollectionRetriever.release, sizer=CollectionRetriever.resident_bytes
+)
+RETRIEVER_DICT.preload(PRELOAD_COLLECTIONS)
 
 # Sleep for a short duration to ensure all processes are ready
 time.sleep(0.2)
@@ -89,6 +114,7 @@ time.sleep(0.2)
 # Open the localhost URL in the default web browser
 subprocess.run(['python', '-m', 'webbrowser', '-t', 'http://localhost:5111'])
 
+
 def make_tree(path: str) -> dict:
     """
     Generate a tree structure of directories starting from the given path.
@@ -113,16 +139,18 @@ def make_tree(path: str) -> dict:
         for name in lst:
             # Construct the full path of the entry
             fn = os.path.join(path, name)
-            # Check if the entry is a directory
-            if os.path.isdir(fn):
+            # Check if the entry is a directory, hidden ones such as the shared Chroma store are not databases
+            if os.path.isdir(fn) and not name.startswith("."):
                 # Add the directory to the children list
                 tree['children'].append(dict(name=name))
     
     return tree
 
+
 # Initialize the Flask application
 app = Flask(__name__)
 
+
 @app.route('/api/source_dirtree', methods=["GET"])
 def source_dirtree_api() -> jsonify:
     """
@@ -143,6 +171,7 @@ def source_dirtree_api() -> jsonify:
     # Generate the directory tree structure and return it as a JSON response
     return jsonify(make_tree(path))
 
+
 @app.route('/api/database_dirtree', methods=["GET"])
 def database_dirtree_api() -> jsonify:
     """
@@ -163,6 +192,7 @@ def database_dirtree_api() -> jsonify:
     # Generate the directory tree structure and return it as a JSON response
     return jsonify(make_tree(path))
 
+
 @app.route("/api/delete_source", methods=["GET"])
 def delete_source_route() -> jsonify:
     """
@@ -175,19 +205,23 @@ def delete_source_route() -> jsonify:
         jsonify: A JSON response containing a message about the operation's success.
     """
     folder_names: list[str] = ["SOURCE_DOCUMENTS", "DB"]
+
+    # Close every open database before deleting its files
+    RETRIEVER_DICT.clear()
     
     for folder_name in folder_names:
         # Check if the folder exists
         if os.path.exists(folder_name):
-            # Remove the folder and all its contents
-            shutil.rmtree(folder_name)
+            # Remove the folder and all its contents, dropping the collections of the shared Chroma store
+            remove_directory(folder_name)
         
         # Recreate the folder
-        os.makedirs(folder_name)
+        os.makedirs(folder_name, exist_ok=True)
 
     # Return a JSON response indicating the folders were successfully deleted and recreated
     return jsonify({"message": f"Folders {folder_names} successfully deleted and recreated."})
 
+
 @app.route("/api/save_document/<directory_name>", methods=["GET", "POST"])
 def save_document_route(directory_name: str) -> tuple[str, int]:
     """
@@ -231,6 +265,7 @@ def save_document_route(directory_name: str) -> tuple[str, int]:
         # Return a success message and HTTP status code 200
         return "File saved successfully", 200
     
+
 @app.route("/api/create_folder/<folder_name>", methods=["POST"])
 def create_folder(folder_name: str) -> tuple[dict[str, str], int]:
     """
@@ -255,6 +290,7 @@ def create_folder(folder_name: str) -> tuple[dict[str, str], int]:
         # Return an error message and HTTP status code 400 if the folder already exists
         return {"message": f"Folder '{folder_name}' already exists."}, 400
 
+
 @app.route("/api/choose_prompt_template/<selected_prompt_template>", methods=["POST"])
 def chosen_prompt_template(selected_prompt_template: str) -> str:
     """
@@ -287,6 +323,7 @@ def chosen_prompt_template(selected_prompt_template: str) -> str:
     # Return the name of the selected prompt template
     return PROMPT_TEMPLATE_SELECTED
 
+
 @app.route("/api/choose_folder/<selected_folder>", methods=["POST"])
 def chosen_folder(selected_folder: str) -> str:
     """
@@ -315,6 +352,7 @@ def chosen_folder(selected_folder: str) -> str:
     # Return the name of the selected database
     return DB_SELECTED
 
+
 @app.route("/api/get_current_state", methods=["GET"])
 def get_current_state() -> jsonify:
     """
@@ -337,6 +375,7 @@ def get_current_state() -> jsonify:
     # Return the current state as a JSON response
     return jsonify(current_state)
 
+
 @app.route("/api/run_ingest/<directory_name>", methods=["GET"])
 def run_ingest_route(directory_name: str) -> Tuple[str, int]:
     """
@@ -356,10 +395,13 @@ def run_ingest_route(directory_name: str) -> Tuple[str, int]:
         # Construct the path to the directory where data will be persisted
         persist_directory_path = os.path.join(PERSIST_DIRECTORY, directory_name)
         
+        # Close the database before its files are removed
+        del RETRIEVER_DICT[directory_name]
+
         # Check if the directory exists and remove it if it does
         if os.path.exists(persist_directory_path):
             try:
-                shutil.rmtree(persist_directory_path)
+                remove_directory(persist_directory_path)
             except OSError as e:
                 print(f"Error: {e.filename} - {e.strerror}.")
         else:
@@ -387,16 +429,8 @@ def run_ingest_route(directory_name: str) -> Tuple[str, int]:
         if result.returncode != 0:
             return "Script execution failed: {}".format(result.stderr.decode("utf-8")), 500
         
-        # Load the vector store
-        DB = Chroma(
-            persist_directory=persist_directory_path,
-            embedding_function=EMBEDDINGS,
-            client_settings=CHROMA_SETTINGS,
-        )
-        retriever = DB.as_retriever()
-
-        # Store the retriever in the global dictionary
-        RETRIEVER_DICT[directory_name] = retriever
+        # Load the vector store and store its retriever in the global dictionary
+        RETRIEVER_DICT[directory_name] = open_retriever(directory_name)
 
         success(message=f"Script executed successfully: {result.stdout.decode('utf-8')}")
 
@@ -404,6 +438,7 @@ def run_ingest_route(directory_name: str) -> Tuple[str, int]:
     except Exception as e:
         return f"Error occurred: {str(e)}", 500
 
+
 @app.route("/api/prompt_route", methods=["GET", "POST"])
 def prompt_route() -> Tuple[Response, int]:
     """
@@ -515,6 +550,7 @@ def parse_arguments() -> argparse.Namespace:
     )
     return parser.parse_args()
 
+
 if __name__ == "__main__":
     subprocess.Popen(["python", "localGPTUI/localGPTUI.py"])
 
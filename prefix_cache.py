@@ -0,0 +1,192 @@
+"""
+This module implements the prompt-prefix cache of the llama.cpp models.
+
+Every prompt of a template starts with the same long system prompt, and in history mode with the conversation so
+far, yet llama.cpp evaluated the whole prompt again for every request, which takes seconds on CPU. The cache keeps
+snapshots of the llama.cpp state (the KV cache and the tokens it holds) keyed by their tokens: one after the fixed
+prefix of every prompt template, warmed when the model is loaded, and one after every answer, which holds the chat
+turn for the next prompt of the conversation. Before a prompt is evaluated llama-cpp-python restores the snapshot
+sharing the longest prefix with it and only evaluates the rest. Snapshots are kept in memory up to a byte budget,
+the least recently used ones spill to a disk cache with its own budget, and the warmed prefixes are written to
+disk at once so that restarts find them there.
+
+The llama.cpp server is not warmed: every slot only keeps the prompt it last evaluated, so the prefixes sent at
+startup would leave each slot with an arbitrary one. Requests reuse the prompt cached in their slot instead, which
+holds the prefix of the template the slot last served.
+
+Functions:
+- template_prefixes(): The fixed prefixes of the prompts of every template.
+- enable_prefix_cache(llm): Attaches a prefix cache to a LlamaCpp model.
+- warm_prefixes(llm, prefixes): Evaluates the prefixes that are not cached yet and snapshots them.
+
+Classes:
+- TieredLlamaCache: llama.cpp state snapshots in memory, spilled to disk.
+"""
+
+import logging
+import os
+from collections import OrderedDict
+from typing import Optional, Sequence, Tuple
+
+from llama_cpp import BaseLlamaCache, Llama, LlamaDiskCache, LlamaState
+
+from constants import (
+    PREFIX_CACHE_DIRECTORY,
+    PREFIX_CACHE_DISK_BYTES,
+    PREFIX_CACHE_RAM_BYTES,
+)
+from prompt_templates.prompt_template_utils import PROMPT_TEMPLATE_MAPPING, get_prompt_template
+
+# Replaces the variables of a template, the prefix ends where it first appears
+_SENTINEL = "\x00PREFIX_END\x00"
+
+
+class TieredLlamaCache(BaseLlamaCache):
+    def __init__(
+        self,
+        directory: str,
+        ram_bytes: int = PREFIX_CACHE_RAM_BYTES,
+        disk_bytes: int = PREFIX_CACHE_DISK_BYTES,
+    ):
+        """
+        Initializes the cache.
+
+        Args:
+            directory (str): The directory of the disk cache, one per model.
+            ram_bytes (int): Size of the snapshots kept in memory.
+            disk_bytes (int): Size of the snapshots kept on disk.
+        """
+        super().__init__(capacity_bytes=ram_bytes)
+        self.ram: "OrderedDict[Tuple[int, ...], LlamaState]" = OrderedDict()
+        self.disk = LlamaDiskCache(cache_dir=directory, capacity_bytes=disk_bytes)
+        self.last_key: Optional[Tuple[int, ...]] = None
+
+    @property
+    def cache_size(self) -> int:
+        return sum(state.llama_state_size for state in self.ram.values())
+
+    def _find_longest_prefix_key(self, key: Tuple[int, ...]) -> Optional[Tuple[int, ...]]:
+        best_key, best_length = None, 0
+        for candidate in self.ram.keys():
+            length = Llama.longest_token_prefix(candidate, key)
+            if length > best_length:
+                best_key, best_length = candidate, length
+        # The disk cache is searched for a longer prefix than the one in memory
+        disk_key = self.disk._find_longest_prefix_key(key)
+        if disk_key is not None and Llama.longest_token_prefix(disk_key, key) > best_length:
+            best_key = disk_key
+        return best_key
+
+    def __getitem__(self, key: Sequence[int]) -> LlamaState:
+        key = tuple(key)
+        best_key = self._find_longest_prefix_key(key)
+        if best_key is None:
+            raise KeyError("Key not found")
+        if best_key in self.ram:
+            self.ram.move_to_end(best_key)
+            return self.ram[best_key]
+        # Promote the snapshot to memory, it is likely to be used again soon. Reading it removes it from the disk
+        # cache, write it back so that a restart still finds it
+        state = self.disk[best_key]
+        self.disk[best_key] = state
+        self._put(best_key, state)
+        return state
+
+    def __contains__(self, key: Sequence[int]) -> bool:
+        return self._find_longest_prefix_key(tuple(key)) is not None
+
+    def __setitem__(self, key: Sequence[int], value: LlamaState) -> None:
+        key = tuple(key)
+        self._put(key, value)
+        self.last_key = key
+
+    def _put(self, key: Tuple[int, ...], value: LlamaState) -> None:
+        self.ram.pop(key, None)
+        self.ram[key] = value
+        # Spill the least recently used snapshots to disk beyond the memory budget
+        while self.cache_size > self.capacity_bytes and len(self.ram) > 1:
+            spilled_key, spilled_state = self.ram.popitem(last=False)
+            self.disk[spilled_key] = spilled_state
+
+    def persist(self, key: Tuple[int, ...]) -> None:
+        """
+        Write a snapshot to disk while keeping it in memory, e.g. a warmed prefix needed after a restart.
+
+        Args:
+            key (Tuple[int, ...]): The tokens of the snapshot.
+        """
+        if key in self.ram:
+            self.disk[key] = self.ram[key]
+
+
+def template_prefixes() -> list[str]:
+    """
+    Get the fixed prefixes of the prompts of every template, i.e. the prompt up to its first variable.
+
+    Returns:
+        list[str]: The distinct prefixes, as the API and the console chat render them.
+    """
+    prefixes = []
+    for system_prompt in PROMPT_TEMPLATE_MAPPING.values():
+        for history in (False, True):
+            prompt, _ = get_prompt_template(
+                system_prompt=system_prompt, promptTemplate_type="mistral", history=history
+            )
+            rendered = prompt.format(**{name: _SENTINEL for name in prompt.input_variables})
+            prefixes.append(rendered[: rendered.index(_SENTINEL)])
+        # Prompts answered without RAG start with the bare system prompt
+        prefixes.append(system_prompt)
+    return [prefix for prefix in dict.fromkeys(prefixes) if prefix.strip()]
+
+
+def enable_prefix_cache(llm) -> Optional[TieredLlamaCache]:
+    """
+    Attach a prefix cache to a LlamaCpp model, with a disk cache of its own.
+
+    Args:
+        llm: The LangChain LLM.
+
+    Returns:
+        Optional[TieredLlamaCache]: The cache, None when the LLM is not an in-process llama.cpp model.
+    """
+    model = getattr(llm, "client", None)
+    if not isinstance(model, Llama):
+        return None
+    directory = os.path.join(PREFIX_CACHE_DIRECTORY, os.path.basename(model.model_path))
+    cache = TieredLlamaCache(directory)
+    model.set_cache(cache)
+    return cache
+
+
+def warm_prefixes(llm, prefixes: Sequence[str]) -> int:
+    """
+    Evaluate the prefixes that are not cached yet, so that their snapshots are restored by the first requests.
+
+    Args:
+        llm: The LangChain LLM, a LlamaCpp model with a prefix cache.
+        prefixes (Sequence[str]): The prefixes.
+
+    Returns:
+        int: The number of prefixes evaluated, 0 for other models, e.g. a llama.cpp server LLM.
+    """
+    model = getattr(llm, "client", None)
+    if not isinstance(model, Llama):
+        return 0
+    cache = model.cache
+    if not isinstance(cache, TieredLlamaCache):
+        return 0
+
+    warmed = 0
+    for prefix in prefixes:
+        tokens = tuple(model.tokenize(prefix.encode("utf-8")))
+        cached = cache._find_longest_prefix_key(tokens)
+        # Completions are tokenized slightly differently at the end of the prefix, the last token may differ
+        if cached is not None and Llama.longest_token_prefix(cached, tokens) >= len(tokens) - 1:
+            continue
+        # A one-token completion evaluates the prefix as requests do, and llama-cpp-python snapshots it. It runs on
+        # the llama.cpp model itself, so the LangChain callbacks, e.g. the stdout stream, never see it
+        model.create_completion(prefix, max_tokens=1)
+        cache.persist(cache.last_key)
+        warmed += 1
+    logging.info(f"Warmed {warmed} of {len(prefixes)} prompt prefixes")
+    return warmed
@@ -128,7 +128,7 @@ Example formatting:
 - b. <Option 2: Not more than 10 words ending with a full-stop. Do not use "all of the above" as an option.>
 - c. <Option 3: Not more than 10 words ending with a full-stop. Do not use "all of the above" as an option.>
 - d. <Option 4: Not more than 10 words ending with a full-stop. Do not use "all of the above" as an option.>
-### Feedback for Question 3:
+### Feedback for Question 2:
 - a. <Detailed feedback (including "CORRECT" or "INCORRECT") for Option 1 with examples ending with a full-stop>
 - b. <Detailed feedback (including "CORRECT" or "INCORRECT") for Option 2 with examples ending with a full-stop>
 - c. <Detailed feedback (including "CORRECT" or "INCORRECT") for Option 3 with examples ending with a full-stop>
@@ -142,7 +142,7 @@ Example formatting:
 - b. <Option 2: Not more than 10 words ending with a full-stop. Do not use "all of the above" as an option.>
 - c. <Option 3: Not more than 10 words ending with a full-stop. Do not use "all of the above" as an option.>
 - d. <Option 4: Not more than 10 words ending with a full-stop. Do not use "all of the above" as an option.>
-### Feedback for Question 5:
+### Feedback for Question 3:
 - a. <Detailed feedback (including "CORRECT" or "INCORRECT") for Option 1 with examples ending with a full-stop>
 - b. <Detailed feedback (including "CORRECT" or "INCORRECT") for Option 2 with examples ending with a full-stop>
 - c. <Detailed feedback (including "CORRECT" or "INCORRECT") for Option 3 with examples ending with a full-stop>
@@ -174,6 +174,35 @@ PROMPT_TEMPLATE_MAPPING = {
     "Content Generation": CONTENT_GENERATION_PROMPT,
 }
 
+# Retrieval settings per prompt template, overriding RETRIEVAL_SEARCH_TYPE, MMR_FETCH_K and MMR_LAMBDA_MULT.
+# Add "search_type": "mmr" to a template to opt in to MMR, its fetch_k and lambda_mult then apply: questions favour
+# the most relevant chunks, generated documents favour covering more of the sources.
+PROMPT_RETRIEVAL_SETTINGS = {
+    "Question Answer": {"fetch_k": 12, "lambda_mult": 0.7},
+    "Lesson Plan": {"fetch_k": 30, "lambda_mult": 0.4},
+    "Multiple Choice Question": {"fetch_k": 20, "lambda_mult": 0.5},
+    "Content Generation": {"fetch_k": 30, "lambda_mult": 0.3},
+}
+
+# Generation settings per prompt template, see generation_limits.py. Answers end after max_new_tokens, before a stop
+# string, or once their structured answer is complete: "json" when the top-level JSON object closes, "mcq" when the
+# feedback of the last question is written. "[INST]" starts a new turn the model should not write. The llama.cpp
+# models decode under the "grammar" of the structured answer, see structured_output.py. Templates without a
+# max_new_tokens may generate up to GENERATION_MAX_NEW_TOKENS, the whole context window.
+PROMPT_GENERATION_SETTINGS = {
+    "No Prompt": {"max_new_tokens": 1024, "stop": ["[INST]"]},
+    "Question Answer": {"max_new_tokens": 512, "stop": ["[INST]", "\nUser:"]},
+    "Lesson Plan": {"max_new_tokens": 3072, "stop": ["[INST]"], "complete_on": "json", "grammar": "lesson_plan"},
+    "Multiple Choice Question": {
+        "max_new_tokens": 1536,
+        "stop": ["[INST]", "# TAXONOMY 4"],
+        "complete_on": "mcq",
+        "grammar": "mcq",
+    },
+    # Articles of about 2,000 words, some 2,700 tokens, take most of the context window
+    "Content Generation": {"stop": ["[INST]"]},
+}
+
 def get_prompt_template(system_prompt=DEFAULT_PROMPT, promptTemplate_type=None, history=False):
     if promptTemplate_type == "llama":
         B_INST, E_INST = "[INST]", "[/INST]"
@@ -0,0 +1,669 @@
+"""
+This module implements the retrieval layer shared by the API and the ingestion scripts.
+
+Retrieval results are cached per collection so that regenerate clicks and template changes, which re-run the
+exact same search, skip the vector search and the sqlite reads entirely. Every ingest job bumps a persisted
+generation counter for the collection it writes to, which invalidates the cached results of that collection
+without having to track individual entries.
+
+Classes:
+- CollectionGenerations: Per-collection generation counters persisted next to the databases.
+- QueryEmbeddingCache: Small LRU memo of query embeddings so a query is embedded once per request.
+- RetrievalCache: LRU cache of (collection, generation, query vector bucket, k) -> (chunk id, score, document).
+- CollectionRetriever: LangChain retriever over a Chroma collection that consults the retrieval cache.
+  Supports plain similarity search and maximal marginal relevance (MMR) search, both optionally pre-filtered by
+  a Chroma where clause (see metadata_filters.py).
+- FederatedRetriever: LangChain retriever that searches several collections concurrently and merges one top-k.
+
+Both retrievers expand the matched child chunks to their parent windows when the collection has a chunk store.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Optional
+
+import chromadb.errors
+import numpy as np
+from langchain.callbacks.manager import CallbackManagerForRetrieverRun
+from langchain.docstore.document import Document
+from langchain.schema import BaseRetriever
+
+from chroma_store import release_store, resident_bytes
+from chunk_store import expand_to_parents
+from constants import (
+    FEDERATED_SEARCH_THREADS,
+    GENERATIONS_FILE,
+    MMR_FETCH_K,
+    MMR_LAMBDA_MULT,
+    QUERY_EMBEDDING_CACHE_MAX_ENTRIES,
+    RETRIEVAL_CACHE_BUCKET_DECIMALS,
+    RETRIEVAL_CACHE_MAX_ENTRIES,
+    RETRIEVAL_SEARCH_TYPE,
+)
+
+
+# Thread pool shared by every federated search, vector search and sqlite reads release the GIL
+_SEARCH_POOL = ThreadPoolExecutor(max_workers=FEDERATED_SEARCH_THREADS, thread_name_prefix="federated-search")
+
+
+@contextmanager
+def _file_lock(path: str, timeout: float = 10.0):
+    """
+    Hold an exclusive lock file so that concurrent ingest processes do not lose counter updates.
+
+    Args:
+        path (str): The path of the lock file.
+        timeout (float): Number of seconds after which a stale lock file is removed.
+    """
+    started = time.monotonic()
+    while True:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            # Remove a lock left behind by a crashed process
+            if time.monotonic() - started > timeout:
+                os.remove(path)
+                continue
+            time.sleep(0.05)
+    try:
+        yield
+    finally:
+        os.close(fd)
+        os.remove(path)
+
+
+class CollectionGenerations:
+    def __init__(self, path: str = GENERATIONS_FILE):
+        """
+        Initializes the generation counters stored in a JSON file.
+
+        Args:
+            path (str): The path of the JSON file holding the counters.
+        """
+        self.path = path
+        self._counters: dict[str, int] = {}
+        self._signature: Optional[tuple] = None
+        self._lock = threading.Lock()
+
+    def _read(self) -> dict[str, int]:
+        try:
+            with open(self.path, encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, collection: str) -> int:
+        """
+        Get the current generation of a collection, reloading the file only when it changed on disk.
+
+        Args:
+            collection (str): The name of the collection.
+
+        Returns:
+            int: The generation of the collection, 0 if it was never ingested.
+        """
+        # Every bump replaces the file, which gives it a new inode even when the mtime resolution is coarse
+        try:
+            stat = os.stat(self.path)
+            signature = (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+        except OSError:
+            signature = None
+
+        with self._lock:
+            if signature != self._signature:
+                self._counters = self._read() if signature is not None else {}
+                self._signature = signature
+            return self._counters.get(collection, 0)
+
+    def bump(self, collection: str) -> int:
+        """
+        Increment the generation of a collection after it has been written to.
+
+        The new value is never lower than the current time in nanoseconds, so that counters cannot be reused
+        when the DB folder, and this file with it, is deleted and recreated.
+
+        Args:
+            collection (str): The name of the collection.
+
+        Returns:
+            int: The new generation of the collection.
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with _file_lock(self.path + ".lock"):
+            counters = self._read()
+            counters[collection] = max(counters.get(collection, 0) + 1, time.time_ns())
+
+            # Write to a temporary file first so that readers never see a partial file
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as file:
+                json.dump(counters, file)
+            os.replace(tmp_path, self.path)
+
+        return counters[collection]
+
+
+class QueryEmbeddingCache:
+    def __init__(self, embeddings, max_entries: int = QUERY_EMBEDDING_CACHE_MAX_ENTRIES):
+        """
+        Initializes the query embedding memo.
+
+        Args:
+            embeddings: The LangChain embeddings used to embed queries.
+            max_entries (int): Maximum number of query embeddings kept.
+        """
+        self.embeddings = embeddings
+        self.max_entries = max_entries
+        self._vectors: OrderedDict[str, list[float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def embed(self, text: str) -> list[float]:
+        """
+        Embed a query, reusing the embedding of an identical recent query.
+
+        Args:
+            text (str): The query text.
+
+        Returns:
+            list[float]: The query embedding.
+        """
+        with self._lock:
+            if text in self._vectors:
+                self._vectors.move_to_end(text)
+                return self._vectors[text]
+
+        vector = self.embeddings.embed_query(text)
+
+        with self._lock:
+            self._vectors[text] = vector
+            while len(self._vectors) > self.max_entries:
+                self._vectors.popitem(last=False)
+        return vector
+
+
+class RetrievalCache:
+    def __init__(
+        self,
+        max_entries: int = RETRIEVAL_CACHE_MAX_ENTRIES,
+        bucket_decimals: int = RETRIEVAL_CACHE_BUCKET_DECIMALS,
+    ):
+        """
+        Initializes an empty retrieval cache.
+
+        Args:
+            max_entries (int): Maximum number of cached searches before the least recently used are evicted.
+            bucket_decimals (int): Number of decimals the normalised query vector is rounded to when bucketing.
+        """
+        self.max_entries = max_entries
+        self.bucket_decimals = bucket_decimals
+        self._results: OrderedDict[tuple, list[tuple[str, float, Document]]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def bucket(self, query_vector) -> str:
+        """
+        Map a query vector to its bucket, so that numerically identical queries share cache entries.
+
+        Args:
+            query_vector: The query embedding.
+
+        Returns:
+            str: A hash of the rounded, normalised query vector.
+        """
+        vector = np.asarray(query_vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector = vector / norm
+        # Adding 0.0 turns negative zeros into positive ones so that they hash the same
+        rounded = np.round(vector, self.bucket_decimals) + 0.0
+        return hashlib.blake2b(rounded.tobytes(), digest_size=16).hexdigest()
+
+    def get(self, key: tuple) -> Optional[list[tuple[str, float, Document]]]:
+        """
+        Get the cached results of a search.
+
+        Args:
+            key (tuple): The key built from the collection, its generation, the query bucket and the search options.
+
+        Returns:
+            Optional[list[tuple[str, float, Document]]]: The cached (chunk id, score, document) triples, or None.
+        """
+        with self._lock:
+            results = self._results.get(key)
+            if results is None:
+                self._misses += 1
+                return None
+            self._results.move_to_end(key)
+            self._hits += 1
+            return list(results)
+
+    def put(self, key: tuple, results: list[tuple[str, float, Document]]) -> None:
+        """
+        Store the results of a search.
+
+        Args:
+            key (tuple): The key built from the collection, its generation, the query bucket and the search options.
+            results (list[tuple[str, float, Document]]): The (chunk id, score, document) triples.
+        """
+        with self._lock:
+            self._results[key] = list(results)
+            self._results.move_to_end(key)
+            while len(self._results) > self.max_entries:
+                self._results.popitem(last=False)
+
+    def invalidate(self, collection: Optional[str] = None) -> None:
+        """
+        Drop the cached results of a collection, or of every collection.
+
+        Stale generations are never looked up again, so this only frees memory early.
+
+        Args:
+            collection (Optional[str]): The collection to drop. Drops everything when None.
+        """
+        with self._lock:
+            if collection is None:
+                self._results.clear()
+                return
+            for key in [key for key in self._results if key[0] == collection]:
+                del self._results[key]
+
+    def stats(self) -> dict[str, int]:
+        """
+        Report the size and hit counters of the cache.
+
+        Returns:
+            dict[str, int]: The number of entries, hits and misses.
+        """
+        with self._lock:
+            return {"entries": len(self._results), "hits": self._hits, "misses": self._misses}
+
+
+def distance_to_similarity(distance: float) -> float:
+    """
+    Convert a Chroma distance into a cosine similarity.
+
+    Chroma returns squared L2 distances, and the embedding models used here produce unit-length vectors,
+    for which the squared L2 distance equals 2 - 2 * cosine similarity.
+
+    Args:
+        distance (float): The squared L2 distance returned by Chroma.
+
+    Returns:
+        float: The cosine similarity, 1.0 being an exact match.
+    """
+    return 1.0 - distance / 2.0
+
+
+def normalise_rows(matrix: np.ndarray) -> np.ndarray:
+    """
+    Scale every row of a matrix to unit length, leaving zero rows untouched.
+
+    Args:
+        matrix (np.ndarray): The matrix to normalise.
+
+    Returns:
+        np.ndarray: The normalised matrix.
+    """
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def mmr_select(query_vector, candidate_vectors, k: int, lambda_mult: float = MMR_LAMBDA_MULT) -> list[int]:
+    """
+    Pick k candidates by maximal marginal relevance.
+
+    Each step picks the candidate maximising lambda * similarity to the query - (1 - lambda) * highest similarity
+    to an already picked candidate. The candidate vectors are normalised once, and the highest similarity to the
+    picked candidates is updated with one matrix-vector product per step, so the cost is O(k * fetch_k * dim).
+
+    Args:
+        query_vector: The query embedding.
+        candidate_vectors: The embeddings of the candidates, one row per candidate.
+        k (int): Number of candidates to pick.
+        lambda_mult (float): 1.0 ranks by relevance only, 0.0 by diversity only.
+
+    Returns:
+        list[int]: The indices of the picked candidates, in the order they were picked.
+    """
+    candidates = normalise_rows(np.asarray(candidate_vectors, dtype=np.float32))
+    if len(candidates) == 0:
+        return []
+    query = np.asarray(query_vector, dtype=np.float32)
+    query = query / (np.linalg.norm(query) or 1.0)
+
+    relevance = candidates @ query
+    # Highest similarity of every candidate to the picked ones, nothing is picked yet
+    redundancy = np.zeros(len(candidates), dtype=np.float32)
+    available = np.ones(len(candidates), dtype=bool)
+
+    picked: list[int] = []
+    for _ in range(min(k, len(candidates))):
+        scores = lambda_mult * relevance - (1.0 - lambda_mult) * redundancy
+        scores[~available] = -np.inf
+        index = int(np.argmax(scores))
+        picked.append(index)
+        available[index] = False
+
+        similarity = candidates @ candidates[index]
+        redundancy = similarity if len(picked) == 1 else np.maximum(redundancy, similarity)
+
+    return picked
+
+
+def _combine_where(*clauses: Optional[dict]) -> Optional[dict]:
+    # Chroma requires at least two conditions in an $and
+    clauses = [clause for clause in clauses if clause]
+    if len(clauses) <= 1:
+        return clauses[0] if clauses else None
+    return {"$and": list(clauses)}
+
+
+# Errors of a query asking for more neighbours than the collection or its filter hold, by chromadb version. hnswlib
+# raises a RuntimeError when a filter leaves fewer elements than n_results
+_NOT_ENOUGH_ELEMENTS_ERRORS = tuple(
+    getattr(chromadb.errors, name)
+    for name in ("NotEnoughElementsException", "InvalidArgumentError")
+    if hasattr(chromadb.errors, name)
+) + (RuntimeError,)
+_NOT_ENOUGH_ELEMENTS_MESSAGE = re.compile(r"contig|number of (?:elements|results)|n_results", re.IGNORECASE)
+
+
+def _not_enough_elements(error: Exception) -> bool:
+    # Other errors, e.g. a malformed where clause or a missing collection, must not pass for an empty result
+    if type(error).__name__ == "NotEnoughElementsException":
+        return True
+    return isinstance(error, _NOT_ENOUGH_ELEMENTS_ERRORS) and bool(_NOT_ENOUGH_ELEMENTS_MESSAGE.search(str(error)))
+
+
+def _query_collection(collection, query_vector, n: int, where: Optional[dict], include: list[str]) -> Optional[dict]:
+    try:
+        return collection.query(query_embeddings=[list(query_vector)], n_results=n, where=where, include=include)
+    except Exception as e:
+        if not _not_enough_elements(e):
+            logging.exception(f"Query of collection {getattr(collection, 'name', '')} failed")
+            raise
+
+    # The HNSW index cannot return more neighbours than the filter, or a small delta segment, allows
+    allowed = len(collection.get(where=where, include=[])["ids"])
+    if allowed == 0:
+        return None
+    return collection.query(
+        query_embeddings=[list(query_vector)], n_results=min(n, allowed), where=where, include=include
+    )
+
+
+class CollectionRetriever(BaseRetriever):
+    """
+    Retriever over a single Chroma collection, with cached results.
+    """
+
+    vectorstore: Any
+    collection_name: str
+    embedder: Any
+    cache: Optional[Any] = None
+    generations: Optional[Any] = None
+    k: int = 4
+    search_type: str = RETRIEVAL_SEARCH_TYPE
+    fetch_k: int = MMR_FETCH_K
+    lambda_mult: float = MMR_LAMBDA_MULT
+    # Chroma where clause resolved through the metadata index before the vectors are scored
+    where: Optional[dict] = None
+    # Parent spans the matched child chunks are expanded to, None to return the chunks as is
+    chunk_store: Optional[Any] = None
+    # Columnar store holding the chunk text and metadata, None when Chroma holds them
+    text_store: Optional[Any] = None
+    # Index version directory the vector store was opened from
+    persist_directory: str = ""
+    # (vector store, tombstone where clause) of every delta segment, and the tombstone where clause of the base
+    segments: list = []
+    tombstone_where: Optional[dict] = None
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _query(self, query_vector, n: int, include: list[str]) -> Optional[dict]:
+        # Query the base collection and every delta segment, hiding the tombstoned chunks of each
+        parts = [(self.vectorstore, self.tombstone_where)] + list(self.segments)
+        responses = [
+            _query_collection(vectorstore._collection, query_vector, n, _combine_where(self.where, hidden), include)
+            for vectorstore, hidden in parts
+        ]
+        responses = [response for response in responses if response is not None]
+        if len(responses) <= 1:
+            return responses[0] if responses else None
+
+        # Keep the n closest chunks over all segments, in the shape of a single query response
+        rows = sorted(
+            (row for response in responses for row in zip(*(response[key][0] for key in ["ids"] + include))),
+            key=lambda row: row[1 + include.index("distances")],
+        )[:n]
+        columns = list(zip(*rows)) if rows else [()] * (1 + len(include))
+        return {key: [list(column)] for key, column in zip(["ids"] + include, columns)}
+
+    def _documents(self, response: dict) -> list[Document]:
+        # Chunk text and metadata come from the columnar store, or from Chroma for collections ingested before it
+        stored = self.text_store.get(response["ids"][0]) if self.text_store is not None else {}
+        return [
+            stored.get(chunk_id) or Document(page_content=text or "", metadata=metadata or {})
+            for chunk_id, text, metadata in zip(
+                response["ids"][0], response["documents"][0], response["metadatas"][0]
+            )
+        ]
+
+    def release(self) -> bool:
+        """
+        Unload the HNSW indexes of the base collection and of every delta segment from the Chroma client.
+
+        Returns:
+            bool: False when the Chroma client keeps them loaded, see chroma_store.segments_releasable.
+        """
+        stores = [self.vectorstore] + [segment for segment, _ in self.segments]
+        return all([release_store(vectorstore) for vectorstore in stores])
+
+    def resident_bytes(self) -> Optional[int]:
+        """
+        Estimate the memory held by the loaded HNSW indexes of the base collection and of every delta segment.
+
+        Returns:
+            Optional[int]: The estimated size in bytes, None when it cannot be measured.
+        """
+        sizes = [resident_bytes(vectorstore) for vectorstore in [self.vectorstore] + [s for s, _ in self.segments]]
+        return None if None in sizes else sum(sizes)
+
+    def candidates_by_vector(self, query_vector, n: int) -> list[tuple[str, float, Document, list[float]]]:
+        """
+        Fetch the chunks closest to a query embedding together with their stored embeddings.
+
+        Args:
+            query_vector: The query embedding.
+            n (int): Number of chunks to fetch.
+
+        Returns:
+            list[tuple[str, float, Document, list[float]]]: The (chunk id, similarity, document, embedding)
+            tuples, best first.
+        """
+        response = self._query(query_vector, n, ["documents", "metadatas", "distances", "embeddings"])
+        if response is None:
+            return []
+
+        return [
+            (chunk_id, distance_to_similarity(distance), document, embedding)
+            for chunk_id, document, distance, embedding in zip(
+                response["ids"][0], self._documents(response), response["distances"][0], response["embeddings"][0]
+            )
+        ]
+
+    def search_by_vector(self, query_vector, k: Optional[int] = None) -> list[tuple[str, float, Document]]:
+        """
+        Search the collection for the chunks closest to a query embedding, or for the most relevant and
+        diverse ones when the search type is "mmr".
+
+        Args:
+            query_vector: The query embedding.
+            k (Optional[int]): Number of chunks to return. Defaults to the retriever's k.
+
+        Returns:
+            list[tuple[str, float, Document]]: The (chunk id, similarity, document) triples, best first.
+        """
+        k = k or self.k
+
+        # Look up the cache under the current generation of the collection
+        key = None
+        if self.cache is not None:
+            generation = self.generations.get(self.collection_name) if self.generations is not None else 0
+            key = (self.collection_name, generation, self.cache.bucket(query_vector), k)
+            if self.search_type == "mmr":
+                key += ("mmr", self.fetch_k, self.lambda_mult)
+            if self.where:
+                key += (json.dumps(self.where, sort_keys=True),)
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+
+        if self.search_type == "mmr":
+            # Re-rank the stored embeddings of the fetch_k closest chunks, nothing is embedded again
+            candidates = self.candidates_by_vector(query_vector, max(self.fetch_k, k))
+            picked = mmr_select(query_vector, [candidate[3] for candidate in candidates], k, self.lambda_mult)
+            results = [candidates[index][:3] for index in picked]
+            if key is not None:
+                self.cache.put(key, results)
+            return results
+
+        response = self._query(query_vector, k, ["documents", "metadatas", "distances"])
+        if response is None:
+            return []
+
+        results = [
+            (chunk_id, distance_to_similarity(distance), document)
+            for chunk_id, document, distance in zip(
+                response["ids"][0], self._documents(response), response["distances"][0]
+            )
+        ]
+
+        if key is not None:
+            self.cache.put(key, results)
+        return results
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list[Document]:
+        query_vector = self.embedder.embed(query)
+        documents = [document for _, _, document in self.search_by_vector(query_vector)]
+        if self.chunk_store is None:
+            return documents
+        return expand_to_parents(documents, lambda document: self.chunk_store)
+
+
+def merge_results(
+    results_per_collection: dict[str, list[tuple[str, float, Document]]], k: int
+) -> list[tuple[str, float, Document]]:
+    """
+    Merge the results of several collections into a single top-k without duplicates.
+
+    Every collection is embedded with the same model and scored with the same cosine similarity, so the scores
+    are rescaled from [-1, 1] to [0, 1] rather than normalised per collection, which would rank the best chunk of
+    an unrelated collection as high as the best chunk of the relevant one.
+
+    Args:
+        results_per_collection (dict[str, list[tuple[str, float, Document]]]): The results of each collection.
+        k (int): Number of chunks to return.
+
+    Returns:
+        list[tuple[str, float, Document]]: The merged (chunk id, score, document) triples, best first. The
+        documents are copies whose metadata also names the database they come from.
+    """
+    best: dict[str, tuple[str, float, Document]] = {}
+
+    for collection, results in results_per_collection.items():
+        for chunk_id, score, document in results:
+            normalised = (score + 1.0) / 2.0
+            # The same file ingested in several folders produces identical chunks, keep the best scoring one
+            fingerprint = hashlib.blake2b(document.page_content.encode("utf-8"), digest_size=16).hexdigest()
+            if fingerprint in best and best[fingerprint][1] >= normalised:
+                continue
+            # Copy the document, the original may be shared with the retrieval cache
+            metadata = {**document.metadata, "database": collection}
+            merged = Document(page_content=document.page_content, metadata=metadata)
+            best[fingerprint] = (chunk_id, normalised, merged)
+
+    return sorted(best.values(), key=lambda result: result[1], reverse=True)[:k]
+
+
+class FederatedRetriever(BaseRetriever):
+    """
+    Retriever searching several collections concurrently and merging their results.
+    """
+
+    retrievers: list[Any]
+    embedder: Any
+    k: int = 4
+    search_type: str = RETRIEVAL_SEARCH_TYPE
+    fetch_k: int = MMR_FETCH_K
+    lambda_mult: float = MMR_LAMBDA_MULT
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def search_by_vector(self, query_vector, k: Optional[int] = None) -> list[tuple[str, float, Document]]:
+        """
+        Search every collection for the chunks closest to a query embedding.
+
+        Args:
+            query_vector: The query embedding.
+            k (Optional[int]): Number of chunks to return. Defaults to the retriever's k.
+
+        Returns:
+            list[tuple[str, float, Document]]: The merged (chunk id, score, document) triples, best first.
+        """
+        k = k or self.k
+
+        if self.search_type == "mmr":
+            return self._mmr_search(query_vector, k)
+
+        # Fan out one search per collection, each one asking for the full k so the merge stays exact
+        futures = {
+            retriever.collection_name: _SEARCH_POOL.submit(retriever.search_by_vector, query_vector, k)
+            for retriever in self.retrievers
+        }
+        return merge_results({name: future.result() for name, future in futures.items()}, k)
+
+    def _mmr_search(self, query_vector, k: int) -> list[tuple[str, float, Document]]:
+        # Fetch the candidates of every collection concurrently, then pick the diverse top-k across all of them
+        futures = {
+            retriever.collection_name: _SEARCH_POOL.submit(
+                retriever.candidates_by_vector, query_vector, max(self.fetch_k, k)
+            )
+            for retriever in self.retrievers
+        }
+
+        candidates: dict[str, tuple[str, float, Document, list[float]]] = {}
+        for collection, future in futures.items():
+            for chunk_id, score, document, embedding in future.result():
+                # Identical chunks ingested in several folders are kept once, as in merge_results
+                fingerprint = hashlib.blake2b(document.page_content.encode("utf-8"), digest_size=16).hexdigest()
+                normalised = (score + 1.0) / 2.0
+                if fingerprint in candidates and candidates[fingerprint][1] >= normalised:
+                    continue
+                merged = Document(
+                    page_content=document.page_content, metadata={**document.metadata, "database": collection}
+                )
+                candidates[fingerprint] = (chunk_id, normalised, merged, embedding)
+
+        ordered = list(candidates.values())
+        picked = mmr_select(query_vector, [candidate[3] for candidate in ordered], k, self.lambda_mult)
+        return [ordered[index][:3] for index in picked]
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list[Document]:
+        query_vector = self.embedder.embed(query)
+        documents = [document for _, _, document in self.search_by_vector(query_vector)]
+        # Every merged document names the database, and so the chunk store, it comes from
+        stores = {retriever.collection_name: retriever.chunk_store for retriever in self.retrievers}
+        return expand_to_parents(documents, lambda document: stores.get(document.metadata.get("database")))
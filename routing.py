@@ -0,0 +1,200 @@
+"""
+This module implements automatic database routing for prompts that do not name a database.
+
+At ingest time a few representative vectors are stored next to every collection: the normalised centroid of
+its chunk embeddings plus a sample of the chunk embeddings themselves. At query time the query embedding is
+scored against the representative vectors of every collection in a single matrix product, and only the best
+matching collections are searched.
+
+Functions:
+- build_routing_vectors(embeddings, sample_size): Computes the representative vectors of a collection.
+- write_routing_vectors(db, persist_directory): Stores the representative vectors of an ingested collection.
+
+Classes:
+- CollectionRouter: Picks the top-m collections for a query embedding.
+
+Command-line Options:
+- --db_directory: Builds the routing vectors of a single database instead of every database in DATABASE_MAPPING.
+"""
+
+import logging
+import os
+import threading
+from typing import Optional
+
+import click
+import numpy as np
+from langchain.vectorstores import Chroma
+
+from constants import (
+    DATABASE_MAPPING,
+    PERSIST_DIRECTORY,
+    ROUTING_MIN_SIMILARITY,
+    ROUTING_SAMPLE_SIZE,
+    ROUTING_TOP_M,
+    ROUTING_VECTORS_FILENAME,
+)
+from retrieval import normalise_rows
+from snapshots import current_version_dir
+from chroma_store import open_store
+
+
+def build_routing_vectors(embeddings, sample_size: int = ROUTING_SAMPLE_SIZE) -> np.ndarray:
+    """
+    Compute the representative vectors of a collection.
+
+    Args:
+        embeddings: The chunk embeddings of the collection, one row per chunk.
+        sample_size (int): Maximum number of chunk embeddings kept besides the centroid.
+
+    Returns:
+        np.ndarray: A float32 matrix whose first row is the centroid, followed by the sampled chunk embeddings.
+    """
+    matrix = normalise_rows(np.asarray(embeddings, dtype=np.float32))
+    if len(matrix) == 0:
+        return matrix
+
+    centroid = normalise_rows(matrix.mean(axis=0, keepdims=True))
+
+    # A fixed seed keeps the routing index stable between identical ingests
+    rng = np.random.default_rng(0)
+    sample = matrix[rng.choice(len(matrix), size=min(sample_size, len(matrix)), replace=False)]
+
+    return np.vstack([centroid, sample]).astype(np.float32)
+
+
+def write_routing_vectors(db: Chroma, persist_directory: str) -> Optional[str]:
+    """
+    Store the representative vectors of an ingested collection in its persist directory.
+
+    The embeddings are read back from the collection, so nothing is embedded twice.
+
+    Args:
+        db (Chroma): The vector store of the collection.
+        persist_directory (str): The directory of the collection.
+
+    Returns:
+        Optional[str]: The path of the routing vectors, or None when the collection is empty.
+    """
+    embeddings = db._collection.get(include=["embeddings"])["embeddings"]
+    if not embeddings:
+        logging.info(f"No embeddings to route to in {persist_directory}")
+        return None
+
+    path = os.path.join(persist_directory, ROUTING_VECTORS_FILENAME)
+
+    # Write next to the final file and rename it, so the API never reads a partial file
+    tmp_path = path + ".tmp.npy"
+    np.save(tmp_path, build_routing_vectors(embeddings))
+    os.replace(tmp_path, path)
+    return path
+
+
+class CollectionRouter:
+    def __init__(self, generations=None, persist_directory: str = PERSIST_DIRECTORY):
+        """
+        Initializes the router.
+
+        Args:
+            generations: The CollectionGenerations used to reload the vectors of re-ingested collections.
+            persist_directory (str): The directory holding the collections.
+        """
+        self.generations = generations
+        self.persist_directory = persist_directory
+        # Loaded routing vectors by collection name, together with the generation they were loaded at
+        self._vectors: dict[str, tuple[int, Optional[np.ndarray]]] = {}
+        self._lock = threading.Lock()
+
+    def _load(self, collection: str) -> Optional[np.ndarray]:
+        generation = self.generations.get(collection) if self.generations is not None else 0
+
+        with self._lock:
+            loaded = self._vectors.get(collection)
+            if loaded is not None and loaded[0] == generation:
+                return loaded[1]
+
+        # The routing vectors of the live index version
+        version_dir = current_version_dir(os.path.join(self.persist_directory, collection))
+        path = os.path.join(version_dir, ROUTING_VECTORS_FILENAME)
+        try:
+            vectors = np.load(path)
+        except (OSError, ValueError):
+            # Collections ingested before routing existed have no routing vectors
+            vectors = None
+
+        with self._lock:
+            self._vectors[collection] = (generation, vectors)
+        return vectors
+
+    def score(self, query_vector, collections: list[str]) -> dict[str, float]:
+        """
+        Score collections against a query embedding.
+
+        Args:
+            query_vector: The query embedding.
+            collections (list[str]): The names of the candidate collections.
+
+        Returns:
+            dict[str, float]: The best cosine similarity between the query and each collection's representative
+            vectors. Collections without routing vectors are left out.
+        """
+        names, blocks = [], []
+        for collection in collections:
+            vectors = self._load(collection)
+            if vectors is not None and len(vectors):
+                names.append(collection)
+                blocks.append(vectors)
+        if not blocks:
+            return {}
+
+        query = np.asarray(query_vector, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+
+        # One matrix product over every representative vector, then the best row of each collection
+        similarities = np.vstack(blocks) @ query
+        starts = np.cumsum([0] + [len(block) for block in blocks[:-1]])
+        best = np.maximum.reduceat(similarities, starts)
+        return dict(zip(names, best.tolist()))
+
+    def route(
+        self,
+        query_vector,
+        collections: list[str],
+        top_m: int = ROUTING_TOP_M,
+        min_similarity: float = ROUTING_MIN_SIMILARITY,
+    ) -> list[str]:
+        """
+        Pick the collections a query should be searched in.
+
+        Args:
+            query_vector: The query embedding.
+            collections (list[str]): The names of the candidate collections.
+            top_m (int): Maximum number of collections returned.
+            min_similarity (float): Minimum similarity for a collection to be picked.
+
+        Returns:
+            list[str]: The names of the picked collections, best first. Empty when nothing is relevant enough.
+        """
+        scores = self.score(query_vector, collections)
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        return [name for name, similarity in ranked[:top_m] if similarity >= min_similarity]
+
+
+@click.command()
+@click.option(
+    "--db_directory",
+    default=None,
+    help="Build the routing vectors of this database only (Default is every database)",
+)
+def main(db_directory):
+    # Build the routing vectors of databases ingested before routing existed
+    directories = [db_directory] if db_directory else list(DATABASE_MAPPING.values())
+    for directory in directories:
+        directory = current_version_dir(directory)
+        db = open_store(directory)
+        path = write_routing_vectors(db, directory)
+        print(f"{directory}: {path or 'empty collection, skipped'}")
+
+
+if __name__ == "__main__":
+    main()
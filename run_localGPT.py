@@ -7,23 +7,27 @@ import sys
 import subprocess
 from langchain.chains import RetrievalQA
 from langchain.embeddings import HuggingFaceInstructEmbeddings
-from langchain.llms import HuggingFacePipeline
 from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler  # for streaming response
 from langchain.callbacks.manager import CallbackManager
 
-callback_manager = CallbackManager([StreamingStdOutCallbackHandler()])
-
 from prompt_templates.prompt_template_utils import get_prompt_template as lesson_plan_template
 from prompt_templates.chat import get_prompt_template as chat_template
 from utils import get_embeddings
 
 # from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
-from langchain.vectorstores import Chroma
+from retrieval import CollectionRetriever, QueryEmbeddingCache
+from chroma_store import open_store
+from chunk_store import ChunkStore
+from columnar_store import ColumnarStore
+from snapshots import current_version_dir
 from transformers import (
     GenerationConfig,
     pipeline,
 )
 
+from batching import BatchedHuggingFaceLLM, BatchingEngine
+from generation_limits import StreamingPipelineLLM
+from speculative import SpeculativeDecoder, SpeculativeHuggingFaceLLM, load_draft_model
 from load_models import (
     load_quantized_model_awq,
     load_quantized_model_gguf_ggml,
@@ -38,11 +42,23 @@ from constants import (
     MODEL_BASENAME,
     MAX_NEW_TOKENS,
     MODELS_PATH,
-    CHROMA_SETTINGS,
     DATABASE_MAPPING,
+    BATCHING_ENABLED,
+    SPECULATIVE_DRAFT_MODEL_ID,
+    SPECULATIVE_DRAFT_MODEL_BASENAME,
 )
 
-def load_model(device_type, model_id, model_basename=None, LOGGING=logging):
+callback_manager = CallbackManager([StreamingStdOutCallbackHandler()])
+
+
+def load_model(
+    device_type,
+    model_id,
+    model_basename=None,
+    LOGGING=logging,
+    draft_model_id=SPECULATIVE_DRAFT_MODEL_ID,
+    draft_model_basename=SPECULATIVE_DRAFT_MODEL_BASENAME,
+):
     """
     Select a model for text generation using the HuggingFace library.
     If you are running this for the first time, it will download a model for you.
@@ -53,9 +69,14 @@ def load_model(device_type, model_id, model_basename=None, LOGGING=logging):
         model_id (str): Identifier of the model to load from HuggingFace's model hub.
         model_basename (str, optional): Basename of the model if using quantized models.
             Defaults to None.
+        draft_model_id (str, optional): Draft model proposing tokens for speculative decoding, a transformers model
+            for transformers models or the repository of draft_model_basename for GGUF models. Defaults to
+            SPECULATIVE_DRAFT_MODEL_ID.
+        draft_model_basename (str, optional): GGUF file of the draft model of a GGUF model. Defaults to
+            SPECULATIVE_DRAFT_MODEL_BASENAME.
 
     Returns:
-        HuggingFacePipeline: A pipeline object for text generation using the loaded model.
+        StreamingPipelineLLM: A pipeline object for text generation using the loaded model.
 
     Raises:
         ValueError: If an unsupported model or device type is provided.
@@ -65,7 +86,9 @@ def load_model(device_type, model_id, model_basename=None, LOGGING=logging):
 
     if model_basename is not None:
         if ".gguf" in model_basename.lower():
-            llm = load_quantized_model_gguf_ggml(model_id, model_basename, device_type, LOGGING)
+            llm = load_quantized_model_gguf_ggml(
+                model_id, model_basename, device_type, LOGGING, draft_model_id, draft_model_basename
+            )
             llm.streaming = True
             return llm
         elif ".ggml" in model_basename.lower():
@@ -83,19 +106,36 @@ def load_model(device_type, model_id, model_basename=None, LOGGING=logging):
     # https://huggingface.co/docs/transformers/
     # main_classes/text_generation#transformers.GenerationConfig.from_pretrained.returns
 
+    draft_model = None
+    if draft_model_id and not draft_model_basename:
+        draft_model = load_draft_model(draft_model_id, model, tokenizer)
+    if draft_model is not None:
+        # A small model proposes the tokens the model verifies in one forward pass, one prompt at a time
+        decoder = SpeculativeDecoder(model, draft_model, tokenizer)
+        logging.info(f"Local LLM Loaded with speculative decoding, {draft_model_id} drafting")
+        return SpeculativeHuggingFaceLLM(decoder=decoder, speculation=decoder.speculation)
+
+    if BATCHING_ENABLED:
+        # Concurrent prompts share one decode loop instead of running one at a time
+        engine = BatchingEngine(model, tokenizer)
+        logging.info(f"Local LLM Loaded with continuous batching of up to {engine.max_batch_size} prompts")
+        return BatchedHuggingFaceLLM(engine=engine, max_concurrency=engine.max_batch_size)
+
     # Create a pipeline for text generation
     pipe = pipeline(
         "text-generation",
         model=model,
         tokenizer=tokenizer,
-        max_length=MAX_NEW_TOKENS,
+        # Counted after the prompt, a max_length would include the prompt tokens
+        max_new_tokens=MAX_NEW_TOKENS,
         temperature=0.2,
         # top_p=0.95,
         repetition_penalty=1.15,
         generation_config=generation_config,
     )
 
-    local_llm = HuggingFacePipeline(pipeline=pipe)
+    # Streams its tokens to the callbacks, which enforce the generation limits of the prompt templates
+    local_llm = StreamingPipelineLLM(pipeline=pipe)
     logging.info("Local LLM Loaded")
 
     return local_llm
@@ -117,7 +157,7 @@ def retrieval_qa_pipline(device_type, use_history, database_choice, query_type,
 
     Notes:
     - The function uses embeddings from the HuggingFace library, either instruction-based or regular.
-    - The Chroma class is used to load a vector store containing pre-computed embeddings.
+    - The Chroma store of the chosen database is opened at its live index version.
     - The retriever fetches relevant documents or data based on a query.
     - The prompt and memory, obtained from the `get_prompt_template` function, might be used in the QA system.
     - The model is loaded onto the specified device using its ID and basename.
@@ -137,10 +177,18 @@ def retrieval_qa_pipline(device_type, use_history, database_choice, query_type,
     logging.info(f"Loaded embeddings from {EMBEDDING_MODEL_NAME}")
 
     try:
-        persist_directory = DATABASE_MAPPING[database_choice]
+        persist_directory = current_version_dir(DATABASE_MAPPING[database_choice])
         # load the vectorstore
-        db = Chroma(persist_directory=persist_directory, embedding_function=embeddings, client_settings=CHROMA_SETTINGS)
-        retriever = db.as_retriever()
+        db = open_store(persist_directory, embeddings)
+        # The chunk text is read from the columnar store of the collection, and matched children expand to parents
+        retriever = CollectionRetriever(
+            vectorstore=db,
+            collection_name=database_choice,
+            embedder=QueryEmbeddingCache(embeddings),
+            chunk_store=ChunkStore(persist_directory),
+            text_store=ColumnarStore(persist_directory),
+            persist_directory=persist_directory,
+        )
     except KeyError:
         print(f"Invalid database choice: {database_choice}. Please select with flag -d. Available choices are: {', '.join(DATABASE_MAPPING.keys())}")
         sys.exit(1)
@@ -1,18 +1,19 @@
 # Standard library imports
 import logging
 import os
-import shutil
 import subprocess
 import argparse
-import time
-from threading import Lock
-from typing import Tuple
+import json
+import math
+from collections import defaultdict
+from threading import Lock, Thread
+from typing import Optional, Tuple
 
 # Third-party library imports
 import torch
-from flask import Flask, jsonify, request, Response, abort, send_file, session
+from flask import Flask, jsonify, request, Response, abort, send_file, session, stream_with_context
 from werkzeug.utils import secure_filename
-from langchain.chains import RetrievalQA, LLMChain
+from langchain.chains.question_answering import load_qa_chain
 from langchain.embeddings import HuggingFaceInstructEmbeddings
 from langchain.vectorstores import Chroma
 
@@ -24,20 +25,52 @@ from utils import (
     error
 )
 from run_localGPT import load_model
+from answer_cache import SemanticAnswerCache
+from retrieval import (
+    CollectionGenerations,
+    CollectionRetriever,
+    FederatedRetriever,
+    QueryEmbeddingCache,
+    RetrievalCache,
+)
+from routing import CollectionRouter
+from collection_pool import CollectionPool
+from chroma_store import open_store, remove_directory
+from chunk_store import ChunkStore
+from columnar_store import ColumnarStore
+from snapshots import SnapshotManager, current_version_dir, new_version_dir, publish
+from segments import delta_dirs, load_manifest, needs_compaction, tombstone_filter
+from context_packer import context_budget, make_token_counter, merge_overlapping, pack_context
+from compression import SentenceStore, compress_documents
+from metadata_filters import build_where_filter, parse_filters
+from streaming import StreamCancelled, TokenStream, stream_events
+from scheduler import DeadlineExceeded, QueueFull, RequestCancelled, RequestScheduler
+from model_registry import ModelRegistry
+from startup import Startup
+from generation_limits import generate_within_limits, generation_profile
+from structured_output import constrain_llm
 from prompt_templates.prompt_template_utils import (
     get_prompt_template,
     PROMPT_TEMPLATE_MAPPING,
+    PROMPT_RETRIEVAL_SETTINGS,
     LESSON_PLAN_PROMPT
 )
 from constants import (
-    CHROMA_SETTINGS, 
     EMBEDDING_MODEL_NAME,  
-    DATABASE_MAPPING,
     PERSIST_DIRECTORY,
     PERSIST_DIRECTORIES, 
-    MODEL_ID, 
-    MODEL_BASENAME,
     SOURCE_DIRECTORY,
+    ANSWER_CACHE_ENABLED,
+    CONTEXT_PACKING_ENABLED,
+    COMPRESSION_ENABLED,
+    COMPRESSION_MAX_TOKENS,
+    ROUTING_AUTO_WHEN_UNSELECTED,
+    PRELOAD_COLLECTIONS,
+    SEGMENT_DELTA_INGEST,
+    SCHEDULER_BATCH_TEMPLATES,
+    SCHEDULER_CONCURRENCY,
+    DEFAULT_MODEL,
+    MODEL_TEMPLATE_MAPPING,
 )
     
 app = Flask(__name__)
@@ -46,8 +79,8 @@ app.secret_key = "LeafmanZSecretKey"
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 DOWNLOAD_PASSWORD = "12345"
 
-# Initialize a lock for handling API requests
-request_lock = Lock()
+# Initialize a lock for the scripts writing generated output files
+output_lock = Lock()
 
 # Determine the device type based on availability
 if torch.backends.mps.is_available():
@@ -64,36 +97,166 @@ logging.info(f"Running on: {DEVICE_TYPE}")
 logging.info(f"Display Source Documents set to: {SHOW_SOURCES}")
 
 
-# Initialize embeddings using HuggingFaceInstructEmbeddings
-EMBEDDINGS = HuggingFaceInstructEmbeddings(model_name=EMBEDDING_MODEL_NAME, model_kwargs={"device": DEVICE_TYPE})
+# The embedding model, the LLM and the collections load in the background, see load_embeddings and the routes
+# /api/health and /api/ready. Requests needing them are answered with a 503 until they are loaded
+STARTUP = Startup()
+EMBEDDINGS = None
 
-# Initialize retriever dictionary and debugging variables
-RETRIEVER_DICT: dict = {}
+# Initialize debugging variables
 DB_SELECTED: str = ""  # For debugging
 PROMPT_TEMPLATE_SELECTED: str = ""  # For debugging
 
-# Load the language model
-LLM = load_model(device_type=DEVICE_TYPE, model_id=MODEL_ID, model_basename=MODEL_BASENAME)
+# The language models, loaded on first use within the memory budget. The default model is loaded at startup
+MODELS = ModelRegistry(
+    lambda spec: load_model(
+        device_type=DEVICE_TYPE,
+        model_id=spec["model_id"],
+        model_basename=spec.get("model_basename"),
+        draft_model_id=spec.get("draft_model_id"),
+        draft_model_basename=spec.get("draft_model_basename"),
+    )
+)
+LLM = None
+# Queue of the prompts waiting for the LLM, served by priority within their deadline. Models batching concurrent
+# prompts generate several answers at once, the concurrency is set once the default model is loaded
+SCHEDULER = RequestScheduler(concurrency=SCHEDULER_CONCURRENCY)
+
+# Cache of generated answers, matched by query embedding similarity
+ANSWER_CACHE = SemanticAnswerCache()
+
+# Caches of query embeddings and retrieval results, invalidated through the collection generations. The embedding
+# model is set once loaded
+QUERY_EMBEDDER = QueryEmbeddingCache(EMBEDDINGS)
+RETRIEVAL_CACHE = RetrievalCache()
+GENERATIONS = CollectionGenerations()
+
+# Sentence embeddings of every database, opened on first use by context compression
+SENTENCE_STORES: dict = {}
+
+# Index versions of every database, leased by requests while re-ingests swap them
+SNAPSHOTS = SnapshotManager()
+
+# Delta ingests and compactions of a database run one at a time, they all rewrite its segments manifest
+SEGMENT_LOCKS: defaultdict = defaultdict(Lock)
+
+# Routing index picking the databases of prompts that do not select one
+ROUTER = CollectionRouter(generations=GENERATIONS)
+
+
+def make_retriever(dir_name: str, db: Chroma, persist_directory: str) -> CollectionRetriever:
+    """
+    Create the cached retriever of a database.
+
+    Args:
+        dir_name (str): The name of the database.
+        db (Chroma): The vector store of the database.
+        persist_directory (str): The index version directory the vector store was opened from.
+
+    Returns:
+        CollectionRetriever: The retriever used by the QA chains.
+    """
+    # Search the delta segments ingested since the last compaction beside the base collection
+    manifest = load_manifest(persist_directory)
+    deltas = delta_dirs(persist_directory, manifest)
+    tombstones = manifest["tombstones"] if manifest else {}
+    return CollectionRetriever(
+        vectorstore=db,
+        collection_name=dir_name,
+        embedder=QUERY_EMBEDDER,
+        cache=RETRIEVAL_CACHE,
+        generations=GENERATIONS,
+        chunk_store=ChunkStore(persist_directory, [segment_dir for _, segment_dir in deltas]),
+        text_store=ColumnarStore(persist_directory, [segment_dir for _, segment_dir in deltas]),
+        persist_directory=persist_directory,
+        segments=[
+            (open_store(segment_dir, EMBEDDINGS), tombstone_filter(tombstones, seq)) for seq, segment_dir in deltas
+        ],
+        tombstone_where=tombstone_filter(tombstones, 0),
+    )
+
 
 # Get the prompt template and memory
 prompt, memory = get_prompt_template(promptTemplate_type="mistral", history=False)
 
-# Iterate over each directory in the database mapping
-for dir_name, dir_path in DATABASE_MAPPING.items():
-    # Initialize Chroma database with embeddings and settings
-    DB = Chroma(persist_directory=dir_path, embedding_function=EMBEDDINGS, client_settings=CHROMA_SETTINGS)
-    
-    # Get the retriever from the database
-    retriever = DB.as_retriever()
-    
-    # Store the retriever in the dictionary
-    RETRIEVER_DICT[dir_name] = retriever
 
-# Sleep for a short duration to ensure all processes are ready
-time.sleep(0.2)
+def open_retriever(dir_name: str) -> CollectionRetriever:
+    """
+    Open the vector store of a database and create its retriever.
+
+    Args:
+        dir_name (str): The name of the database.
+
+    Returns:
+        CollectionRetriever: The retriever used by the QA chains.
+    """
+    # Open the live index version of the database
+    persist_directory: str = SNAPSHOTS.current(dir_name)
+
+    # Open its collection in the shared Chroma store
+    DB = open_store(persist_directory, EMBEDDINGS)
+    return make_retriever(dir_name, DB, persist_directory)
+
+
+# Databases are opened on first use, the most used ones are preloaded at startup
+RETRIEVER_DICT = CollectionPool(
+    open_retriever, closer=CollectionRetriever.release, sizer=CollectionRetriever.resident_bytes
+)
+
+
+def load_embeddings() -> None:
+    """
+    Load the embedding model of the documents and queries.
+    """
+    global EMBEDDINGS
+    EMBEDDINGS = HuggingFaceInstructEmbeddings(model_name=EMBEDDING_MODEL_NAME, model_kwargs={"device": DEVICE_TYPE})
+    QUERY_EMBEDDER.embeddings = EMBEDDINGS
+
+
+def load_default_model() -> None:
+    """
+    Load the default language model and let the queue serve as many prompts at once as it generates. Every model
+    of the registry still generates for at most its own max_concurrency requests at once.
+    """
+    global LLM
+    LLM = MODELS.load(DEFAULT_MODEL)
+    SCHEDULER.resize(getattr(LLM, "max_concurrency", SCHEDULER_CONCURRENCY))
+
+
+# Load the components concurrently, the collections need the embedding model
+STARTUP.add("embeddings", load_embeddings)
+STARTUP.add("llm", load_default_model)
+STARTUP.add(
+    "collections", lambda: RETRIEVER_DICT.preload(PRELOAD_COLLECTIONS, background=False), requires=("embeddings",)
+)
+STARTUP.start()
+
+# Components a route needs before it can serve a request (None for all of them), routes not listed need none
+ROUTE_REQUIREMENTS: dict = {
+    "prompt_route": None,
+    "prompt_stream_route": None,
+    "run_ingest_route": ("embeddings",),
+    "rollback_route": ("embeddings",),
+}
+
+
+@app.before_request
+def require_components() -> Optional[Response]:
+    """
+    Answer the requests arriving before the components they need are loaded with a 503, carrying the estimated
+    seconds until the API is ready in its Retry-After header.
+
+    Returns:
+        Optional[Response]: The 503 response, None to handle the request.
+    """
+    if request.endpoint not in ROUTE_REQUIREMENTS or STARTUP.ready(ROUTE_REQUIREMENTS[request.endpoint]):
+        return None
+    status: dict = STARTUP.status()
+    response = jsonify({"error": "The API is starting", **status})
+    response.status_code = 503
+    if status["eta_seconds"] is not None:
+        response.headers["Retry-After"] = str(max(1, math.ceil(status["eta_seconds"])))
+    return response
 
-# Open the localhost URL in the default web browser
-subprocess.run(['python', '-m', 'webbrowser', '-t', 'http://localhost:5111'])
 
 def make_tree(path: str) -> dict:
     """
@@ -119,15 +282,13 @@ def make_tree(path: str) -> dict:
         for name in lst:
             # Construct the full path of the entry
             fn = os.path.join(path, name)
-            # Check if the entry is a directory
-            if os.path.isdir(fn):
+            # Check if the entry is a directory, hidden ones such as the shared Chroma store are not databases
+            if os.path.isdir(fn) and not name.startswith("."):
                 # Add the directory to the children list
                 tree['children'].append(dict(name=name))
     
     return tree
 
-# Initialize the Flask application
-app = Flask(__name__)
 
 @app.route('/api/source_dirtree', methods=["GET"])
 def source_dirtree_api() -> jsonify:
@@ -149,6 +310,7 @@ def source_dirtree_api() -> jsonify:
     # Generate the directory tree structure and return it as a JSON response
     return jsonify(make_tree(path))
 
+
 @app.route('/api/database_dirtree', methods=["GET"])
 def database_dirtree_api() -> jsonify:
     """
@@ -169,6 +331,7 @@ def database_dirtree_api() -> jsonify:
     # Generate the directory tree structure and return it as a JSON response
     return jsonify(make_tree(path))
 
+
 @app.route("/api/delete_source", methods=["GET"])
 def delete_source_route() -> jsonify:
     """
@@ -181,19 +344,27 @@ def delete_source_route() -> jsonify:
         jsonify: A JSON response containing a message about the operation's success.
     """
     folder_names: list[str] = ["SOURCE_DOCUMENTS", "DB"]
+
+    # Close every open database before deleting its files
+    RETRIEVER_DICT.clear()
     
     for folder_name in folder_names:
         # Check if the folder exists
         if os.path.exists(folder_name):
-            # Remove the folder and all its contents
-            shutil.rmtree(folder_name)
+            # Remove the folder and all its contents, dropping the collections of the shared Chroma store
+            remove_directory(folder_name)
         
         # Recreate the folder
-        os.makedirs(folder_name)
+        os.makedirs(folder_name, exist_ok=True)
+
+    # Every cached answer and search result was generated from the deleted databases
+    ANSWER_CACHE.invalidate()
+    RETRIEVAL_CACHE.invalidate()
 
     # Return a JSON response indicating the folders were successfully deleted and recreated
     return jsonify({"message": f"Folders {folder_names} successfully deleted and recreated."})
 
+
 @app.route("/api/save_document/<directory_name>", methods=["GET", "POST"])
 def save_document_route(directory_name: str) -> tuple[str, int]:
     """
@@ -237,6 +408,7 @@ def save_document_route(directory_name: str) -> tuple[str, int]:
         # Return a success message and HTTP status code 200
         return "File saved successfully", 200
     
+
 @app.route("/api/create_folder/<folder_name>", methods=["POST"])
 def create_folder(folder_name: str) -> tuple[dict[str, str], int]:
     """
@@ -261,6 +433,7 @@ def create_folder(folder_name: str) -> tuple[dict[str, str], int]:
         # Return an error message and HTTP status code 400 if the folder already exists
         return {"message": f"Folder '{folder_name}' already exists."}, 400
 
+
 @app.route("/api/choose_prompt_template/<selected_prompt_template>", methods=["POST"])
 def chosen_prompt_template(selected_prompt_template: str) -> str:
     """
@@ -293,6 +466,7 @@ def chosen_prompt_template(selected_prompt_template: str) -> str:
     # Return the name of the selected prompt template
     return PROMPT_TEMPLATE_SELECTED
 
+
 @app.route("/api/choose_folder/<selected_folder>", methods=["POST"])
 def chosen_folder(selected_folder: str) -> str:
     """
@@ -321,33 +495,29 @@ def chosen_folder(selected_folder: str) -> str:
     # Return the name of the selected database
     return DB_SELECTED
 
+
 @app.route("/api/run_ingest/<directory_name>", methods=["GET"])
 def run_ingest_route(directory_name: str) -> Tuple[str, int]:
     """
     Endpoint to run the ingestion process for a specified directory.
 
+    Databases are ingested into a new index version. With the "mode" query argument "delta", or by default when
+    SEGMENT_DELTA_INGEST is enabled, databases that were already ingested only ingest the files changed since, into
+    a delta segment of their live version, unless the "mode" query argument is "full".
+
     Args:
         directory_name (str): The name of the directory to ingest.
 
     Returns:
         Tuple[str, int]: A message indicating the result of the operation and the HTTP status code.
     """
-    global RETRIEVER_DICT
-
     info(message=f"Device currently in use: {DEVICE_TYPE.upper()}")
 
     try:
-        # Construct the path to the directory where data will be persisted
         persist_directory_path = os.path.join(PERSIST_DIRECTORY, directory_name)
-        
-        # Check if the directory exists and remove it if it does
-        if os.path.exists(persist_directory_path):
-            try:
-                shutil.rmtree(persist_directory_path)
-            except OSError as e:
-                print(f"Error: {e.filename} - {e.strerror}.")
-        else:
-            warning(message="The directory does not exist")
+        live_directory_path = current_version_dir(persist_directory_path)
+        mode = request.args.get("mode", "delta" if SEGMENT_DELTA_INGEST else "full")
+        delta = mode == "delta" and load_manifest(live_directory_path) is not None
 
         # Prepare the command to run the ingestion script
         run_ingest_commands = ["python", "ingest.py"]
@@ -357,30 +527,40 @@ def run_ingest_route(directory_name: str) -> Tuple[str, int]:
             run_ingest_commands.append("--device_type")
             run_ingest_commands.append(DEVICE_TYPE)
         
-        # Add directory paths to the command if directory_name is provided
-        if directory_name is not None:
-            run_ingest_commands.append("--select_directory")
-            run_ingest_commands.append(os.path.join(SOURCE_DIRECTORY, directory_name))
-            run_ingest_commands.append("--db_directory")
-            run_ingest_commands.append(os.path.join(PERSIST_DIRECTORY, directory_name))
-
-        # Execute the ingestion script
-        result = subprocess.run(run_ingest_commands, capture_output=True)
-        
-        # Check if the script execution was successful
-        if result.returncode != 0:
-            return "Script execution failed: {}".format(result.stderr.decode("utf-8")), 500
-        
-        # Load the vector store
-        DB = Chroma(
-            persist_directory=persist_directory_path,
-            embedding_function=EMBEDDINGS,
-            client_settings=CHROMA_SETTINGS,
-        )
-        retriever = DB.as_retriever()
-
-        # Store the retriever in the global dictionary
-        RETRIEVER_DICT[directory_name] = retriever
+        with SEGMENT_LOCKS[directory_name]:
+            if delta:
+                # Add a delta segment to the live version, its base segment is never rewritten
+                version_directory_path = live_directory_path
+                run_ingest_commands.append("--delta")
+            else:
+                # Build the new index beside the live one, which keeps serving requests meanwhile
+                version_directory_path = new_version_dir(persist_directory_path)
+
+            # Add directory paths to the command if directory_name is provided
+            if directory_name is not None:
+                run_ingest_commands.append("--select_directory")
+                run_ingest_commands.append(os.path.join(SOURCE_DIRECTORY, directory_name))
+                run_ingest_commands.append("--db_directory")
+                run_ingest_commands.append(version_directory_path)
+
+            # Execute the ingestion script
+            result = subprocess.run(run_ingest_commands, capture_output=True)
+
+            # Check if the script execution was successful
+            if result.returncode != 0:
+                # Discard the partial version, the live one was never touched
+                if not delta:
+                    remove_directory(version_directory_path, ignore_errors=True)
+                return "Script execution failed: {}".format(result.stderr.decode("utf-8")), 500
+
+            # Swap the new version in, requests that already leased the previous one finish on it
+            if not delta:
+                publish(persist_directory_path, version_directory_path)
+            swap_version(directory_name)
+
+        # Merge the segments in the background once the deltas slow searches down
+        if delta and needs_compaction(version_directory_path):
+            Thread(target=compact_database, args=(directory_name,), daemon=True).start()
 
         success(message=f"Script executed successfully: {result.stdout.decode('utf-8')}")
 
@@ -388,20 +568,259 @@ def run_ingest_route(directory_name: str) -> Tuple[str, int]:
     except Exception as e:
         return f"Error occurred: {str(e)}", 500
 
-@app.route("/api/prompt_route", methods=["GET", "POST"])
-def prompt_route() -> Tuple[Response, int]:
+
+def compact_database(directory_name: str) -> None:
     """
-    Handle the prompt route for processing user prompts.
+    Compact the segments of the live version of a database into a new version and serve it.
+
+    Args:
+        directory_name (str): The name of the database.
+    """
+    # Ingests of the database wait for the compaction, their delta would be missing from the new version
+    with SEGMENT_LOCKS[directory_name]:
+        result = subprocess.run(
+            ["python", "segments.py", "--db_directory", os.path.join(PERSIST_DIRECTORY, directory_name)],
+            capture_output=True,
+        )
+        if result.returncode != 0:
+            warning(message=f"Compaction of '{directory_name}' failed: {result.stderr.decode('utf-8')}")
+            return
+        swap_version(directory_name)
+    success(message=f"Compacted the segments of '{directory_name}'")
+
+
+def swap_version(directory_name: str) -> None:
+    """
+    Serve the live index version of a database after it was published or rolled back.
+
+    Args:
+        directory_name (str): The name of the database.
+    """
+    # Open the live version and store its retriever in the pool
+    RETRIEVER_DICT[directory_name] = open_retriever(directory_name)
+
+    # Cached answers and search results of this database were generated from another version
+    GENERATIONS.bump(directory_name)
+    ANSWER_CACHE.invalidate(directory_name)
+    RETRIEVAL_CACHE.invalidate(directory_name)
+
+    # Delete the versions that are neither kept for rollback nor used by a request
+    SNAPSHOTS.collect(directory_name)
+
+
+@app.route("/api/rollback/<directory_name>", methods=["POST"])
+def rollback_route(directory_name: str) -> Tuple[str, int]:
+    """
+    Endpoint to make a previous index version of a database live again.
+
+    Args:
+        directory_name (str): The name of the database. The optional "version" form field names the version to
+            restore, e.g. "v3", and defaults to the version before the live one.
 
     Returns:
-        Tuple[Response, int]: JSON response containing the prompt, answer, and sources (if any), along with the HTTP status code.
+        Tuple[str, int]: A message indicating the result of the operation and the HTTP status code.
     """
-    global request_lock  # Make sure to use the global lock instance
-    global OUT_DIR
+    try:
+        version_directory_path = SNAPSHOTS.rollback(directory_name, request.form.get("version") or None)
+    except ValueError as e:
+        return str(e), 404
+    swap_version(directory_name)
+    success(message=f"Database '{directory_name}' rolled back to {os.path.basename(version_directory_path)}")
+    return f"Rolled back to {os.path.basename(version_directory_path)}", 200
+
+
+def select_databases(requested: str, raw_prompt: str) -> list[str]:
+    """
+    Resolve the databases a prompt should be answered from.
+
+    Args:
+        requested (str): Comma separated database names, "all" for every database, "auto" to route the prompt,
+            or "" for the selected database.
+        raw_prompt (str): The prompt as typed by the user, used to route it.
+
+    Returns:
+        list[str]: The names of the databases to search, empty when RAG is not used.
+
+    Raises:
+        ValueError: If the selected database no longer exists.
+    """
+    requested = requested.strip()
+    if not requested and DB_SELECTED:
+        if DB_SELECTED not in RETRIEVER_DICT:
+            raise ValueError(f"The selected database '{DB_SELECTED}' does not exist, select another one")
+        return [DB_SELECTED]
+    if requested.lower() == "all":
+        return sorted(RETRIEVER_DICT)
+    if requested.lower() == "auto" or (not requested and ROUTING_AUTO_WHEN_UNSELECTED):
+        # Search only the databases closest to the prompt
+        routed = ROUTER.route(QUERY_EMBEDDER.embed(raw_prompt), sorted(RETRIEVER_DICT))
+        info(message=f"Prompt routed to databases {routed}")
+        return routed
+
+    names = [name.strip() for name in requested.split(",") if name.strip()]
+    # Ignore databases that have not been ingested
+    for name in names:
+        if name not in RETRIEVER_DICT:
+            warning(message=f"Database '{name}' does not exist and is skipped.")
+    return [name for name in dict.fromkeys(names) if name in RETRIEVER_DICT]
+
+
+def get_retriever(
+    retrievers: dict, template: str = "", where: Optional[dict] = None, search_type: Optional[str] = None
+):
+    """
+    Get the retriever searching one or several databases.
+
+    Args:
+        retrievers (dict): The leased retrievers of the databases to search, by database name.
+        template (str): The selected prompt template, whose retrieval settings are applied.
+        where (Optional[dict]): Chroma where clause restricting the searched chunks.
+        search_type (Optional[str]): "similarity" or "mmr", overriding the template's.
+
+    Returns:
+        The retriever of the database, a FederatedRetriever over several databases, or None without databases.
+    """
+    if not retrievers:
+        return None
+    settings: dict = dict(PROMPT_RETRIEVAL_SETTINGS.get(template, {}))
+    if search_type:
+        settings["search_type"] = search_type
+    if len(retrievers) == 1:
+        # Shallow copy, the pooled retriever is shared with concurrent requests using other templates
+        return next(iter(retrievers.values())).copy(update={**settings, "where": where})
+    return FederatedRetriever(
+        retrievers=[retriever.copy(update={"where": where}) for retriever in retrievers.values()],
+        embedder=QUERY_EMBEDDER,
+        **settings,
+    )
+
+
+def sentence_store(dir_name: str) -> SentenceStore:
+    """
+    Get the sentence embeddings of a database, used by context compression.
+
+    Args:
+        dir_name (str): The name of the database.
+
+    Returns:
+        SentenceStore: The sentence store of the database.
+    """
+    # One store per index version, a re-ingest publishes new sentence embeddings with its version
+    persist_directory: str = SNAPSHOTS.current(dir_name)
+    if persist_directory not in SENTENCE_STORES:
+        SENTENCE_STORES[persist_directory] = SentenceStore(persist_directory)
+    return SENTENCE_STORES[persist_directory]
+
+
+def answer_with_context(
+    llm, user_prompt: str, retriever, prompt, profile: dict, callbacks=None, on_sources=None
+) -> Tuple[str, list]:
+    """
+    Answer a prompt with the "stuff" chain, packing the retrieved documents into the context window.
+
+    Args:
+        llm: The LangChain LLM generating the answer.
+        user_prompt (str): The prompt, already wrapped for the selected prompt template.
+        retriever: The retriever of the databases to answer from.
+        prompt: The prompt template of the chain, with "context" and "question" variables.
+        profile (dict): The generation profile, whose limits end the answer.
+        callbacks: LangChain callback handlers of the generation, e.g. a TokenStream.
+        on_sources: Called with the documents placed in the context before the answer is generated.
+
+    Returns:
+        Tuple[str, list]: The generated answer and the documents placed in the context.
+    """
+    docs = retriever.get_relevant_documents(user_prompt)
+    count_tokens = make_token_counter(llm)
+    budget: int = context_budget(prompt, user_prompt, count_tokens)
+    if COMPRESSION_ENABLED:
+        # Keep only the sentences closest to the prompt, federated searches name the database of every document
+        database: str = getattr(retriever, "collection_name", "")
+        docs = compress_documents(
+            QUERY_EMBEDDER.embed(user_prompt),
+            merge_overlapping(docs),
+            min(budget, COMPRESSION_MAX_TOKENS),
+            count_tokens,
+            EMBEDDINGS,
+            lambda document: sentence_store(document.metadata.get("database", database)),
+        )
+    if CONTEXT_PACKING_ENABLED:
+        # Merge overlapping chunks and keep what fits next to the prompt and the generated answer
+        docs = pack_context(docs, budget, count_tokens)
+    if on_sources and SHOW_SOURCES:
+        on_sources(docs)
+    chain = load_qa_chain(llm, chain_type="stuff", prompt=prompt)
+    answer: str = generate_within_limits(
+        lambda handlers: chain({"input_documents": docs, "question": user_prompt}, callbacks=handlers)["output_text"],
+        profile,
+        callbacks,
+    )
+    return answer, docs if SHOW_SOURCES else []
+
+
+def generate_answer(
+    llm, user_prompt: str, retriever=None, callbacks=None, on_sources=None, profile: Optional[dict] = None
+) -> Tuple[str, list]:
+    """
+    Run the LLM for a prompt using the selected databases and prompt template.
+
+    Args:
+        llm: The LangChain LLM generating the answer.
+        user_prompt (str): The prompt, already wrapped for the selected prompt template.
+        retriever: The retriever of the databases to answer from, or None to answer without RAG.
+        callbacks: LangChain callback handlers of the generation, e.g. a TokenStream.
+        on_sources: Called with the documents placed in the context before the answer is generated.
+        profile (Optional[dict]): The generation profile (default is the one of the selected prompt template).
+
+    Returns:
+        Tuple[str, list]: The generated answer and the source documents used (empty without RAG).
+    """
+    # Token budget, stop strings and structured answer end of the prompt template
+    profile = profile or generation_profile(PROMPT_TEMPLATE_SELECTED)
+    # The llama.cpp models decode lesson plans and questions under their grammar, so they parse on the first pass
+    llm = constrain_llm(llm, profile.get("grammar"))
+
+    # Case 1: Both a database and a prompt template are selected
+    if retriever and PROMPT_TEMPLATE_SELECTED:
+        info(message="*****************Using LLM with both RAG/OutputType*****************")
+        prompt, memory = get_prompt_template(
+            system_prompt=PROMPT_TEMPLATE_MAPPING[PROMPT_TEMPLATE_SELECTED],
+            promptTemplate_type="mistral",
+            history=False,
+        )
+        answer, docs = answer_with_context(llm, user_prompt, retriever, prompt, profile, callbacks, on_sources)
+    # Case 2: Only a database is selected
+    elif retriever:
+        warning(message="*****************Using LLM with RAG without OutputType*****************")
+        prompt, memory = get_prompt_template(promptTemplate_type="mistral", history=False)
+        answer, docs = answer_with_context(llm, user_prompt, retriever, prompt, profile, callbacks, on_sources)
+    # Case 3: Only a prompt template is selected
+    elif PROMPT_TEMPLATE_SELECTED:
+        warning(message="*****************Using LLM with OutputType without RAG*****************")
+        prompt = PROMPT_TEMPLATE_MAPPING[PROMPT_TEMPLATE_SELECTED]
+        answer = generate_within_limits(
+            lambda handlers: llm(prompt + user_prompt, callbacks=handlers), profile, callbacks
+        )
+        docs = []
+    # Case 4: Neither a database nor a prompt template is selected
+    else:
+        warning(message="*****************Using base LLM without both RAG/OutputType*****************")
+        answer = generate_within_limits(lambda handlers: llm(user_prompt, callbacks=handlers), profile, callbacks)
+        docs = []
+
+    return answer, docs
 
-    # Retrieve the user prompt from the form data
-    user_prompt: str = request.form.get("user_prompt")
 
+def wrap_user_prompt(user_prompt: str) -> str:
+    """
+    Wrap a prompt as typed by the user with the instructions of the selected prompt template.
+
+    Args:
+        user_prompt (str): The prompt as typed by the user.
+
+    Returns:
+        str: The prompt given to the LLM.
+    """
     # Modify the user prompt if the selected template is "Lesson Plan"
     if PROMPT_TEMPLATE_SELECTED == "Lesson Plan":
         user_prompt = f'Create a lesson plan on the following topic: {user_prompt}. Ensure that there are at least 2 activities per section. Be verbose on the content and provide examples.'
@@ -413,7 +832,7 @@ def prompt_route() -> Tuple[Response, int]:
 
     # Modify the user prompt if the selected template is "Content Generation"
     if PROMPT_TEMPLATE_SELECTED == "Content Generation":
-        user_prompt = f"""Write an in-depth article of at least 5,000 words on the topic of {user_prompt}, providing a comprehensive analysis that covers the background and history, current trends, key players, challenges, and future prospects. Begin with a compelling introduction that explains the relevance and importance of the topic. Delve into its origins and development, highlighting key milestones and influential figures with specific examples. Analyze the current state of the topic, discussing significant trends, technological advancements, and recent changes, supported by relevant data and case studies. Explore the roles of major contributors, organizations, or entities, illustrating their impact with real-world examples. Address the challenges, controversies, and debates surrounding the topic, elaborating on different perspectives. Conclude with a forward-looking analysis of potential future trends, innovations, and emerging ideas, providing concrete examples where possible. Throughout, ensure that each section is detailed, well-supported by examples, and written in an engaging, informative tone for a well-read audience.
+        user_prompt = f"""Write an in-depth article of about 2,000 words on the topic of {user_prompt}, providing a comprehensive analysis that covers the background and history, current trends, key players, challenges, and future prospects. Begin with a compelling introduction that explains the relevance and importance of the topic. Delve into its origins and development, highlighting key milestones and influential figures with specific examples. Analyze the current state of the topic, discussing significant trends, technological advancements, and recent changes, supported by relevant data and case studies. Explore the roles of major contributors, organizations, or entities, illustrating their impact with real-world examples. Address the challenges, controversies, and debates surrounding the topic, elaborating on different perspectives. Conclude with a forward-looking analysis of potential future trends, innovations, and emerging ideas, providing concrete examples where possible. Throughout, ensure that each section is detailed, well-supported by examples, and written in an engaging, informative tone for a well-read audience.
 
 Format the article in Markdown using the following structure:
 
@@ -429,66 +848,179 @@ Images: If including images, use the markdown syntax for embedding images (![alt
 
 Ensure the article is meticulously organized, flows logically from one section to the next, and is fully elaborated with examples, data, and expert opinions where relevant."""
 
-    # Return an error response if no user prompt is received
-    if not user_prompt:
-        return "No user prompt received", 400
+    return user_prompt
+
+
+def parse_prompt_request() -> dict:
+    """
+    Read the prompt, model, databases, filters and cache settings of a prompt request.
+
+    Returns:
+        dict: The request settings, with the cached answer under "cached" when one may be served.
+
+    Raises:
+        ValueError: If the model is unknown, the selected database no longer exists, or the filters or the
+            generation overrides are invalid.
+    """
+    # Retrieve the user prompt from the form data, keeping it as typed by the user for the answer cache
+    raw_prompt: str = request.form.get("user_prompt")
+    user_prompt: str = wrap_user_prompt(raw_prompt) if raw_prompt else raw_prompt
 
     info(message="*****************Processing prompt*****************")
     info(message=f"The selected folder is {DB_SELECTED}")
     info(message=f"The selected output is {PROMPT_TEMPLATE_SELECTED}")
 
-    with request_lock:
-        # Case 1: Both a database and a prompt template are selected
-        if DB_SELECTED and PROMPT_TEMPLATE_SELECTED:
-            info(message="*****************Using LLM with both RAG/OutputType*****************")
-            prompt, memory = get_prompt_template(system_prompt=PROMPT_TEMPLATE_MAPPING[PROMPT_TEMPLATE_SELECTED], promptTemplate_type="mistral", history=False)
-            QA = RetrievalQA.from_chain_type(
-                llm=LLM,
-                chain_type="stuff",
-                retriever=RETRIEVER_DICT[DB_SELECTED],
-                return_source_documents=SHOW_SOURCES,
-                chain_type_kwargs={"prompt": prompt},
-            )
-            res = QA(user_prompt)
-            answer, docs = res["result"], res["source_documents"]
-        # Case 2: Only a database is selected
-        elif DB_SELECTED:
-            warning(message="*****************Using LLM with RAG without OutputType*****************")
-            prompt, memory = get_prompt_template(promptTemplate_type="mistral", history=False)
-            QA = RetrievalQA.from_chain_type(
-                llm=LLM,
-                chain_type="stuff",
-                retriever=RETRIEVER_DICT[DB_SELECTED],
-                return_source_documents=SHOW_SOURCES,
-                chain_type_kwargs={"prompt": prompt},
+    # The model named by the request, e.g. model=small, else the model of the selected prompt template
+    model: str = request.form.get("model") or MODEL_TEMPLATE_MAPPING.get(PROMPT_TEMPLATE_SELECTED, DEFAULT_MODEL)
+    if model not in MODELS.names():
+        raise ValueError(f"Unknown model '{model}', expected one of {MODELS.names()}")
+    info(message=f"The selected model is {model}")
+
+    # Several databases can be searched at once, e.g. databases=ModuleA,ModuleB, databases=all or databases=auto
+    databases: list[str] = select_databases(request.form.get("databases", ""), raw_prompt or "")
+    info(message=f"The searched databases are {databases}")
+
+    # Optional metadata filters, e.g. filters={"folder": "Module3", "file_type": [".pptx", ".pdf"]}
+    where: Optional[dict] = build_where_filter(parse_filters(request.form.get("filters")))
+    filters_key: str = json.dumps(where, sort_keys=True) if where else ""
+
+    # Optional search type, e.g. search_type=mmr, else the one of the prompt template or RETRIEVAL_SEARCH_TYPE
+    search_type: str = request.form.get("search_type", "")
+    if search_type and search_type not in ("similarity", "mmr"):
+        raise ValueError(f"Unknown search_type '{search_type}', expected 'similarity' or 'mmr'")
+
+    # Optional generation overrides, e.g. max_new_tokens=256 and stop=["\n\n"] (a JSON list or one string)
+    max_new_tokens: Optional[int] = int(request.form["max_new_tokens"]) if request.form.get("max_new_tokens") else None
+    stop: str = request.form.get("stop", "")
+    stop_strings: list[str] = (
+        [str(text) for text in json.loads(stop)] if stop.startswith("[") else [stop] if stop else []
+    )
+    profile: dict = generation_profile(PROMPT_TEMPLATE_SELECTED, max_new_tokens, stop_strings)
+    overridden: bool = max_new_tokens is not None or bool(stop_strings) or bool(search_type)
+
+    # Decide whether a cached answer may be served for this request
+    bypass_cache: bool = request.form.get("bypass_cache", "").lower() in ("1", "true", "yes", "on")
+    cache_key: tuple[str, str, str] = (",".join(databases), PROMPT_TEMPLATE_SELECTED, MODELS.key(model))
+    query_vector = QUERY_EMBEDDER.embed(raw_prompt) if ANSWER_CACHE_ENABLED and raw_prompt else None
+    generation: tuple = tuple(GENERATIONS.get(name) for name in databases)
+
+    cached = None
+    # Answers generated with overrides are neither served from nor stored in the cache
+    if ANSWER_CACHE_ENABLED and raw_prompt and not bypass_cache and not overridden:
+        cached = ANSWER_CACHE.lookup(*cache_key, query_vector, generation=generation, filters=filters_key)
+    return {
+        "user_prompt": user_prompt,
+        "model": model,
+        "profile": profile,
+        "cacheable": not overridden,
+        "databases": databases,
+        "where": where,
+        "search_type": search_type or None,
+        "filters_key": filters_key,
+        "cache_key": cache_key,
+        "query_vector": query_vector,
+        "generation": generation,
+        "cached": cached,
+    }
+
+
+def submit_prompt(settings: dict):
+    """
+    Admit a parsed prompt request into the queue of the LLM.
+
+    Args:
+        settings (dict): The request settings from parse_prompt_request.
+
+    Returns:
+        Ticket: The admitted request.
+
+    Raises:
+        ValueError: If the priority or deadline of the request is invalid.
+        QueueFull: If the request is not admitted.
+    """
+    # Long generations queue behind interactive prompts unless the request names its class, e.g. priority=batch
+    priority: str = request.form.get("priority") or (
+        "batch" if PROMPT_TEMPLATE_SELECTED in SCHEDULER_BATCH_TEMPLATES else "interactive"
+    )
+    # Optional deadline in seconds, e.g. deadline=30 to give up rather than wait longer
+    deadline: Optional[float] = float(request.form["deadline"]) if request.form.get("deadline") else None
+    ticket = SCHEDULER.submit(priority, deadline)
+    info(message=f"Prompt queued as {priority}, {SCHEDULER.stats()['queued']} waiting")
+    return ticket
+
+
+def queue_full_response(e: QueueFull) -> Response:
+    """
+    Build the 429 response of a request the queue did not admit.
+
+    Args:
+        e (QueueFull): The rejection.
+
+    Returns:
+        Response: The response, with the seconds after which to retry in its Retry-After header.
+    """
+    warning(message=str(e))
+    response = jsonify({"error": str(e), "retry_after": round(e.retry_after, 1)})
+    response.status_code = 429
+    response.headers["Retry-After"] = str(math.ceil(e.retry_after))
+    return response
+
+
+def answer_prompt(settings: dict, ticket, callbacks=None, on_sources=None, cancelled=None) -> Tuple[str, list]:
+    """
+    Generate the answer of a parsed prompt request once the queue serves it, and cache it.
+
+    Args:
+        settings (dict): The request settings from parse_prompt_request.
+        ticket (Ticket): The admitted request.
+        callbacks: LangChain callback handlers of the generation, e.g. a TokenStream.
+        on_sources: Called with the documents placed in the context before the answer is generated.
+        cancelled: Event set when the client went away, the request then leaves the queue.
+
+    Returns:
+        Tuple[str, list]: The generated answer and the source documents used.
+
+    Raises:
+        DeadlineExceeded: If the request is still queued at its deadline.
+        RequestCancelled: If the request is cancelled while queued.
+    """
+    # Lease the live index versions, a concurrent re-ingest cannot delete them before the answer is generated, and
+    # the model, which is not unloaded or swapped out before then
+    with SCHEDULER.slot(ticket, cancelled), SNAPSHOTS.checkout(RETRIEVER_DICT, settings["databases"]) as retrievers:
+        with MODELS.lease(settings["model"]) as llm:
+            answer, docs = generate_answer(
+                llm,
+                settings["user_prompt"],
+                get_retriever(retrievers, PROMPT_TEMPLATE_SELECTED, settings["where"], settings["search_type"]),
+                callbacks,
+                on_sources,
+                settings["profile"],
             )
-            res = QA(user_prompt)
-            answer, docs = res["result"], res["source_documents"]
-        # Case 3: Only a prompt template is selected
-        elif PROMPT_TEMPLATE_SELECTED:
-            warning(message="*****************Using LLM with OutputType without RAG*****************")
-            prompt = PROMPT_TEMPLATE_MAPPING[PROMPT_TEMPLATE_SELECTED]
-            answer = LLM(prompt + user_prompt)
-            docs = []
-        # Case 4: Neither a database nor a prompt template is selected
-        else:
-            warning(message="*****************Using base LLM without both RAG/OutputType*****************")
-            answer = LLM(user_prompt)
-            docs = []
-
-        # Construct the response dictionary
-        prompt_response_dict: Dict[str, Any] = {
-            "Prompt": user_prompt,
-            "Answer": answer,
-        }
-
-        # Include source documents in the response if available
-        # if docs:
-        #     prompt_response_dict["Sources"] = [
-        #         (os.path.basename(str(document.metadata["source"])), str(document.page_content))
-        #         for document in docs
-        #     ]
+    if ANSWER_CACHE_ENABLED and settings["cacheable"]:
+        ANSWER_CACHE.store(
+            *settings["cache_key"],
+            settings["query_vector"],
+            answer,
+            docs,
+            generation=settings["generation"],
+            filters=settings["filters_key"],
+        )
+    return answer, docs
+
+
+def run_output_scripts(answer: str, docs: list, prompt_response_dict: dict) -> None:
+    """
+    Run the extension script of the selected prompt template on a generated answer.
+
+    Args:
+        answer (str): The generated answer.
+        docs (list): The source documents of the answer.
+        prompt_response_dict (dict): The response, completed with the sources of generated content.
+    """
+    global OUT_DIR
 
+    # The output scripts share template and output folders, run them one at a time
+    with output_lock:
         OUT_DIR = None
         # Run additional scripts based on the selected prompt template
         if PROMPT_TEMPLATE_SELECTED == "Lesson Plan":
@@ -510,8 +1042,235 @@ Ensure the article is meticulously organized, flows logically from one section t
                 print(sources_string)
             subprocess.run(["python", "./extensions/content_generation/convert.py", answer, sources_string])
             OUT_DIR = "./extensions/content_generation/outputs"
-        # Return the JSON response along with the HTTP status code
-        return jsonify(prompt_response_dict), 200
+
+
+@app.route("/api/prompt_route", methods=["GET", "POST"])
+def prompt_route() -> Tuple[Response, int]:
+    """
+    Handle the prompt route for processing user prompts.
+
+    Returns:
+        Tuple[Response, int]: JSON response containing the prompt, answer, and sources (if any), along with the HTTP status code.
+    """
+    try:
+        settings: dict = parse_prompt_request()
+    except ValueError as e:
+        return f"Invalid request: {e}", 400
+
+    # Return an error response if no user prompt is received
+    if not settings["user_prompt"]:
+        return "No user prompt received", 400
+
+    # Serve a cached answer without waiting for the LLM when possible
+    cached = settings["cached"]
+    if cached:
+        success(message=f"Answer served from cache (similarity {cached['similarity']:.3f})")
+        answer, docs = cached["answer"], cached["docs"]
+    else:
+        try:
+            ticket = submit_prompt(settings)
+        except QueueFull as e:
+            return queue_full_response(e)
+        except ValueError as e:
+            return f"Invalid priority or deadline: {e}", 400
+        try:
+            answer, docs = answer_prompt(settings, ticket)
+        except DeadlineExceeded as e:
+            warning(message=str(e))
+            return str(e), 503
+        except KeyError as e:
+            # The database was deleted after the request was accepted
+            warning(message=f"Database {e} does not exist")
+            return f"Database {e} does not exist", 404
+        except RuntimeError as e:
+            # The model of the request failed to load
+            warning(message=str(e))
+            return str(e), 503
+
+    # Construct the response dictionary
+    prompt_response_dict: Dict[str, Any] = {
+        "Prompt": settings["user_prompt"],
+        "Answer": answer,
+        "Cached": bool(cached),
+    }
+
+    # Include source documents in the response if available
+    # if docs:
+    #     prompt_response_dict["Sources"] = [
+    #         (os.path.basename(str(document.metadata["source"])), str(document.page_content))
+    #         for document in docs
+    #     ]
+
+    run_output_scripts(answer, docs, prompt_response_dict)
+    # Return the JSON response along with the HTTP status code
+    return jsonify(prompt_response_dict), 200
+
+
+@app.route("/api/prompt_route/stream", methods=["POST"])
+def prompt_stream_route() -> Response:
+    """
+    Handle a prompt like /api/prompt_route, streaming the answer as server-sent events: the sources once the
+    context is built, the tokens as they are decoded, then the response of /api/prompt_route as a "done" event.
+
+    Returns:
+        Response: The text/event-stream response.
+    """
+    try:
+        settings: dict = parse_prompt_request()
+    except ValueError as e:
+        return f"Invalid request: {e}", 400
+    if not settings["user_prompt"]:
+        return "No user prompt received", 400
+
+    # Admit the request before the stream starts, a full queue is answered with a 429
+    cached = settings["cached"]
+    ticket = None
+    if not cached:
+        try:
+            ticket = submit_prompt(settings)
+        except QueueFull as e:
+            return queue_full_response(e)
+        except ValueError as e:
+            return f"Invalid priority or deadline: {e}", 400
+
+    def work(stream: TokenStream) -> dict:
+        if cached:
+            success(message=f"Answer served from cache (similarity {cached['similarity']:.3f})")
+            answer, docs = cached["answer"], cached["docs"]
+            stream.sources(docs)
+        else:
+            try:
+                answer, docs = answer_prompt(
+                    settings, ticket, callbacks=[stream], on_sources=stream.sources, cancelled=stream.cancelled
+                )
+            except RequestCancelled:
+                raise StreamCancelled()
+        prompt_response_dict: dict = {"Prompt": settings["user_prompt"], "Answer": answer, "Cached": bool(cached)}
+        run_output_scripts(answer, docs, prompt_response_dict)
+        return prompt_response_dict
+
+    response = Response(
+        stream_with_context(stream_events(work, TokenStream())),
+        mimetype="text/event-stream",
+        # Disable caching and the buffering of reverse proxies, every event must reach the client as it is sent
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    if ticket is not None:
+        # A client gone before the stream started must not hold its place in the queue until its deadline
+        response.call_on_close(lambda: SCHEDULER.cancel(ticket))
+    return response
+
+
+@app.route("/api/health", methods=["GET"])
+def health_route() -> jsonify:
+    """
+    Liveness probe: the API process answers requests, whether or not its components are loaded.
+
+    Returns:
+        jsonify: The status and uptime of the API.
+    """
+    return jsonify({"status": "ok", "uptime_seconds": STARTUP.status()["uptime_seconds"]})
+
+
+@app.route("/api/ready", methods=["GET"])
+def ready_route() -> Tuple[Response, int]:
+    """
+    Readiness probe: the embedding model, the default LLM and the preloaded collections are loaded.
+
+    Returns:
+        Tuple[Response, int]: The state of every component and the estimated seconds until the API is ready, with
+        the HTTP status code 200 when it is ready and 503 otherwise.
+    """
+    status: dict = STARTUP.status()
+    return jsonify(status), 200 if status["ready"] else 503
+
+
+@app.route("/api/queue", methods=["GET"])
+def queue_route() -> jsonify:
+    """
+    Get the metrics of the prompt queue: queue depth per priority class, active requests, request counts, wait
+    times of the latest served requests and the estimated wait of a new request.
+
+    Returns:
+        jsonify: The queue metrics.
+    """
+    return jsonify(SCHEDULER.stats())
+
+
+@app.route("/api/models", methods=["GET"])
+def models_route() -> jsonify:
+    """
+    Get the state of the declared models: resident, loading, failed or unloaded, with the memory and active
+    requests of the resident ones.
+
+    Returns:
+        jsonify: The models and the memory budget.
+    """
+    return jsonify({"models": MODELS.status(), "memory_budget_bytes": MODELS.memory_budget_bytes})
+
+
+@app.route("/api/models/<name>/load", methods=["POST"])
+def load_model_route(name: str) -> Tuple[str, int]:
+    """
+    Load a declared model in the background, e.g. before the requests that will use it.
+
+    Args:
+        name (str): The name of the model.
+
+    Returns:
+        Tuple[str, int]: A message and the HTTP status code, 202 once loading started.
+    """
+    if name not in MODELS.names():
+        return f"Unknown model '{name}'", 404
+    MODELS.load_async(name)
+    return f"Loading model '{name}'", 202
+
+
+@app.route("/api/models/<name>", methods=["POST"])
+def replace_model_route(name: str) -> Tuple[str, int]:
+    """
+    Serve another model under a name without downtime: the new model loads in the background while the current
+    one keeps answering, then replaces it. Requests already generating finish with the previous model.
+
+    Args:
+        name (str): The name of the model, declared or new.
+
+    Returns:
+        Tuple[str, int]: A message and the HTTP status code, 202 once loading started.
+    """
+    model_id: str = request.form.get("model_id", "")
+    if not model_id:
+        return "No model_id received", 400
+    spec: dict = {
+        "model_id": model_id,
+        "model_basename": request.form.get("model_basename") or None,
+        "draft_model_id": request.form.get("draft_model_id") or None,
+        "draft_model_basename": request.form.get("draft_model_basename") or None,
+    }
+    try:
+        MODELS.replace(name, spec)
+    except RuntimeError as e:
+        return str(e), 409
+    return f"Loading {model_id} for model '{name}'", 202
+
+
+@app.route("/api/models/<name>/unload", methods=["POST"])
+def unload_model_route(name: str) -> Tuple[str, int]:
+    """
+    Unload a model once the requests using it complete, it is loaded again by the next request naming it.
+
+    Args:
+        name (str): The name of the model.
+
+    Returns:
+        Tuple[str, int]: A message and the HTTP status code.
+    """
+    if name in MODELS.pinned:
+        return f"Model '{name}' is pinned", 409
+    if not MODELS.unload(name):
+        return f"Model '{name}' is not loaded", 404
+    return f"Model '{name}' unloaded", 200
+
 
 # Password verification endpoint
 @app.route("/api/verify_password/<filename>", methods=["POST"])
@@ -526,6 +1285,7 @@ def verify_password(filename):
         # Return an error message if the password is wrong
         return jsonify({"error": "Invalid password"}), 401
 
+
 # File download endpoint
 @app.route("/api/download/<filename>", methods=["GET"])
 def download_file(filename):
@@ -556,6 +1316,7 @@ def download_file(filename):
         print(f"File not found: {DL_FILE_PATH}")
         return abort(404)  # Return 404 if file not found
 
+
 #DEBUGGER
 @app.route("/api/get_current_state", methods=["GET"])
 def get_current_state() -> jsonify:
@@ -575,6 +1336,7 @@ def get_current_state() -> jsonify:
     current_state = {
         "DEBUGGING: DB_SELECTED": DB_SELECTED,
         "DEBUGGING: PROMPT_TEMPLATE_SELECTED": PROMPT_TEMPLATE_SELECTED,
+        "DEBUGGING: OPEN_DATABASES": RETRIEVER_DICT.open_names(),
     }
 
     # Print the current state for debugging purposes
@@ -583,6 +1345,7 @@ def get_current_state() -> jsonify:
     # Return the current state as a JSON response
     return jsonify(current_state)
 
+
 def parse_arguments() -> argparse.Namespace:
     """
     Parse command-line arguments.
@@ -609,6 +1372,7 @@ def parse_arguments() -> argparse.Namespace:
     )
     return parser.parse_args()
 
+
 if __name__ == "__main__":
     # Parse command-line arguments
     args = parse_arguments()
@@ -619,5 +1383,10 @@ if __name__ == "__main__":
     #     level=logging.INFO
     # )
 
-    # Run the Flask application
+    # Open the localhost URL in the default web browser, without delaying the API
+    Thread(
+        target=subprocess.run, args=(["python", "-m", "webbrowser", "-t", "http://localhost:5111"],), daemon=True
+    ).start()
+
+    # Run the Flask application, the components keep loading in the background
     app.run(debug=False, host=args.host, port=args.port)
@@ -0,0 +1,304 @@
+"""
+This module implements the admission-controlled queue of prompt requests.
+
+Every prompt used to wait on one global lock, so under a burst the Flask threads piled up with no ordering, no
+timeout and no way for a client to know how long it would wait. The scheduler admits requests into a bounded
+queue, rejects them with an estimate of when to retry once the queue is full or the estimated wait exceeds their
+deadline, and hands the generation slots to the waiting requests in priority order: interactive prompts before
+long content generation, oldest first within a class. Batch requests that waited too long are served as
+interactive ones so they never starve. A request that is still queued when its deadline passes gives up without
+using the LLM. Queue depth, wait times and service times are recorded for the metrics endpoint and the
+Retry-After estimates.
+
+Classes:
+- RequestScheduler: Bounded, prioritised queue handing out generation slots.
+- Ticket: An admitted request.
+- QueueFull: Raised when a request is not admitted, with the seconds after which to retry.
+- DeadlineExceeded: Raised when a request is still queued at its deadline.
+- RequestCancelled: Raised when a queued request is cancelled by its client.
+"""
+
+import itertools
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from constants import (
+    SCHEDULER_CONCURRENCY,
+    SCHEDULER_DEADLINE_SECONDS,
+    SCHEDULER_MAX_BATCH_WAIT_SECONDS,
+    SCHEDULER_MAX_QUEUE,
+    SCHEDULER_METRICS_WINDOW,
+)
+
+# Priority classes, served in this order
+PRIORITY_CLASSES = ("interactive", "batch")
+# Smoothing of the service time estimates, the weight of the latest request
+_SERVICE_TIME_ALPHA = 0.2
+# Queued requests check their deadline and cancellation at least this often
+_POLL_SECONDS = 0.5
+
+
+class QueueFull(Exception):
+    def __init__(self, retry_after: float):
+        """
+        Initializes the rejection of a request.
+
+        Args:
+            retry_after (float): Estimated seconds after which the request may be admitted.
+        """
+        super().__init__(f"The request queue is full, retry in {retry_after:.0f} seconds")
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a request is still queued at its deadline."""
+
+
+class RequestCancelled(Exception):
+    """Raised when a queued request is cancelled by its client."""
+
+
+class Ticket:
+    def __init__(self, priority: str, deadline: float, sequence: int):
+        """
+        Initializes an admitted request.
+
+        Args:
+            priority (str): The priority class of the request.
+            deadline (float): The time.monotonic() after which the request gives up waiting.
+            sequence (int): The admission order, used to serve a class oldest first.
+        """
+        self.priority = priority
+        self.deadline = deadline
+        self.sequence = sequence
+        self.enqueued_at = time.monotonic()
+        self.started_at: Optional[float] = None
+
+
+class RequestScheduler:
+    def __init__(self, concurrency: int = SCHEDULER_CONCURRENCY, max_queue: int = SCHEDULER_MAX_QUEUE):
+        """
+        Initializes the scheduler.
+
+        Args:
+            concurrency (int): Number of requests generating at once.
+            max_queue (int): Number of requests waiting for a slot beyond which requests are rejected.
+        """
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self._condition = threading.Condition()
+        self._waiting: list[Ticket] = []
+        self._active = 0
+        self._sequence = itertools.count()
+        # Expected generation time of every class, learnt from the served requests
+        self._service_seconds: dict[str, Optional[float]] = {priority: None for priority in PRIORITY_CLASSES}
+        self._waits: deque = deque(maxlen=SCHEDULER_METRICS_WINDOW)
+        self._counts = {"admitted": 0, "rejected": 0, "expired": 0, "cancelled": 0, "completed": 0}
+
+    def resize(self, concurrency: int) -> None:
+        """
+        Change the number of requests generating at once, e.g. once the model is loaded.
+
+        Args:
+            concurrency (int): Number of requests generating at once.
+        """
+        with self._condition:
+            self.concurrency = concurrency
+            # Queued requests may fit in the new slots
+            self._condition.notify_all()
+
+    def _rank(self, ticket: Ticket, now: float) -> tuple:
+        # Batch requests waiting too long are ranked as interactive ones
+        rank = PRIORITY_CLASSES.index(ticket.priority)
+        if now - ticket.enqueued_at > SCHEDULER_MAX_BATCH_WAIT_SECONDS:
+            rank = 0
+        return rank, ticket.sequence
+
+    def _next(self) -> Optional[Ticket]:
+        if not self._waiting:
+            return None
+        now = time.monotonic()
+        return min(self._waiting, key=lambda ticket: self._rank(ticket, now))
+
+    def _service_estimate(self, priority: str) -> float:
+        known = [seconds for seconds in self._service_seconds.values() if seconds is not None]
+        estimate = self._service_seconds.get(priority)
+        if estimate is None:
+            # Before a request of the class was served, assume the mean of the others
+            estimate = sum(known) / len(known) if known else 0.0
+        return estimate
+
+    def _estimate_wait(self, priority: str) -> float:
+        # Requests served before a new one: every queued request of its class or a higher one
+        rank = PRIORITY_CLASSES.index(priority)
+        ahead = sum(
+            self._service_estimate(ticket.priority)
+            for ticket in self._waiting
+            if PRIORITY_CLASSES.index(ticket.priority) <= rank
+        )
+        # Running requests are on average half done
+        running = self._active * self._service_estimate(priority) / 2
+        return (ahead + running) / self.concurrency
+
+    def estimate_wait(self, priority: str = "interactive") -> float:
+        """
+        Estimate how long a new request would wait for a slot.
+
+        Args:
+            priority (str): The priority class of the request.
+
+        Returns:
+            float: The estimated wait, in seconds.
+        """
+        with self._condition:
+            return self._estimate_wait(priority)
+
+    def submit(self, priority: str = "interactive", deadline_seconds: Optional[float] = None) -> Ticket:
+        """
+        Admit a request into the queue.
+
+        Args:
+            priority (str): The priority class of the request, one of PRIORITY_CLASSES.
+            deadline_seconds (Optional[float]): Seconds the request may wait for a slot (default is the deadline
+                of its class in SCHEDULER_DEADLINE_SECONDS).
+
+        Returns:
+            Ticket: The admitted request, to be passed to slot().
+
+        Raises:
+            ValueError: If the priority class is unknown.
+            QueueFull: If the queue is full, or the estimated wait exceeds the deadline of the request.
+        """
+        if priority not in PRIORITY_CLASSES:
+            raise ValueError(f"Unknown priority class '{priority}', expected one of {PRIORITY_CLASSES}")
+        if deadline_seconds is None:
+            deadline_seconds = SCHEDULER_DEADLINE_SECONDS[priority]
+
+        with self._condition:
+            wait = self._estimate_wait(priority)
+            if len(self._waiting) >= self.max_queue:
+                self._counts["rejected"] += 1
+                # A place frees up once the next queued request is served
+                raise QueueFull(max(1.0, self._service_estimate(priority) / self.concurrency))
+            if wait > deadline_seconds:
+                self._counts["rejected"] += 1
+                # The request would be served in time once the queue is this much shorter
+                raise QueueFull(max(1.0, wait - deadline_seconds))
+            ticket = Ticket(priority, time.monotonic() + deadline_seconds, next(self._sequence))
+            self._waiting.append(ticket)
+            self._counts["admitted"] += 1
+            return ticket
+
+    def _leave(self, ticket: Ticket, outcome: str) -> None:
+        self._waiting.remove(ticket)
+        self._counts[outcome] += 1
+        # The head of the queue may have changed
+        self._condition.notify_all()
+
+    def cancel(self, ticket: Ticket) -> bool:
+        """
+        Remove a request from the queue, e.g. when its client went away before it waited for a slot.
+
+        Args:
+            ticket (Ticket): The admitted request.
+
+        Returns:
+            bool: True when the request was still queued.
+        """
+        with self._condition:
+            if ticket not in self._waiting:
+                return False
+            self._leave(ticket, "cancelled")
+            return True
+
+    @contextmanager
+    def slot(self, ticket: Ticket, cancelled: Optional[threading.Event] = None) -> Iterator[Ticket]:
+        """
+        Wait until the request is served, then hold a generation slot while the block runs.
+
+        Args:
+            ticket (Ticket): The admitted request.
+            cancelled (Optional[threading.Event]): Set when the client went away, the request then leaves the queue.
+
+        Yields:
+            Ticket: The request, with its start time.
+
+        Raises:
+            DeadlineExceeded: If the request is still queued at its deadline.
+            RequestCancelled: If the request is cancelled while queued.
+        """
+        with self._condition:
+            while not (self._active < self.concurrency and self._next() is ticket):
+                remaining = ticket.deadline - time.monotonic()
+                if remaining <= 0:
+                    self._leave(ticket, "expired")
+                    raise DeadlineExceeded(
+                        f"The request waited {time.monotonic() - ticket.enqueued_at:.1f} seconds without being served"
+                    )
+                if cancelled is not None and cancelled.is_set():
+                    self._leave(ticket, "cancelled")
+                    raise RequestCancelled()
+                self._condition.wait(min(remaining, _POLL_SECONDS))
+            self._waiting.remove(ticket)
+            self._active += 1
+            ticket.started_at = time.monotonic()
+            self._waits.append(ticket.started_at - ticket.enqueued_at)
+            # Another slot may still be free for the next request
+            self._condition.notify_all()
+
+        try:
+            yield ticket
+        finally:
+            with self._condition:
+                self._active -= 1
+                self._counts["completed"] += 1
+                seconds = time.monotonic() - ticket.started_at
+                previous = self._service_seconds[ticket.priority]
+                if previous is not None:
+                    seconds = _SERVICE_TIME_ALPHA * seconds + (1 - _SERVICE_TIME_ALPHA) * previous
+                self._service_seconds[ticket.priority] = seconds
+                self._condition.notify_all()
+
+    def stats(self) -> dict:
+        """
+        Get the queue metrics.
+
+        Returns:
+            dict: The queue depth of every class, the active requests, the request counts, the wait times of the
+            latest served requests and the estimated service time of every class.
+        """
+        with self._condition:
+            waits = sorted(self._waits)
+            depth = {priority: 0 for priority in PRIORITY_CLASSES}
+            for ticket in self._waiting:
+                depth[ticket.priority] += 1
+
+            def percentile(fraction: float) -> Optional[float]:
+                if not waits:
+                    return None
+                return round(waits[min(len(waits) - 1, math.ceil(fraction * len(waits)) - 1)], 3)
+
+            return {
+                "queued": depth,
+                "active": self._active,
+                "concurrency": self.concurrency,
+                "max_queue": self.max_queue,
+                **self._counts,
+                "wait_seconds": {
+                    "mean": round(sum(waits) / len(waits), 3) if waits else None,
+                    "p50": percentile(0.5),
+                    "p95": percentile(0.95),
+                    "max": round(waits[-1], 3) if waits else None,
+                },
+                "service_seconds": {
+                    priority: round(seconds, 3) if seconds is not None else None
+                    for priority, seconds in self._service_seconds.items()
+                },
+                "estimated_wait_seconds": {
+                    priority: round(self._estimate_wait(priority), 3) for priority in PRIORITY_CLASSES
+                },
+            }
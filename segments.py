@@ -0,0 +1,307 @@
+"""
+This module implements segmented collections, so that small uploads do not rewrite a whole database.
+
+An index version is made of an immutable base segment, the Chroma collection of the version directory,
+plus small delta segments under deltas/. A delta ingest only loads and embeds the files that were added or
+changed since the last ingest, and records tombstones for the files that were changed or removed, which hide
+their chunks in the older segments. Searches query every segment with the tombstones as a where pre-filter and
+merge the results. Once the deltas cross the configured thresholds, compaction copies the live chunks and their
+embeddings, without embedding anything again, into a new index version that is published as a snapshot.
+
+The segments of a version are listed in a segments.json manifest:
+{"next_seq": 3, "deltas": [{"name": "d1", "seq": 1}, ...], "tombstones": {source: seq}, "files": {source: {...}}}
+A tombstone hides the chunks of its source in every segment older than its seq, the base segment having seq 0.
+
+Functions:
+- load_manifest(version_dir): Reads the manifest of an index version.
+- write_manifest(version_dir, manifest): Replaces the manifest of an index version.
+- scan_files(source_dir): Lists the ingestible files of a source directory with their size and mtime.
+- plan_delta(source_dir, manifest): Finds the files to ingest and the sources to tombstone.
+- tombstone_filter(tombstones, seq): Builds the where clause hiding tombstoned sources in a segment.
+- delta_dirs(version_dir, manifest): Lists the delta segment directories of an index version.
+- needs_compaction(version_dir): Checks the compaction thresholds.
+- compact(database_dir): Merges the segments of the live version into a new published version.
+
+Command-line Options:
+- --db_directory: The database directory to compact (the directory holding the versions).
+"""
+
+import json
+import logging
+import os
+from typing import Any, Optional
+
+import click
+from langchain.docstore.document import Document
+
+from constants import (
+    COLUMNAR_CHUNK_STORE,
+    DOCUMENT_MAP,
+    SEGMENT_MAX_DELTA_FRACTION,
+    SEGMENT_MAX_DELTAS,
+    SEGMENT_MAX_TOMBSTONES,
+)
+from ann_tuning import load_ann_params, save_ann_params
+from chroma_store import open_store, remove_directory
+from chunk_store import ChunkStore
+from columnar_store import ColumnarStore
+from compression import merge_sentence_embeddings
+from metadata_filters import index_metadata
+from retrieval import CollectionGenerations
+from routing import write_routing_vectors
+from snapshots import collection_name, current_version_dir, new_version_dir, publish
+
+MANIFEST_FILENAME = "segments.json"
+DELTAS_DIRNAME = "deltas"
+# Number of chunks copied to the compacted collection per call, below Chroma's maximum batch size
+_COPY_BATCH_SIZE = 5000
+
+
+def load_manifest(version_dir: str) -> Optional[dict]:
+    """
+    Read the manifest of an index version.
+
+    Args:
+        version_dir (str): The index version directory.
+
+    Returns:
+        Optional[dict]: The manifest, or None for versions ingested before segmentation.
+    """
+    try:
+        with open(os.path.join(version_dir, MANIFEST_FILENAME), encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def write_manifest(version_dir: str, manifest: dict) -> None:
+    """
+    Replace the manifest of an index version.
+
+    Args:
+        version_dir (str): The index version directory.
+        manifest (dict): The manifest.
+    """
+    # Replacing the file is atomic, readers see either the old or the new segments
+    path = os.path.join(version_dir, MANIFEST_FILENAME)
+    with open(path + ".tmp", "w", encoding="utf-8") as file:
+        json.dump(manifest, file)
+    os.replace(path + ".tmp", path)
+
+
+def new_manifest(files: dict) -> dict:
+    """
+    Create the manifest of a version whose base segment holds every file.
+
+    Args:
+        files (dict): The ingested files, as returned by scan_files.
+
+    Returns:
+        dict: The manifest.
+    """
+    return {
+        "next_seq": 1,
+        "deltas": [],
+        "tombstones": {},
+        "files": {source: {**stat, "seq": 0} for source, stat in files.items()},
+    }
+
+
+def scan_files(source_dir: str) -> dict[str, dict]:
+    """
+    List the ingestible files of a source directory.
+
+    Args:
+        source_dir (str): The source directory, walked the same way as load_documents does.
+
+    Returns:
+        dict[str, dict]: The size and modification time of every file, by source path.
+    """
+    files = {}
+    for root, _, file_names in os.walk(source_dir):
+        for file_name in file_names:
+            if os.path.splitext(file_name)[1] in DOCUMENT_MAP:
+                path = os.path.join(root, file_name)
+                stat = os.stat(path)
+                files[path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    return files
+
+
+def plan_delta(source_dir: str, manifest: dict) -> tuple[list[str], list[str], dict]:
+    """
+    Find the files a delta ingest has to load and the sources it has to tombstone.
+
+    Args:
+        source_dir (str): The source directory of the database.
+        manifest (dict): The manifest of the live index version.
+
+    Returns:
+        tuple[list[str], list[str], dict]: The added or changed files, the changed or removed sources whose
+        older chunks must be hidden, and the current scan of the source directory.
+    """
+    files = scan_files(source_dir)
+    known = manifest["files"]
+    changed = [
+        path
+        for path, stat in files.items()
+        if path not in known or (known[path]["size"], known[path]["mtime_ns"]) != (stat["size"], stat["mtime_ns"])
+    ]
+    removed = [path for path in known if path not in files]
+    return changed, [path for path in changed if path in known] + removed, files
+
+
+def tombstone_filter(tombstones: dict[str, int], seq: int) -> Optional[dict]:
+    """
+    Build the where clause hiding the tombstoned sources of a segment.
+
+    Args:
+        tombstones (dict[str, int]): The seq of the tombstone of every source.
+        seq (int): The seq of the segment.
+
+    Returns:
+        Optional[dict]: The where clause, or None when nothing is hidden in the segment.
+    """
+    hidden = [{"source": {"$ne": source}} for source, tombstone in tombstones.items() if tombstone > seq]
+    if not hidden:
+        return None
+    return hidden[0] if len(hidden) == 1 else {"$and": hidden}
+
+
+def delta_dirs(version_dir: str, manifest: Optional[dict]) -> list[tuple[int, str]]:
+    """
+    List the delta segment directories of an index version.
+
+    Args:
+        version_dir (str): The index version directory.
+        manifest (Optional[dict]): Its manifest.
+
+    Returns:
+        list[tuple[int, str]]: The seq and directory of every delta, oldest first.
+    """
+    if not manifest:
+        return []
+    return [(delta["seq"], os.path.join(version_dir, DELTAS_DIRNAME, delta["name"])) for delta in manifest["deltas"]]
+
+
+def needs_compaction(version_dir: str) -> bool:
+    """
+    Check whether the deltas of an index version crossed the compaction thresholds.
+
+    Args:
+        version_dir (str): The index version directory.
+
+    Returns:
+        bool: True when there are too many deltas or tombstones, or the deltas hold too many files.
+    """
+    manifest = load_manifest(version_dir)
+    if not manifest or not manifest["deltas"]:
+        return False
+    delta_files = sum(1 for stat in manifest["files"].values() if stat["seq"] > 0)
+    return (
+        len(manifest["deltas"]) >= SEGMENT_MAX_DELTAS
+        or len(manifest["tombstones"]) >= SEGMENT_MAX_TOMBSTONES
+        or delta_files > SEGMENT_MAX_DELTA_FRACTION * max(len(manifest["files"]), 1)
+    )
+
+
+def _copy_segment(source: Any, target: Any, where: Optional[dict], text_store: ColumnarStore) -> tuple[list, list]:
+    # Copy the live chunks of a segment with their stored embeddings
+    data = source.get(where=where, include=["embeddings", "documents", "metadatas"])
+    stored = text_store.get(data["ids"])
+    chunks = [
+        stored.get(chunk_id) or Document(page_content=text or "", metadata=metadata or {})
+        for chunk_id, text, metadata in zip(data["ids"], data["documents"], data["metadatas"])
+    ]
+    for start in range(0, len(data["ids"]), _COPY_BATCH_SIZE):
+        end = start + _COPY_BATCH_SIZE
+        if COLUMNAR_CHUNK_STORE:
+            # The text and the rest of the metadata go to the columnar store of the compacted collection
+            target.add(
+                ids=data["ids"][start:end],
+                embeddings=data["embeddings"][start:end],
+                metadatas=[index_metadata(chunk.metadata) for chunk in chunks[start:end]],
+            )
+        else:
+            target.add(
+                ids=data["ids"][start:end],
+                embeddings=data["embeddings"][start:end],
+                documents=[chunk.page_content for chunk in chunks[start:end]],
+                metadatas=[chunk.metadata for chunk in chunks[start:end]],
+            )
+    return data["ids"], chunks
+
+
+def compact(database_dir: str, ann_params: Optional[dict] = None, tuning: Optional[dict] = None) -> str:
+    """
+    Merge the segments of the live index version of a database into a new version and publish it.
+
+    Args:
+        database_dir (str): The directory holding the versions of the database.
+        ann_params (Optional[dict]): The hnsw:* collection metadata of the new version. Defaults to the tuned
+            parameters of the live version.
+        tuning (Optional[dict]): The measurements ann_params were chosen from, saved beside them.
+
+    Returns:
+        str: The new index version directory.
+    """
+    live = current_version_dir(database_dir)
+    manifest = load_manifest(live)
+    tombstones = manifest["tombstones"] if manifest else {}
+    segments = [(0, live)] + delta_dirs(live, manifest)
+    version_dir = new_version_dir(database_dir)
+
+    try:
+        # Create the collection with the tuned HNSW parameters of the database, if any, and keep them for the
+        # versions built after this one
+        ann_params = ann_params or load_ann_params(database_dir)
+        target = open_store(version_dir, collection_metadata=ann_params)
+        save_ann_params(version_dir, ann_params, tuning)
+        parents, ids, chunks, documents = [], [], [], []
+        for seq, segment_dir in segments:
+            where = tombstone_filter(tombstones, seq)
+            source = open_store(segment_dir)
+            text_store = ColumnarStore(segment_dir)
+            copied_ids, copied_chunks = _copy_segment(source._collection, target._collection, where, text_store)
+            ids.extend(copied_ids)
+            chunks.extend(copied_chunks)
+            logging.info(f"Copied {len(copied_ids)} chunks from {segment_dir}")
+
+            # Keep the parent spans and documents of the live chunks only
+            hidden = {name for name, tombstone in tombstones.items() if tombstone > seq}
+            parents.extend(
+                parent for parent in ChunkStore(segment_dir).all() if parent.metadata.get("source") not in hidden
+            )
+            documents.extend(doc for doc in text_store.documents() if doc.metadata.get("source") not in hidden)
+
+        if parents:
+            ChunkStore(version_dir).write(parents)
+        if COLUMNAR_CHUNK_STORE:
+            ColumnarStore(version_dir).write(chunks, ids, documents)
+        merge_sentence_embeddings([segment_dir for _, segment_dir in segments], version_dir)
+        write_routing_vectors(target, version_dir)
+        # Versions ingested before segmentation stay without a manifest, their next ingest is a full one
+        if manifest:
+            write_manifest(version_dir, new_manifest(manifest["files"]))
+    except Exception:
+        # Leave the live version untouched
+        remove_directory(version_dir, ignore_errors=True)
+        raise
+
+    publish(database_dir, version_dir)
+    CollectionGenerations().bump(collection_name(database_dir))
+    return version_dir
+
+
+@click.command()
+@click.option(
+    "--db_directory",
+    required=True,
+    help="Database directory to compact, e.g. DB/ModuleA",
+)
+def main(db_directory):
+    version_dir = compact(db_directory)
+    print(f"Compacted into {version_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+"""
+This module implements versioned index snapshots, so that re-ingesting a database never takes it offline.
+
+Every database directory holds one sub-directory per index version (v1, v2, ...) and a CURRENT file naming the
+live one. A re-ingest builds the next version beside the live one, then publishes it by atomically replacing the
+CURRENT file. Requests lease the version of the retrievers they use, and versions older than the last few are
+deleted once no request holds a lease on them, which also leaves the last versions available for rollback.
+Databases ingested before versioning, without a CURRENT file, are used in place.
+
+Functions:
+- current_version_dir(database_dir): The directory of the live index of a database.
+- is_servable(database_dir): Whether a database has a live index.
+- new_version_dir(database_dir): Creates the directory of the next index version.
+- publish(database_dir, version_dir): Makes a version the live index.
+- list_versions(database_dir): Lists the index versions of a database, oldest first.
+- database_directory(db_directory): The database directory of a database or version directory.
+- collection_name(db_directory): The database name of a database or version directory.
+
+Classes:
+- SnapshotManager: Leases index versions to requests and deletes the old ones nobody uses.
+"""
+
+import os
+import re
+import shutil
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Optional
+
+from chroma_store import drop_store, is_own_client_entry, remove_directory
+from constants import PERSIST_DIRECTORY, SNAPSHOT_KEEP_VERSIONS
+from utils import info, warning
+
+CURRENT_FILENAME = "CURRENT"
+_VERSION_PATTERN = re.compile(r"^v(\d+)$")
+
+
+def list_versions(database_dir: str) -> list[str]:
+    """
+    List the index versions of a database.
+
+    Args:
+        database_dir (str): The directory of the database.
+
+    Returns:
+        list[str]: The version names, oldest first.
+    """
+    try:
+        names = [name for name in os.listdir(database_dir) if _VERSION_PATTERN.match(name)]
+    except OSError:
+        return []
+    return sorted(names, key=lambda name: int(name[1:]))
+
+
+def current_version_dir(database_dir: str) -> str:
+    """
+    Get the directory of the live index of a database.
+
+    Args:
+        database_dir (str): The directory of the database.
+
+    Returns:
+        str: The live version directory, or the database directory itself when it is not versioned.
+    """
+    try:
+        with open(os.path.join(database_dir, CURRENT_FILENAME), encoding="utf-8") as file:
+            version = file.read().strip()
+    except OSError:
+        return database_dir
+    return os.path.join(database_dir, version) if _VERSION_PATTERN.match(version) else database_dir
+
+
+def is_servable(database_dir: str) -> bool:
+    """
+    Check whether a database can be searched, i.e. it has a live version or was ingested before versioning.
+
+    Args:
+        database_dir (str): The directory of the database.
+
+    Returns:
+        bool: False while the first version of a new database is being built.
+    """
+    return os.path.exists(os.path.join(database_dir, CURRENT_FILENAME)) or not list_versions(database_dir)
+
+
+def new_version_dir(database_dir: str) -> str:
+    """
+    Create the directory of the next index version of a database.
+
+    Args:
+        database_dir (str): The directory of the database.
+
+    Returns:
+        str: The new, empty version directory.
+    """
+    os.makedirs(database_dir, exist_ok=True)
+    versions = list_versions(database_dir)
+    number = int(versions[-1][1:]) + 1 if versions else 1
+    # Another ingest may have created the same version meanwhile
+    while True:
+        path = os.path.join(database_dir, f"v{number}")
+        try:
+            os.mkdir(path)
+            return path
+        except FileExistsError:
+            number += 1
+
+
+def publish(database_dir: str, version_dir: str) -> None:
+    """
+    Make an index version the live index of its database.
+
+    Args:
+        database_dir (str): The directory of the database.
+        version_dir (str): The version directory to publish.
+    """
+    # Replacing the file is atomic, readers see either the old or the new version
+    tmp_path = os.path.join(database_dir, CURRENT_FILENAME + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        file.write(os.path.basename(os.path.normpath(version_dir)))
+    os.replace(tmp_path, os.path.join(database_dir, CURRENT_FILENAME))
+
+
+def database_directory(db_directory: str) -> str:
+    """
+    Get the database directory of a database directory or of one of its version directories.
+
+    Args:
+        db_directory (str): The directory an index is written to.
+
+    Returns:
+        str: The directory holding the versions of the database.
+    """
+    path = os.path.normpath(db_directory)
+    if _VERSION_PATTERN.match(os.path.basename(path)):
+        path = os.path.dirname(path)
+    return path
+
+
+def collection_name(db_directory: str) -> str:
+    """
+    Get the database name of a database directory or of one of its version directories.
+
+    Args:
+        db_directory (str): The directory an index is written to.
+
+    Returns:
+        str: The name of the database.
+    """
+    return os.path.basename(database_directory(db_directory))
+
+
+class SnapshotManager:
+    def __init__(self, persist_directory: str = PERSIST_DIRECTORY, keep_versions: int = SNAPSHOT_KEEP_VERSIONS):
+        """
+        Initializes the manager of the index versions of every database.
+
+        Args:
+            persist_directory (str): The directory holding one sub-directory per database.
+            keep_versions (int): Number of versions kept for rollback besides the live one.
+        """
+        self.persist_directory = persist_directory
+        self.keep_versions = keep_versions
+        # Number of requests using every version directory
+        self._leases: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def database_dir(self, name: str) -> str:
+        # The directory holding the versions of a database
+        return os.path.join(self.persist_directory, name)
+
+    def current(self, name: str) -> str:
+        """
+        Get the directory of the live index of a database.
+
+        Args:
+            name (str): The name of the database.
+
+        Returns:
+            str: The live version directory.
+        """
+        return current_version_dir(self.database_dir(name))
+
+    def _checkout_one(self, pool, name: str) -> Any:
+        while True:
+            version = self.current(name)
+            with self._lock:
+                self._leases[version] += 1
+            try:
+                retriever = pool[name]
+            except Exception:
+                self.release(version)
+                raise
+            if retriever.persist_directory == version:
+                return retriever
+            # The pool still holds another version, open the live one and lease again
+            self.release(version)
+            pool[name] = pool.opener(name)
+
+    @contextmanager
+    def checkout(self, pool, names: list[str]):
+        """
+        Lease the live retrievers of databases for the duration of a request.
+
+        Args:
+            pool: The CollectionPool holding the retrievers.
+            names (list[str]): The names of the databases.
+
+        Yields:
+            dict[str, Any]: The retrievers by database name. Their index version is not deleted until released.
+        """
+        retrievers: dict[str, Any] = {}
+        try:
+            for name in names:
+                retrievers[name] = self._checkout_one(pool, name)
+            yield retrievers
+        finally:
+            for retriever in retrievers.values():
+                self.release(retriever.persist_directory)
+
+    def release(self, version_dir: str) -> None:
+        """
+        Release a lease on an index version, deleting the version when it was the last user of an old one.
+
+        Args:
+            version_dir (str): The version directory.
+        """
+        with self._lock:
+            self._leases[version_dir] -= 1
+            if self._leases[version_dir] > 0:
+                return
+            del self._leases[version_dir]
+        self.collect(collection_name(version_dir))
+
+    def collect(self, name: str) -> list[str]:
+        """
+        Delete the versions of a database older than the last kept ones that no request is using.
+
+        Args:
+            name (str): The name of the database.
+
+        Returns:
+            list[str]: The deleted version directories.
+        """
+        database_dir = self.database_dir(name)
+        live = self.current(name)
+        versions = [os.path.join(database_dir, version) for version in list_versions(database_dir)]
+        # Keep the live version and the versions just before it for rollback
+        live_index = versions.index(live) if live in versions else len(versions)
+        kept = set(versions[max(live_index - self.keep_versions, 0) : live_index + 1])
+        # Versions after the live one are being built, or were rolled back from
+        kept.update(versions[live_index + 1 :])
+
+        deleted = []
+        with self._lock:
+            for version in versions:
+                if version in kept or self._leases[version] > 0:
+                    continue
+                # Delete under the lock so that no request leases the version meanwhile
+                try:
+                    remove_directory(version)
+                    deleted.append(version)
+                    info(message=f"Deleted index version {version}")
+                except OSError as e:
+                    warning(message=f"Could not delete index version {version}: {e}")
+
+            # The Chroma files of a database ingested before versioning count as the version before v1. Only
+            # those are removed, the other files of the database directory, e.g. its tuned HNSW parameters, stay
+            if live != database_dir and live_index >= self.keep_versions and self._leases[database_dir] == 0:
+                if drop_store(database_dir):
+                    deleted.append(database_dir)
+                for entry in os.listdir(database_dir):
+                    if not is_own_client_entry(entry):
+                        continue
+                    path = os.path.join(database_dir, entry)
+                    if os.path.isdir(path):
+                        shutil.rmtree(path, ignore_errors=True)
+                    else:
+                        os.remove(path)
+                    deleted.append(path)
+        return deleted
+
+    def rollback(self, name: str, version: Optional[str] = None) -> str:
+        """
+        Make a previous index version the live one again.
+
+        Args:
+            name (str): The name of the database.
+            version (Optional[str]): The version to restore, e.g. "v3". Defaults to the version before the live one.
+
+        Returns:
+            str: The restored version directory.
+
+        Raises:
+            ValueError: If the version does not exist or there is no previous version.
+        """
+        database_dir = self.database_dir(name)
+        versions = list_versions(database_dir)
+        if version is None:
+            live = os.path.basename(self.current(name))
+            if live not in versions or versions.index(live) == 0:
+                raise ValueError(f"Database '{name}' has no previous version")
+            version = versions[versions.index(live) - 1]
+        if version not in versions:
+            raise ValueError(f"Database '{name}' has no version '{version}'")
+
+        version_dir = os.path.join(database_dir, version)
+        publish(database_dir, version_dir)
+        return version_dir
@@ -0,0 +1,529 @@
+"""
+This module implements speculative decoding with a small draft model.
+
+On CPU every token of a 7B model costs a full read of its weights, so long generations run at a few tokens per
+second. A draft model sharing the tokenizer of the model, e.g. a 1B model of the same family, proposes the next
+few tokens one at a time, cheaply, and the model scores all of them in a single forward pass. The proposed tokens
+are kept up to the first one the model disagrees with, which is replaced by the model's own token, so every forward
+pass of the model yields between one and SPECULATIVE_DRAFT_TOKENS + 1 tokens. Draft tokens are accepted with the
+speculative sampling rule, which leaves the output distribution of the model unchanged: greedy decoding generates
+exactly the tokens the model generates on its own, only faster when the draft model guesses well. The number of
+proposed and accepted draft tokens is recorded for every model.
+
+llama.cpp models get the same with the draft GGUF of their llama.cpp server, or with SmallLlamaDraftModel when
+they run in process.
+
+Functions:
+- load_draft_model(draft_model_id, model, tokenizer): Loads the transformers draft model of a model.
+- load_llama_draft_model(draft_model_path, n_gpu_layers): Loads the llama.cpp draft model of an in-process model.
+- benchmark(model_id, draft_model_id, max_new_tokens, draft_tokens): Compares greedy decoding with and without a
+  draft model.
+
+Classes:
+- SpeculationStats: Proposed and accepted draft tokens of a model.
+- SpeculativeDecoder: Speculative decoding over a transformers causal LM and its draft model.
+- SpeculativeHuggingFaceLLM: LangChain LLM generating with a SpeculativeDecoder.
+- SmallLlamaDraftModel: Draft model of llama-cpp-python proposing the tokens of a small llama.cpp model.
+
+Command-line Options:
+- --model_id: The model to benchmark (default is the first of SPECULATIVE_BENCHMARK_MODELS).
+- --draft_model_id: Its draft model (default is the second of SPECULATIVE_BENCHMARK_MODELS).
+- --max_new_tokens: Number of tokens generated per prompt.
+- --draft_tokens: Number of tokens proposed by the draft model per step (default is SPECULATIVE_DRAFT_TOKENS).
+"""
+
+import logging
+import threading
+import time
+from typing import Any, Callable, List, Optional
+
+import click
+import torch
+from langchain.callbacks.manager import CallbackManagerForLLMRun
+from langchain.llms.base import LLM
+
+from batching import DEFAULT_REPETITION_PENALTY, DEFAULT_TEMPERATURE
+from constants import (
+    CONTEXT_WINDOW_SIZE,
+    MAX_NEW_TOKENS,
+    MODELS_PATH,
+    N_BATCH,
+    SPECULATIVE_BENCHMARK_MODELS,
+    SPECULATIVE_DRAFT_TOKENS,
+)
+from utils import warning
+
+
+class SpeculationStats:
+    def __init__(self):
+        """
+        Initializes the counters of a model.
+        """
+        self._lock = threading.Lock()
+        self.generations = 0
+        self.proposed = 0
+        self.accepted = 0
+        self.tokens = 0
+        self.verifications = 0
+
+    def record(self, proposed: int, accepted: int, tokens: int = 0, verifications: int = 0, generations: int = 0):
+        """
+        Add the draft tokens of a generation, or of a step of one.
+
+        Args:
+            proposed (int): Number of tokens proposed by the draft model.
+            accepted (int): Number of them the model accepted.
+            tokens (int): Number of tokens generated.
+            verifications (int): Number of forward passes of the model that verified draft tokens.
+            generations (int): Number of completed generations.
+        """
+        with self._lock:
+            self.proposed += proposed
+            self.accepted += accepted
+            self.tokens += tokens
+            self.verifications += verifications
+            self.generations += generations
+
+    def stats(self) -> dict:
+        """
+        Get the acceptance metrics.
+
+        Returns:
+            dict: The generations, the proposed and accepted draft tokens, the acceptance rate and, when known, the
+            tokens generated per forward pass of the model.
+        """
+        with self._lock:
+            return {
+                "generations": self.generations,
+                "draft_tokens": self.proposed,
+                "accepted_tokens": self.accepted,
+                "acceptance_rate": round(self.accepted / self.proposed, 3) if self.proposed else None,
+                "tokens_per_verification": (
+                    round(self.tokens / self.verifications, 2) if self.verifications and self.tokens else None
+                ),
+            }
+
+
+def _crop(cache: tuple, length: int) -> tuple:
+    # Keep the first tokens of key/value tensors, [batch, heads, time, head dim]
+    return tuple((key[:, :, :length], value[:, :, :length]) for key, value in cache)
+
+
+class SpeculativeDecoder:
+    def __init__(
+        self,
+        model,
+        draft_model,
+        tokenizer,
+        draft_tokens: int = SPECULATIVE_DRAFT_TOKENS,
+        max_new_tokens: int = MAX_NEW_TOKENS,
+        temperature: float = DEFAULT_TEMPERATURE,
+        repetition_penalty: float = DEFAULT_REPETITION_PENALTY,
+        context_window: int = CONTEXT_WINDOW_SIZE,
+    ):
+        """
+        Initializes the decoder.
+
+        Args:
+            model: The transformers causal LM.
+            draft_model: The smaller causal LM proposing tokens, with the tokenizer of the model.
+            tokenizer: The tokenizer of both models.
+            draft_tokens (int): Number of tokens proposed per forward pass of the model, 0 to decode without draft.
+            max_new_tokens (int): Default number of tokens generated per request.
+            temperature (float): Sampling temperature, 0 for greedy decoding.
+            repetition_penalty (float): Penalty of the tokens already in a sequence, 1 to disable it.
+            context_window (int): Number of prompt and generated tokens of a sequence.
+        """
+        self.model = model.eval()
+        self.draft_model = draft_model.eval()
+        self.tokenizer = tokenizer
+        self.draft_tokens = draft_tokens
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.repetition_penalty = repetition_penalty
+        self.context_window = min(
+            context_window, getattr(model.config, "max_position_embeddings", None) or context_window
+        )
+        # Embedding matrices are often padded beyond the tokenizer, the padding is never sampled
+        self.vocab_size = min(model.config.vocab_size, draft_model.config.vocab_size)
+        eos = getattr(getattr(model, "generation_config", None), "eos_token_id", None)
+        if eos is None:
+            eos = tokenizer.eos_token_id
+        self.eos_ids: set[int] = set(eos if isinstance(eos, (list, tuple)) else [eos]) - {None}
+
+        self.speculation = SpeculationStats()
+        # The caches of the models hold one sequence, requests are decoded one at a time
+        self._lock = threading.Lock()
+        # Cache class of every model, newer transformers versions take a Cache object rather than tuples
+        self._cache_classes: dict = {}
+
+    def _forward(self, model, input_ids: list[int], cache: tuple) -> tuple[torch.Tensor, tuple]:
+        # Run the model on new tokens after its cache, returns the logits of every new token and the new cache
+        cache_class = self._cache_classes.get(id(model))
+        past = cache_class.from_legacy_cache(cache) if cache and cache_class is not None else cache or None
+        output = model(
+            input_ids=torch.tensor([input_ids], device=model.device),
+            past_key_values=past,
+            use_cache=True,
+        )
+        past = output.past_key_values
+        if hasattr(past, "to_legacy_cache"):
+            self._cache_classes[id(model)] = type(past)
+            past = past.to_legacy_cache()
+        return output.logits[0, :, : self.vocab_size].float(), tuple((key, value) for key, value in past)
+
+    def _distribution(self, logits: torch.Tensor, seen: list[int]) -> torch.Tensor:
+        # The processed logits of a position for greedy decoding, its probabilities otherwise
+        logits = logits.clone()
+        if self.repetition_penalty != 1.0 and seen:
+            index = torch.tensor(sorted(set(seen)), device=logits.device)
+            scores = logits[index]
+            logits[index] = torch.where(scores < 0, scores * self.repetition_penalty, scores / self.repetition_penalty)
+        if self.temperature <= 0:
+            return logits
+        return torch.softmax(logits / self.temperature, dim=-1)
+
+    def _pick(self, distribution: torch.Tensor) -> int:
+        if self.temperature <= 0:
+            return int(distribution.argmax())
+        return int(torch.multinomial(distribution, num_samples=1))
+
+    def _verify(self, logits: torch.Tensor, tokens: list[int], drafts: list[int], draft_distributions: list) -> list:
+        # The accepted draft tokens followed by the token of the model at the first rejected one, or after the last
+        new_tokens: list[int] = []
+        for position, token in enumerate(drafts):
+            distribution = self._distribution(logits[position], tokens + drafts[:position])
+            if self.temperature <= 0:
+                if int(distribution.argmax()) != token:
+                    return new_tokens + [int(distribution.argmax())]
+            else:
+                # Accept with probability p/q, else sample from the part of p that q under-represents
+                proposed = draft_distributions[position]
+                if float(torch.rand(())) >= float(distribution[token] / proposed[token]):
+                    residual = torch.clamp(distribution - proposed, min=0)
+                    if float(residual.sum()) <= 0:
+                        residual = distribution
+                    return new_tokens + [int(torch.multinomial(residual / residual.sum(), num_samples=1))]
+            new_tokens.append(token)
+        # Every draft token was accepted, the last position of the model gives one more
+        return new_tokens + [self._pick(self._distribution(logits[len(drafts)], tokens + drafts))]
+
+    def generate(
+        self,
+        prompt: str,
+        max_new_tokens: Optional[int] = None,
+        stop: Optional[list[str]] = None,
+        on_token: Optional[Callable[[str], None]] = None,
+    ) -> str:
+        """
+        Generate the answer of a prompt, the draft model proposing the tokens the model verifies.
+
+        Args:
+            prompt (str): The prompt.
+            max_new_tokens (Optional[int]): Number of tokens to generate at most (default is the decoder's).
+            stop (Optional[list[str]]): Generation stops at the first of these strings, which is not returned.
+            on_token (Optional[Callable[[str], None]]): Called with the text of every new token. An exception it
+                raises ends the generation and is raised.
+
+        Returns:
+            str: The generated text.
+        """
+        max_new_tokens = max_new_tokens or self.max_new_tokens
+        prompt_ids = self.tokenizer.encode(prompt)
+        limit = self.context_window - 1
+        if len(prompt_ids) > limit:
+            logging.warning(f"Prompt of {len(prompt_ids)} tokens truncated to the last {limit}")
+            prompt_ids = prompt_ids[-limit:]
+
+        tokens = list(prompt_ids)
+        generated: list[int] = []
+        state = {"text": ""}
+
+        def append(token: int) -> bool:
+            # Add a token to the answer, returns True when the answer is complete
+            if token in self.eos_ids:
+                return True
+            tokens.append(token)
+            generated.append(token)
+            text = self.tokenizer.decode(generated, skip_special_tokens=True)
+            # Wait for the rest of a character split over several tokens
+            if not text.endswith("�"):
+                complete = False
+                for stop_text in stop or []:
+                    if stop_text in text:
+                        text, complete = text[: text.index(stop_text)], True
+                        break
+                new_text, state["text"] = text[len(state["text"]) :], text
+                if new_text and on_token is not None:
+                    on_token(new_text)
+                if complete:
+                    return True
+            return len(generated) >= max_new_tokens or len(tokens) >= self.context_window
+
+        proposed = accepted = verifications = 0
+        with self._lock, torch.inference_mode():
+            # Tokens held by the cache of every model, the last generated token is in neither
+            cache, draft_cache = (), ()
+            cached = draft_cached = 0
+            done = False
+            while not done:
+                # The draft model proposes tokens one at a time, never beyond the answer or the context window
+                room = min(
+                    self.draft_tokens, max_new_tokens - len(generated) - 1, self.context_window - len(tokens) - 1
+                )
+                drafts: list[int] = []
+                draft_distributions: list = []
+                new_input = tokens[draft_cached:]
+                for _ in range(max(room, 0)):
+                    logits, draft_cache = self._forward(self.draft_model, new_input, draft_cache)
+                    distribution = self._distribution(logits[-1], tokens + drafts)
+                    drafts.append(self._pick(distribution))
+                    draft_distributions.append(distribution)
+                    new_input = drafts[-1:]
+                if drafts:
+                    # The last draft token was not run through the draft model
+                    draft_cached = len(tokens) + len(drafts) - 1
+
+                # The model scores the new tokens and every draft token in one forward pass
+                logits, cache = self._forward(self.model, tokens[cached:] + drafts, cache)
+                new_tokens = self._verify(logits[-len(drafts) - 1 :], tokens, drafts, draft_distributions)
+                proposed += len(drafts)
+                accepted += len(new_tokens) - 1
+                verifications += 1
+
+                # Drop the rejected draft tokens from the caches
+                cached = len(tokens) + len(new_tokens) - 1
+                cache = _crop(cache, cached)
+                draft_cached = min(draft_cached, cached)
+                draft_cache = _crop(draft_cache, draft_cached)
+                for token in new_tokens:
+                    if append(token):
+                        done = True
+                        break
+
+        self.speculation.record(proposed, accepted, len(generated), verifications, generations=1)
+        logging.info(
+            f"Speculative decoding accepted {accepted} of {proposed} draft tokens, "
+            f"{len(generated) / max(verifications, 1):.2f} tokens per forward pass"
+        )
+        return state["text"]
+
+
+class SpeculativeHuggingFaceLLM(LLM):
+    decoder: Any
+    speculation: Any = None
+    # The decoder generates one prompt at a time
+    max_concurrency: int = 1
+
+    @property
+    def _llm_type(self) -> str:
+        return "speculative_huggingface"
+
+    def _call(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        # Tokens reach the callback handlers, e.g. a TokenStream, as they are accepted
+        on_token = run_manager.on_llm_new_token if run_manager else None
+        return self.decoder.generate(prompt, stop=stop, on_token=on_token)
+
+    def get_num_tokens(self, text: str) -> int:
+        return len(self.decoder.tokenizer.encode(text, add_special_tokens=False))
+
+
+def load_draft_model(draft_model_id: str, model, tokenizer):
+    """
+    Load the transformers draft model of a model, on the device of the model.
+
+    Args:
+        draft_model_id (str): The draft model on the HuggingFace Hub.
+        model: The transformers causal LM.
+        tokenizer: The tokenizer of the model.
+
+    Returns:
+        The draft model, None when its tokenizer differs from the model's.
+    """
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    draft_tokenizer = AutoTokenizer.from_pretrained(draft_model_id, cache_dir=MODELS_PATH)
+    if draft_tokenizer.get_vocab() != tokenizer.get_vocab():
+        warning(message=f"The draft model {draft_model_id} has another tokenizer, speculative decoding is disabled")
+        return None
+    draft_model = AutoModelForCausalLM.from_pretrained(
+        draft_model_id, torch_dtype=getattr(model, "dtype", torch.float32), cache_dir=MODELS_PATH
+    )
+    return draft_model.to(model.device)
+
+
+def load_llama_draft_model(draft_model_path: str, n_gpu_layers: int = 0, draft_tokens: int = SPECULATIVE_DRAFT_TOKENS):
+    """
+    Load the llama.cpp draft model of an in-process llama.cpp model.
+
+    Args:
+        draft_model_path (str): The GGUF file of the draft model.
+        n_gpu_layers (int): Number of layers offloaded to the GPU.
+        draft_tokens (int): Number of tokens proposed per forward pass of the model.
+
+    Returns:
+        SmallLlamaDraftModel: The draft model, to be set as the draft_model of the Llama of the model.
+    """
+    from llama_cpp import Llama
+
+    draft = Llama(
+        model_path=draft_model_path,
+        n_ctx=CONTEXT_WINDOW_SIZE,
+        n_batch=N_BATCH,
+        n_gpu_layers=n_gpu_layers,
+        verbose=False,
+    )
+    return SmallLlamaDraftModel(draft, draft_tokens)
+
+
+try:
+    from llama_cpp.llama_speculative import LlamaDraftModel
+except ImportError:
+    # llama-cpp-python is only needed by GGUF models, and draft models need a version supporting them
+    LlamaDraftModel = object
+
+
+class SmallLlamaDraftModel(LlamaDraftModel):
+    def __init__(self, draft, draft_tokens: int = SPECULATIVE_DRAFT_TOKENS):
+        """
+        Initializes the draft model.
+
+        Args:
+            draft (llama_cpp.Llama): The small llama.cpp model, with the vocabulary of the model.
+            draft_tokens (int): Number of tokens proposed per forward pass of the model.
+        """
+        self.draft = draft
+        self.draft_tokens = draft_tokens
+        self.speculation = SpeculationStats()
+        # The last proposal, and the number of tokens it followed
+        self._proposal: list[int] = []
+        self._proposed_after = 0
+
+    def __call__(self, input_ids, /, **kwargs):
+        import numpy as np
+        from llama_cpp import Llama
+
+        input_ids = [int(token) for token in input_ids]
+        # The tokens the model kept of the last proposal are the accepted ones
+        if self._proposal and len(input_ids) > self._proposed_after:
+            kept = Llama.longest_token_prefix(self._proposal, input_ids[self._proposed_after :])
+            self.speculation.record(len(self._proposal), kept, tokens=kept + 1, verifications=1)
+
+        # Evaluate the tokens after the prefix the draft already holds, at least the last one for its logits
+        prefix = min(Llama.longest_token_prefix(self.draft.input_ids.tolist(), input_ids), len(input_ids) - 1)
+        self.draft.n_tokens = prefix
+        self.draft.eval(input_ids[prefix:])
+        proposal: list[int] = []
+        while len(proposal) < self.draft_tokens and self.draft.n_tokens < self.draft.n_ctx():
+            token = int(np.argmax(self.draft.scores[self.draft.n_tokens - 1]))
+            if token == self.draft.token_eos():
+                break
+            proposal.append(token)
+            self.draft.eval([token])
+        self._proposal, self._proposed_after = proposal, len(input_ids)
+        return np.array(proposal, dtype=np.intc)
+
+
+def benchmark(model_id: str, draft_model_id: str, max_new_tokens: int, draft_tokens: int) -> dict:
+    """
+    Compare the greedy decoding of a model by transformers with its speculative decoding.
+
+    Args:
+        model_id (str): The transformers model to load, on CPU.
+        draft_model_id (str): Its draft model.
+        max_new_tokens (int): Number of tokens generated per prompt.
+        draft_tokens (int): Number of tokens proposed per forward pass of the model.
+
+    Returns:
+        dict: The tokens per second of both, the speedup, the acceptance metrics and whether the answers are equal.
+    """
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(model_id)
+    model = AutoModelForCausalLM.from_pretrained(model_id)
+    draft_model = load_draft_model(draft_model_id, model, tokenizer)
+    if draft_model is None:
+        raise click.UsageError(f"{draft_model_id} does not share the tokenizer of {model_id}")
+    decoder = SpeculativeDecoder(model, draft_model, tokenizer, draft_tokens=draft_tokens, temperature=0)
+    prompts = [
+        "Write a lesson plan on photosynthesis for a class of ten year olds.",
+        "Explain the causes of the First World War in a short article.",
+        "List five questions about the water cycle with their answers.",
+    ]
+
+    # Warm up both models before measuring
+    decoder.generate(prompts[0], max_new_tokens=2)
+    decoder.speculation = SpeculationStats()
+    baseline_tokens = speculative_tokens = 0
+    baseline_seconds = speculative_seconds = 0.0
+    identical = True
+    for prompt in prompts:
+        input_ids = tokenizer(prompt, return_tensors="pt").input_ids
+        start = time.perf_counter()
+        with torch.inference_mode():
+            output = model.generate(
+                input_ids,
+                max_new_tokens=max_new_tokens,
+                do_sample=False,
+                repetition_penalty=decoder.repetition_penalty,
+                pad_token_id=tokenizer.eos_token_id,
+            )
+        baseline_seconds += time.perf_counter() - start
+        baseline_ids = output[0, input_ids.shape[-1] :].tolist()
+        baseline_tokens += len(baseline_ids)
+
+        generated = decoder.speculation.tokens
+        start = time.perf_counter()
+        answer = decoder.generate(prompt, max_new_tokens=max_new_tokens)
+        speculative_seconds += time.perf_counter() - start
+        speculative_tokens += decoder.speculation.tokens - generated
+        identical = identical and answer == tokenizer.decode(
+            [token for token in baseline_ids if token not in decoder.eos_ids], skip_special_tokens=True
+        )
+
+    baseline = baseline_tokens / baseline_seconds
+    speculative = speculative_tokens / speculative_seconds
+    return {
+        "greedy_tokens_per_s": round(baseline, 1),
+        "speculative_tokens_per_s": round(speculative, 1),
+        "speedup": round(speculative / baseline, 2),
+        "identical_output": identical,
+        **decoder.speculation.stats(),
+    }
+
+
+@click.command()
+@click.option(
+    "--model_id",
+    default=SPECULATIVE_BENCHMARK_MODELS[0],
+    help="Transformers model to benchmark on CPU",
+)
+@click.option(
+    "--draft_model_id",
+    default=SPECULATIVE_BENCHMARK_MODELS[1],
+    help="Draft model sharing the tokenizer of the model",
+)
+@click.option(
+    "--max_new_tokens",
+    default=128,
+    type=int,
+    help="Number of tokens generated per prompt",
+)
+@click.option(
+    "--draft_tokens",
+    default=SPECULATIVE_DRAFT_TOKENS,
+    type=int,
+    help="Number of tokens proposed by the draft model per step",
+)
+def main(model_id, draft_model_id, max_new_tokens, draft_tokens):
+    print(benchmark(model_id, draft_model_id, max_new_tokens, draft_tokens))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""
+This module loads the components of the API in the background and tracks their progress.
+
+The API used to load the embedding model, the LLM and the collections one after another at import, so the port was
+only bound minutes after the process started and orchestrators saw a dead process meanwhile. Every component now
+loads in a thread of its own as soon as the components it needs are ready, e.g. the collections once the embedding
+model is loaded, while the HTTP server already answers. The time every component took is remembered across
+restarts, which gives the estimated time until the API is ready returned to the requests arriving before then.
+
+Classes:
+- Startup: The components loading in the background, their state and the estimated time until they are ready.
+"""
+
+import json
+import os
+import threading
+import time
+from typing import Callable, Optional
+
+from constants import STARTUP_DEFAULT_SECONDS, STARTUP_TIMINGS_FILE
+from utils import info, success, warning
+
+
+class _Component:
+    def __init__(self, name: str, load: Callable[[], None], requires: tuple, expected_seconds: Optional[float]):
+        self.name = name
+        self.load = load
+        self.requires = requires
+        self.expected_seconds = expected_seconds
+        self.state = "pending"
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.error: Optional[str] = None
+        self.done = threading.Event()
+
+
+class Startup:
+    def __init__(self, timings_file: str = STARTUP_TIMINGS_FILE):
+        """
+        Initializes the startup, components are added with add() and loaded by start().
+
+        Args:
+            timings_file (str): The JSON file remembering how long every component took to load.
+        """
+        self.timings_file = timings_file
+        self.started_at = time.monotonic()
+        self._components: dict[str, _Component] = {}
+        self._lock = threading.Lock()
+        self._timings: dict[str, float] = self._load_timings()
+
+    def _load_timings(self) -> dict:
+        try:
+            with open(self.timings_file, encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_timings(self) -> None:
+        # Write to a temporary file first so that a crash never leaves a partial file
+        try:
+            os.makedirs(os.path.dirname(self.timings_file) or ".", exist_ok=True)
+            tmp_path = self.timings_file + ".tmp"
+            with self._lock:
+                timings = dict(self._timings)
+            with open(tmp_path, "w", encoding="utf-8") as file:
+                json.dump(timings, file)
+            os.replace(tmp_path, self.timings_file)
+        except OSError as e:
+            warning(message=f"Could not save the startup timings: {e}")
+
+    def add(self, name: str, load: Callable[[], None], requires: tuple = ()) -> None:
+        """
+        Declare a component.
+
+        Args:
+            name (str): The name of the component, e.g. "llm".
+            load (Callable[[], None]): Loads the component, raising an exception when it fails.
+            requires (tuple): Names of the components loaded before it.
+        """
+        self._components[name] = _Component(name, load, tuple(requires), self._timings.get(name))
+
+    def _run(self, component: _Component) -> None:
+        for name in component.requires:
+            required = self._components[name]
+            required.done.wait()
+            if required.state != "ready":
+                with self._lock:
+                    component.state = "failed"
+                    component.error = f"Requires '{name}', which failed to load"
+                component.done.set()
+                return
+
+        with self._lock:
+            component.state = "loading"
+            component.started_at = time.monotonic()
+        info(message=f"Loading {component.name}")
+        try:
+            component.load()
+        except Exception as e:
+            with self._lock:
+                component.state = "failed"
+                component.error = str(e)
+                component.finished_at = time.monotonic()
+            warning(message=f"Could not load {component.name}: {e}")
+        else:
+            with self._lock:
+                component.state = "ready"
+                component.finished_at = time.monotonic()
+                self._timings[component.name] = component.finished_at - component.started_at
+            success(message=f"Loaded {component.name} in {component.finished_at - component.started_at:.1f} seconds")
+            self._save_timings()
+        finally:
+            component.done.set()
+
+    def start(self) -> None:
+        """
+        Load every component in a daemon thread of its own, waiting only for the components it requires.
+        """
+        for component in self._components.values():
+            threading.Thread(target=self._run, args=(component,), daemon=True).start()
+
+    def ready(self, names: Optional[tuple] = None) -> bool:
+        """
+        Check whether components are loaded.
+
+        Args:
+            names (Optional[tuple]): The components to check (default is all).
+
+        Returns:
+            bool: True when they are all ready.
+        """
+        names = self._components if names is None else names
+        return all(self._components[name].state == "ready" for name in names)
+
+    def failed(self) -> bool:
+        """
+        Check whether a component failed to load, the API then never gets ready.
+
+        Returns:
+            bool: True when a component failed.
+        """
+        return any(component.state == "failed" for component in self._components.values())
+
+    def _remaining(self, component: _Component, now: float) -> float:
+        # Called with the lock. A component finishes once its requirements did and it loaded for its expected time
+        if component.state in ("ready", "failed"):
+            return 0.0
+        expected = component.expected_seconds if component.expected_seconds is not None else STARTUP_DEFAULT_SECONDS
+        if component.state == "loading":
+            # Past its expected time a component is assumed to be nearly done
+            return max(1.0, expected - (now - component.started_at))
+        after = max((self._remaining(self._components[name], now) for name in component.requires), default=0.0)
+        return after + expected
+
+    def eta_seconds(self) -> Optional[float]:
+        """
+        Estimate how long until every component is ready, from the time they took at the previous startup.
+
+        Returns:
+            Optional[float]: The estimate in seconds, None when a component failed.
+        """
+        if self.failed():
+            return None
+        now = time.monotonic()
+        with self._lock:
+            return max((self._remaining(component, now) for component in self._components.values()), default=0.0)
+
+    def status(self) -> dict:
+        """
+        Get the progress of every component.
+
+        Returns:
+            dict: Whether the API is ready, the estimated seconds until it is, and the state, load time, expected
+            load time and error of every component.
+        """
+        now = time.monotonic()
+        eta = self.eta_seconds()
+        with self._lock:
+            components = {}
+            for component in self._components.values():
+                state: dict = {"state": component.state, "requires": list(component.requires)}
+                if component.started_at is not None:
+                    state["seconds"] = round((component.finished_at or now) - component.started_at, 1)
+                if component.expected_seconds is not None:
+                    state["expected_seconds"] = round(component.expected_seconds, 1)
+                if component.error:
+                    state["error"] = component.error
+                components[component.name] = state
+        return {
+            "ready": self.ready(),
+            "uptime_seconds": round(now - self.started_at, 1),
+            "eta_seconds": round(eta, 1) if eta is not None else None,
+            "components": components,
+        }
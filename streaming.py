@@ -0,0 +1,142 @@
+"""
+This module implements server-sent events streaming of generated answers.
+
+The GGUF models are loaded with streaming enabled, but the only consumer of their tokens used to be the console
+callback handler, so clients waited for the whole answer. A TokenStream is passed as a LangChain callback handler
+to the chain; it queues the retrieved sources as soon as the context is built and every token as it is decoded,
+and the route turns the queue into server-sent events while the answer is generated in a worker thread. When the
+client disconnects the stream is cancelled, which stops the generation at the next token and frees the LLM.
+
+Events:
+- sources: {"Sources": [[file name, text], ...]}, sent once the context is built.
+- token: {"token": text}, one per decoded token.
+- done: The same summary as /api/prompt_route, with "tokens", "seconds" and "time_to_first_token".
+- error: {"error": message}.
+
+Functions:
+- sse_event(event, data): Formats a server-sent event.
+- stream_events(work, stream): Runs the generation in a worker thread and yields its events.
+
+Classes:
+- TokenStream: LangChain callback handler queueing the sources and tokens of one answer.
+- StreamCancelled: Raised in the generation thread when the client went away.
+"""
+
+import json
+import os
+import queue
+import threading
+import time
+from typing import Any, Callable, Iterator, Optional
+
+from langchain.callbacks.base import BaseCallbackHandler
+
+from constants import STREAM_HEARTBEAT_SECONDS
+
+
+class StreamCancelled(Exception):
+    """Raised in the generation thread when the client of a stream disconnected."""
+
+
+def sse_event(event: str, data: Any) -> str:
+    """
+    Format a server-sent event.
+
+    Args:
+        event (str): The event name.
+        data (Any): The JSON-serialisable payload.
+
+    Returns:
+        str: The event, terminated by a blank line.
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class TokenStream(BaseCallbackHandler):
+    # Errors raised here must stop the chain, LangChain only logs them otherwise
+    raise_error: bool = True
+
+    def __init__(self):
+        """
+        Initializes the stream of one answer.
+        """
+        self.events: queue.Queue = queue.Queue()
+        self.cancelled = threading.Event()
+        self.tokens = 0
+        self.first_token_at: Optional[float] = None
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        if self.cancelled.is_set():
+            raise StreamCancelled()
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        self.tokens += 1
+        self.events.put(("token", {"token": token}))
+
+    def sources(self, docs: list) -> None:
+        """
+        Queue the sources of the answer, called once the context is built.
+
+        Args:
+            docs (list): The documents placed in the context.
+        """
+        sources = [(os.path.basename(str(doc.metadata.get("source", ""))), doc.page_content) for doc in docs]
+        self.events.put(("sources", {"Sources": sources}))
+
+    def cancel(self) -> None:
+        # Stop the generation at its next token
+        self.cancelled.set()
+
+
+def stream_events(work: Callable[[TokenStream], dict], stream: TokenStream) -> Iterator[str]:
+    """
+    Run the generation of an answer in a worker thread and yield its server-sent events as they are produced.
+
+    Args:
+        work (Callable[[TokenStream], dict]): Generates the answer, reporting to the stream, and returns the summary
+            sent in the "done" event.
+        stream (TokenStream): The stream of the answer.
+
+    Yields:
+        str: The server-sent events.
+    """
+    started = time.perf_counter()
+
+    def run() -> None:
+        try:
+            summary = work(stream)
+            # Models that do not stream, e.g. transformers pipelines, send their whole answer as one token
+            if stream.tokens == 0 and summary.get("Answer"):
+                stream.on_llm_new_token(summary["Answer"])
+            stream.events.put(("done", summary))
+        except StreamCancelled:
+            stream.events.put(("cancelled", None))
+        except Exception as e:
+            stream.events.put(("error", {"error": str(e)}))
+
+    threading.Thread(target=run, daemon=True).start()
+    try:
+        while True:
+            try:
+                event, data = stream.events.get(timeout=STREAM_HEARTBEAT_SECONDS)
+            except queue.Empty:
+                # Comment lines keep proxies from closing the connection while the prompt is prefilled
+                yield ": keep-alive\n\n"
+                continue
+            if event == "cancelled":
+                return
+            if event == "done":
+                data = {
+                    **data,
+                    "tokens": stream.tokens,
+                    "seconds": round(time.perf_counter() - started, 3),
+                    "time_to_first_token": (
+                        round(stream.first_token_at - started, 3) if stream.first_token_at is not None else None
+                    ),
+                }
+            yield sse_event(event, data)
+            if event in ("done", "error"):
+                return
+    finally:
+        # The client went away or the stream ended, stop generating tokens nobody reads
+        stream.cancel()
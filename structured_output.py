@@ -0,0 +1,273 @@
+"""
+This module constrains the llama.cpp models to the structured answers of the prompt templates.
+
+Lesson plans were asked for as JSON and repaired afterwards by clean_json_string, so a missing comma, an unescaped
+quote or a renamed key could waste a generation of several minutes when the repair failed. The llama.cpp models now
+decode these answers under a GBNF grammar: at every step only the tokens that keep the answer within the grammar can
+be sampled, and once the grammar is complete only the end of the text can. A lesson plan is built from
+LESSON_PLAN_SCHEMA, the JSON schema of the "lessonPlan" object read by LessonPlanExtractor, so the answer parses with
+json.loads as it is and has the keys of the template in their order. The multiple choice questions follow the
+markdown headings that the MCQ extension converts, with four options and their feedback per question.
+
+Requests pass the grammar to the llama.cpp server, in-process LlamaCpp models get it as a LlamaGrammar. Other
+models decode unconstrained and their lesson plans are still repaired by clean_json_string.
+
+Functions:
+- schema_grammar(schema): The GBNF grammar of the JSON values of a schema.
+- mcq_grammar(questions): The GBNF grammar of the multiple choice questions.
+- output_grammar(name): The GBNF grammar of a structured answer, by name.
+- constrain_llm(llm, grammar): The LLM decoding under a grammar.
+
+Classes:
+- ConstrainedLLM: LangChain LLM passing a grammar to every generation of a llama.cpp model.
+"""
+
+import json
+import re
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+
+from langchain.callbacks.manager import CallbackManagerForLLMRun
+from langchain.llms.base import LLM
+
+from utils import warning
+
+# The five events of a lesson plan, in the wording of LESSON_PLAN_PROMPT
+LESSON_PLAN_EVENTS = (
+    "Gain Attention; inform learning outcomes; activate prior knowledge",
+    "Present content and provide learning guidance",
+    "Elicit performance and provide feedback",
+    "Assess performance",
+    "Enhance retention and transfer of learning",
+)
+
+_ACTIVITY_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "activity": {"type": "string"},
+        "duration": {"type": "string"},
+        "method": {"type": "string"},
+    },
+    "required": ["activity", "duration", "method"],
+}
+
+LESSON_PLAN_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "lessonPlan": {
+            "type": "object",
+            "properties": {
+                "learningOutcomes": {"type": "array", "items": {"type": "string"}, "minItems": 1, "maxItems": 2},
+                "professionalAttributes": {"type": "array", "items": {"type": "string"}, "minItems": 1, "maxItems": 2},
+                "events": {
+                    "type": "array",
+                    "prefixItems": [
+                        {
+                            "type": "object",
+                            "properties": {
+                                f"event {number}": {"const": event},
+                                "content": {"type": "array", "items": _ACTIVITY_SCHEMA, "minItems": 1},
+                            },
+                            "required": [f"event {number}", "content"],
+                        }
+                        for number, event in enumerate(LESSON_PLAN_EVENTS, 1)
+                    ],
+                    "items": False,
+                },
+            },
+            "required": ["learningOutcomes", "professionalAttributes", "events"],
+        },
+    },
+    "required": ["lessonPlan"],
+}
+
+# A JSON string without raw control characters, which json.loads rejects
+_STRING_RULE = (
+    r'"\"" ( [^"\\\x7F\x00-\x1F] | "\\" ( ["\\/bfnrt] | "u" [0-9a-fA-F] [0-9a-fA-F] [0-9a-fA-F] [0-9a-fA-F] ) )* "\""'
+)
+_WS_RULE = r"( [ \t\n] ws )?"
+
+
+def _literal(text: str) -> str:
+    # GBNF literals take the escapes of JSON strings
+    return json.dumps(text)
+
+
+def _rule_name(path: str) -> str:
+    # Rule names only hold letters, digits and dashes
+    return re.sub(r"[^a-zA-Z0-9-]+", "-", path)
+
+
+def _items(item: str, minimum: int, maximum: Optional[int]) -> str:
+    # Between minimum and maximum comma separated items, nesting the optional ones
+    if maximum == 0:
+        return ""
+    rest = f'( "," ws {item} ws )*'
+    if maximum is not None:
+        rest = ""
+        for _ in range(maximum - max(minimum, 1)):
+            rest = f'( "," ws {item} ws {rest})? '
+    body = " ".join([f"{item} ws"] + [f'"," ws {item} ws'] * (minimum - 1) + [rest]).strip()
+    return body if minimum else f"( {body} )?"
+
+
+def schema_grammar(schema: dict) -> str:
+    """
+    Convert a JSON schema to the GBNF grammar of its values.
+
+    Only the schemas of the structured answers are supported: objects have all their properties, written in the
+    order of the schema, arrays have "items" with "minItems" and "maxItems" or a fixed tuple in "prefixItems", and
+    values are strings, a "const" or an "enum".
+
+    Args:
+        schema (dict): The JSON schema.
+
+    Returns:
+        str: The grammar, its "root" rule matching the values of the schema.
+
+    Raises:
+        ValueError: If the schema uses a type the conversion does not support.
+    """
+    rules: dict[str, str] = {}
+
+    def visit(schema: dict, path: str) -> str:
+        # The grammar expression of a value, objects and arrays get a rule named after their path
+        if "const" in schema:
+            return _literal(json.dumps(schema["const"]))
+        if "enum" in schema:
+            return "( " + " | ".join(_literal(json.dumps(value)) for value in schema["enum"]) + " )"
+        kind = schema.get("type")
+        if kind == "string":
+            return "string"
+        name = _rule_name(path)
+        if kind == "object":
+            members = [
+                f'{_literal(json.dumps(key))} ws ":" ws {visit(value, f"{path}-{key}")} ws'
+                for key, value in schema["properties"].items()
+            ]
+            rules[name] = '"{" ws ' + ' "," ws '.join(members) + ' "}"'
+        elif kind == "array" and "prefixItems" in schema:
+            elements = [f"{visit(item, f'{path}-{index}')} ws" for index, item in enumerate(schema["prefixItems"], 1)]
+            rules[name] = '"[" ws ' + ' "," ws '.join(elements) + ' "]"'
+        elif kind == "array":
+            item = visit(schema["items"], f"{path}-item")
+            rules[name] = f'"[" ws {_items(item, schema.get("minItems", 0), schema.get("maxItems"))} "]"'
+        else:
+            raise ValueError(f"Unsupported schema type: {kind}")
+        return name
+
+    root = visit(schema, "root")
+    if root != "root":
+        rules["root"] = root
+    rules["string"] = _STRING_RULE
+    rules["ws"] = _WS_RULE
+    return "\n".join(f"{name} ::= {body}" for name, body in rules.items())
+
+
+def mcq_grammar(questions: int = 3) -> str:
+    """
+    Get the GBNF grammar of the multiple choice questions of MCQ_PROMPT.
+
+    Every question has its taxonomy and question headings, a line of text, four options and the feedback of each
+    option, one line apiece, and the questions are separated by a blank line.
+
+    Args:
+        questions (int): Number of questions.
+
+    Returns:
+        str: The grammar.
+    """
+    rules: dict[str, str] = {"root": ' "\\n" '.join(f"question-{number}" for number in range(1, questions + 1))}
+    for number in range(1, questions + 1):
+        rules[f"question-{number}"] = " ".join(
+            [_literal(f"# TAXONOMY {number}\n## Question {number} / {questions}:\n"), "line"]
+            + [_literal("### Options:\n")]
+            + [f"{_literal(f'- {option}. ')} line" for option in "abcd"]
+            + [_literal(f"### Feedback for Question {number}:\n")]
+            + [f"{_literal(f'- {option}. ')} line" for option in "abcd"]
+        )
+    # A line of text, never a heading
+    rules["line"] = r'[^#\n] [^\n]* "\n"'
+    return "\n".join(f"{name} ::= {body}" for name, body in rules.items())
+
+
+# Grammars of the structured answers, by the name used in PROMPT_GENERATION_SETTINGS
+_GRAMMARS = {
+    "lesson_plan": lambda: schema_grammar(LESSON_PLAN_SCHEMA),
+    "mcq": mcq_grammar,
+}
+
+
+@lru_cache(maxsize=None)
+def output_grammar(name: str) -> str:
+    """
+    Get the GBNF grammar of a structured answer.
+
+    Args:
+        name (str): The structured answer, "lesson_plan" or "mcq".
+
+    Returns:
+        str: The grammar.
+
+    Raises:
+        ValueError: If no grammar has this name.
+    """
+    if name not in _GRAMMARS:
+        raise ValueError(f"Unknown grammar '{name}', expected one of {list(_GRAMMARS)}")
+    return _GRAMMARS[name]()
+
+
+class ConstrainedLLM(LLM):
+    # The llama.cpp LLM and the grammar passed to its generations, a GBNF string or a LlamaGrammar
+    llm: Any
+    grammar: Any
+
+    @property
+    def _llm_type(self) -> str:
+        return self.llm._llm_type
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return self.llm._identifying_params
+
+    def _call(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        # The tokens go to the callbacks of this run, e.g. the generation limits and the stream of the request
+        return self.llm._call(prompt, stop=stop, run_manager=run_manager, **{"grammar": self.grammar, **kwargs})
+
+    def get_num_tokens(self, text: str) -> int:
+        return self.llm.get_num_tokens(text)
+
+
+def constrain_llm(llm, grammar: Optional[str]):
+    """
+    Get the LLM generating under the grammar of a structured answer.
+
+    Args:
+        llm: The LangChain LLM.
+        grammar (Optional[str]): The structured answer, e.g. "lesson_plan", or None for free text.
+
+    Returns:
+        The LLM passing the grammar to every generation, or the LLM itself when there is no grammar or the model
+        is not a llama.cpp model.
+    """
+    if not grammar:
+        return llm
+    llm_type: Optional[str] = getattr(llm, "_llm_type", None)
+    if llm_type == "llama_server":
+        # The server parses the grammar of every request for its slot
+        return ConstrainedLLM(llm=llm, grammar=output_grammar(grammar))
+    if llm_type == "llamacpp":
+        try:
+            from llama_cpp import LlamaGrammar
+        except ImportError:
+            warning(message="This version of llama-cpp-python has no grammars, the answer is decoded unconstrained")
+            return llm
+        return ConstrainedLLM(llm=llm, grammar=LlamaGrammar.from_string(output_grammar(grammar), verbose=False))
+    # The transformers models decode unconstrained
+    return llm
@@ -0,0 +1,197 @@
+"""
+Tests of the continuous batching engine on a tiny randomly initialised Llama model, small enough to run on CPU.
+"""
+
+import threading
+
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+batching = pytest.importorskip("batching")
+
+BatchingEngine = batching.BatchingEngine
+
+
+class CharTokenizer:
+    # One token per character, the token 0 is the end of the text
+    alphabet = "\0 abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789.,:;?!'-\n"
+    eos_token_id = 0
+
+    def encode(self, text, add_special_tokens=True):
+        return [self.alphabet.index(char) if char in self.alphabet else 1 for char in text]
+
+    def decode(self, ids, skip_special_tokens=True):
+        return "".join(self.alphabet[i] for i in ids if not (skip_special_tokens and i == self.eos_token_id))
+
+
+PROMPTS = ["Hello", "The lesson plan of the week covers", "One two three", "A"]
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    config = transformers.LlamaConfig(
+        vocab_size=len(CharTokenizer.alphabet),
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=256,
+        bos_token_id=1,
+        eos_token_id=0,
+        pad_token_id=0,
+    )
+    return transformers.LlamaForCausalLM(config).eval()
+
+
+@pytest.fixture
+def engine(model):
+    engine = BatchingEngine(model, CharTokenizer(), max_batch_size=4, max_new_tokens=12, temperature=0)
+    yield engine
+    engine.close()
+
+
+def generate_concurrently(engine, prompts, **kwargs):
+    answers = [None] * len(prompts)
+
+    def run(index):
+        answers[index] = engine.generate(prompts[index], timeout=60, **kwargs)
+
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(len(prompts))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return answers
+
+
+def test_greedy_answers_match_transformers_generate(model, engine):
+    tokenizer = CharTokenizer()
+    for prompt in PROMPTS:
+        input_ids = torch.tensor([tokenizer.encode(prompt)])
+        output = model.generate(
+            input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            max_new_tokens=12,
+            do_sample=False,
+            repetition_penalty=batching.DEFAULT_REPETITION_PENALTY,
+        )
+        assert engine.generate(prompt, timeout=60) == tokenizer.decode(output[0, input_ids.shape[1] :].tolist())
+
+
+def test_batched_answers_match_one_prompt_at_a_time(engine):
+    # The prompts have different lengths, so their rows are left-padded and trimmed as they finish
+    expected = [engine.generate(prompt, timeout=60) for prompt in PROMPTS]
+    assert generate_concurrently(engine, PROMPTS) == expected
+
+
+def test_batch_never_exceeds_max_batch_size(model):
+    engine = BatchingEngine(model, CharTokenizer(), max_batch_size=2, max_new_tokens=8, temperature=0)
+    expected = [engine.generate(prompt, timeout=60) for prompt in PROMPTS]
+    sizes = []
+    forward = engine._forward
+
+    def recording_forward(input_ids, *args, **kwargs):
+        sizes.append(input_ids.shape[0])
+        return forward(input_ids, *args, **kwargs)
+
+    engine._forward = recording_forward
+    try:
+        assert generate_concurrently(engine, PROMPTS) == expected
+    finally:
+        engine.close()
+    assert max(sizes) == 2
+
+
+def test_stops_at_max_new_tokens(engine):
+    engine.eos_ids = set()
+    assert len(engine.generate("Hello", max_new_tokens=5, timeout=60)) == 5
+
+
+def test_stops_before_stop_string(engine):
+    engine.eos_ids = set()
+    full = engine.generate(PROMPTS[1], timeout=60)
+    stop = full[4:6]
+    assert engine.generate(PROMPTS[1], stop=[stop], timeout=60) == full[: full.index(stop)]
+
+
+def test_stops_at_end_of_text(engine):
+    # The greedy answer of this prompt ends with the end of text token after one character
+    engine.eos_ids = set()
+    without_eos = engine.generate("One two three", timeout=60)
+    engine.eos_ids = {0}
+    with_eos = engine.generate("One two three", timeout=60)
+    assert len(with_eos) < len(without_eos) and without_eos.startswith(with_eos)
+
+
+def test_stops_at_context_window(model):
+    engine = BatchingEngine(model, CharTokenizer(), max_new_tokens=50, temperature=0, context_window=20)
+    engine.eos_ids = set()
+    try:
+        assert len(engine.generate("Hello", timeout=60)) == 20 - len("Hello")
+    finally:
+        engine.close()
+
+
+def test_rejects_prompt_longer_than_context_window(model):
+    engine = BatchingEngine(model, CharTokenizer(), temperature=0, context_window=20)
+    try:
+        with pytest.raises(ValueError):
+            engine.generate("word " * 10, timeout=60)
+        # The engine still answers after the rejected prompt
+        assert engine.generate("Hello", max_new_tokens=3, timeout=60)
+    finally:
+        engine.close()
+
+
+def test_failing_callback_only_fails_its_own_request(engine):
+    expected = [engine.generate(prompt, timeout=60) for prompt in PROMPTS]
+    failures = []
+
+    def fail(text):
+        raise RuntimeError("Client went away")
+
+    def run_failing():
+        try:
+            engine.generate(PROMPTS[1], on_token=fail, timeout=60)
+        except RuntimeError as e:
+            failures.append(e)
+
+    thread = threading.Thread(target=run_failing)
+    thread.start()
+    answers = generate_concurrently(engine, PROMPTS)
+    thread.join()
+    assert answers == expected
+    assert len(failures) == 1
+
+
+def test_waiting_request_times_out(model):
+    engine = BatchingEngine(model, CharTokenizer(), max_batch_size=1, max_new_tokens=4, temperature=0)
+    release = threading.Event()
+    try:
+        # The only row is held by a request whose callback blocks, the next one cannot be admitted in time
+        blocking = threading.Thread(
+            target=engine.generate, args=("Hello",), kwargs={"on_token": lambda text: release.wait(30)}
+        )
+        blocking.start()
+        with pytest.raises(TimeoutError):
+            engine.generate("A", timeout=0.5)
+        release.set()
+        blocking.join()
+        # The timed out request is skipped and the engine goes on answering
+        assert engine.generate("A", timeout=60) == engine.generate("A", timeout=60)
+    finally:
+        release.set()
+        engine.close()
+
+
+def test_close_stops_the_loop(model):
+    engine = BatchingEngine(model, CharTokenizer(), max_new_tokens=3, temperature=0)
+    engine.generate("Hello", timeout=60)
+    engine.close()
+    engine._thread.join(10)
+    assert not engine._thread.is_alive()
+    with pytest.raises(RuntimeError):
+        engine.submit("Hello")
@@ -0,0 +1,146 @@
+"""
+Tests of the pool of open collections: lazy opening, least-recently-used eviction, memory budget and usage counts.
+"""
+
+import os
+
+import pytest
+
+collection_pool = pytest.importorskip("collection_pool")
+
+CollectionPool = collection_pool.CollectionPool
+
+DATABASES = ["Biology", "Chemistry", "History", "Physics"]
+
+
+class Retriever:
+    def __init__(self, name, size=0):
+        self.name = name
+        self.size = size
+        self.released = False
+
+
+@pytest.fixture
+def persist_directory(tmp_path):
+    for name in DATABASES + [".chroma"]:
+        os.makedirs(tmp_path / name)
+    return str(tmp_path)
+
+
+def make_pool(persist_directory, opened=None, closed=None, sizes=None, **kwargs):
+    opened = [] if opened is None else opened
+    closed = [] if closed is None else closed
+
+    def opener(name):
+        opened.append(name)
+        return Retriever(name, (sizes or {}).get(name, 0))
+
+    def closer(retriever):
+        closed.append(retriever.name)
+        retriever.released = True
+        return True
+
+    kwargs.setdefault("usage_file", os.path.join(persist_directory, "collection_usage.json"))
+    return CollectionPool(opener, closer=closer, persist_directory=persist_directory, **kwargs)
+
+
+def test_lists_databases_but_not_hidden_directories(persist_directory):
+    pool = make_pool(persist_directory)
+    assert list(pool) == DATABASES
+    assert len(pool) == 4 and "Biology" in pool and ".chroma" not in pool
+    with pytest.raises(KeyError):
+        pool["Missing"]
+
+
+def test_opens_on_first_use_only(persist_directory):
+    opened = []
+    pool = make_pool(persist_directory, opened)
+    assert pool.open_names() == []
+    assert pool["Biology"] is pool["Biology"]
+    assert opened == ["Biology"]
+
+
+def test_evicts_least_recently_used(persist_directory):
+    closed = []
+    pool = make_pool(persist_directory, closed=closed, max_open=2, memory_budget=0)
+    pool["Biology"]
+    pool["Chemistry"]
+    pool["Biology"]
+    pool["History"]
+    assert pool.open_names() == ["Biology", "History"]
+    assert closed == ["Chemistry"]
+
+
+def test_evicts_over_memory_budget(persist_directory):
+    closed = []
+    sizes = {"Biology": 60, "Chemistry": 30, "History": 50}
+    pool = make_pool(
+        persist_directory, closed=closed, sizes=sizes, max_open=8, memory_budget=100, sizer=lambda r: r.size
+    )
+    pool["Biology"]
+    pool["Chemistry"]
+    assert closed == []
+    pool["History"]
+    assert closed == ["Biology"]
+    assert pool.open_names() == ["Chemistry", "History"]
+
+
+def test_keeps_one_collection_over_budget(persist_directory):
+    pool = make_pool(persist_directory, sizes={"Biology": 500}, memory_budget=100, sizer=lambda r: r.size)
+    pool["Biology"]
+    assert pool.open_names() == ["Biology"]
+
+
+def test_unmeasurable_memory_falls_back_to_max_open(persist_directory):
+    closed = []
+    pool = make_pool(persist_directory, closed=closed, max_open=2, memory_budget=1, sizer=lambda r: None)
+    pool["Biology"]
+    pool["Chemistry"]
+    assert closed == []
+    pool["History"]
+    assert closed == ["Biology"]
+
+
+def test_failing_closer_does_not_break_the_pool(persist_directory):
+    def closer(retriever):
+        raise RuntimeError("Segment busy")
+
+    pool = CollectionPool(
+        Retriever,
+        closer=closer,
+        persist_directory=persist_directory,
+        max_open=1,
+        usage_file=os.path.join(persist_directory, "collection_usage.json"),
+    )
+    pool["Biology"]
+    pool["Chemistry"]
+    assert pool.open_names() == ["Chemistry"]
+
+
+def test_replacing_and_deleting_close_the_old_retriever(persist_directory):
+    closed = []
+    pool = make_pool(persist_directory, closed=closed)
+    old = pool["Biology"]
+    pool["Biology"] = Retriever("Biology-v2")
+    assert pool["Biology"].name == "Biology-v2"
+    del pool["Biology"]
+    pool.clear()
+    assert pool.open_names() == []
+    # Replacing a retriever hands it over, the old one is released by whoever held it
+    assert closed == ["Biology-v2"] and not old.released
+
+
+def test_preloads_the_most_used(persist_directory):
+    usage_file = os.path.join(persist_directory, "collection_usage.json")
+    pool = make_pool(persist_directory, usage_file=usage_file)
+    for name in ["History", "History", "History", "Physics", "Physics", "Biology"]:
+        pool[name]
+    pool._save_usage()
+
+    # A restarted pool ranks the databases from the saved counts
+    opened = []
+    restarted = make_pool(persist_directory, opened, usage_file=usage_file, max_open=8)
+    assert restarted.most_used(2) == ["History", "Physics"]
+    restarted.preload(2, background=False)
+    assert opened == ["History", "Physics"]
+    assert restarted.most_used(8) == ["History", "Physics", "Biology"]
@@ -0,0 +1,98 @@
+"""
+Tests of the columnar chunk store: chunks written as offsets into their documents read back with their metadata.
+"""
+
+import pytest
+
+columnar_store = pytest.importorskip("columnar_store")
+Document = pytest.importorskip("langchain.docstore.document").Document
+
+ColumnarStore = columnar_store.ColumnarStore
+
+SLIDES = "Module 3 covers photosynthesis. Light reactions come first. The Calvin cycle follows them."
+NOTES = "Homework: read chapter four and answer the questions at its end."
+
+
+def split(text, size, overlap):
+    # Fixed-size chunks overlapping by a few characters, as the text splitter produces
+    return [text[start : start + size] for start in range(0, len(text), size - overlap)]
+
+
+@pytest.fixture
+def chunks():
+    slides = [
+        Document(page_content=text, metadata={"source": "slides.pptx", "page": number, "score": 0.5 * number})
+        for number, text in enumerate(split(SLIDES, 30, 8))
+    ]
+    notes = [
+        Document(page_content=text, metadata={"source": "notes.txt", "folder": "Module3", "tags": ["hw", number]})
+        for number, text in enumerate(split(NOTES, 25, 5))
+    ]
+    return slides + notes
+
+
+@pytest.fixture
+def documents():
+    return [
+        Document(page_content=SLIDES, metadata={"source": "slides.pptx"}),
+        None,
+        Document(page_content=NOTES, metadata={"source": "notes.txt"}),
+    ]
+
+
+def test_round_trip_keeps_text_and_metadata(tmp_path, chunks, documents):
+    ids = [f"chunk-{row}" for row in range(len(chunks))]
+    ColumnarStore(str(tmp_path)).write(chunks, ids, documents)
+
+    # A new store reads what another process wrote
+    found = ColumnarStore(str(tmp_path)).get(ids)
+    assert sorted(found) == sorted(ids)
+    for chunk_id, chunk in zip(ids, chunks):
+        assert found[chunk_id].page_content == chunk.page_content
+        assert found[chunk_id].metadata == chunk.metadata
+
+
+def test_documents_are_stored_once(tmp_path, chunks, documents):
+    store = ColumnarStore(str(tmp_path))
+    store.write(chunks, [str(row) for row in range(len(chunks))], documents)
+    assert [doc.page_content for doc in store.documents()] == [SLIDES, NOTES]
+
+
+def test_unknown_ids_are_left_out(tmp_path, chunks, documents):
+    store = ColumnarStore(str(tmp_path))
+    store.write(chunks, [str(row) for row in range(len(chunks))], documents)
+    assert set(store.get(["0", "missing"])) == {"0"}
+
+
+def test_chunk_missing_from_its_documents_is_stored_alone(tmp_path):
+    chunk = Document(page_content="Text  normalised away", metadata={"source": "slides.pptx"})
+    store = ColumnarStore(str(tmp_path))
+    store.write([chunk], ["only"], [Document(page_content=SLIDES, metadata={"source": "slides.pptx"})])
+    assert store.get(["only"])["only"].page_content == "Text  normalised away"
+
+
+def test_rewrite_is_reloaded(tmp_path, chunks, documents):
+    store = ColumnarStore(str(tmp_path))
+    store.write(chunks, [str(row) for row in range(len(chunks))], documents)
+    assert store.get(["0"])
+    store.write(chunks[:1], ["new"], documents)
+    assert set(store.get(["0", "new"])) == {"new"}
+
+
+def test_empty_store(tmp_path):
+    store = ColumnarStore(str(tmp_path))
+    assert not store.exists()
+    assert store.get(["0"]) == {}
+    store.write([], [], [])
+    assert store.exists()
+    assert store.get(["0"]) == {} and store.documents() == []
+
+
+def test_delta_segments_are_searched(tmp_path, chunks, documents):
+    delta = tmp_path / "delta"
+    ColumnarStore(str(tmp_path)).write(chunks[:2], ["base-0", "base-1"], documents)
+    ColumnarStore(str(delta)).write(chunks[2:3], ["delta-0"], documents)
+
+    found = ColumnarStore(str(tmp_path), extra_directories=[str(delta)]).get(["base-1", "delta-0"])
+    assert found["base-1"].page_content == chunks[1].page_content
+    assert found["delta-0"].page_content == chunks[2].page_content
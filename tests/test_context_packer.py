@@ -0,0 +1,113 @@
+"""
+Tests of the context packer: overlapping chunks merged, and the best ranked documents kept within the token budget.
+"""
+
+import pytest
+
+context_packer = pytest.importorskip("context_packer")
+Document = pytest.importorskip("langchain.docstore.document").Document
+PromptTemplate = pytest.importorskip("langchain.prompts").PromptTemplate
+
+TEXT = (
+    "Photosynthesis turns light into chemical energy. The light reactions happen in the thylakoid membranes, "
+    "and the Calvin cycle fixes carbon dioxide in the stroma of the chloroplast."
+)
+
+
+def doc(text, source="slides.pptx", database="Biology"):
+    return Document(page_content=text, metadata={"source": source, "database": database})
+
+
+def count_words(text):
+    return len(text.split())
+
+
+def test_overlapping_chunks_are_joined():
+    first, second = TEXT[:90], TEXT[60:]
+    assert [d.page_content for d in context_packer.merge_overlapping([doc(first), doc(second)])] == [TEXT]
+    # The lower ranked chunk may come first in the document
+    assert [d.page_content for d in context_packer.merge_overlapping([doc(second), doc(first)])] == [TEXT]
+
+
+def test_contained_and_duplicated_chunks_are_dropped():
+    merged = context_packer.merge_overlapping([doc(TEXT[10:50]), doc(TEXT), doc(TEXT[20:40], source="other.pdf")])
+    assert [d.page_content for d in merged] == [TEXT]
+
+
+def test_chunks_of_other_sources_are_not_joined():
+    first, second = TEXT[:90], TEXT[60:]
+    for other in (doc(second, source="notes.txt"), doc(second, database="Chemistry")):
+        assert len(context_packer.merge_overlapping([doc(first), other])) == 2
+
+
+def test_short_overlap_is_not_joined():
+    first, second = TEXT[:90], TEXT[90 - context_packer.CONTEXT_MIN_OVERLAP_CHARS + 1 :]
+    assert len(context_packer.merge_overlapping([doc(first), doc(second)])) == 2
+
+
+def test_pack_keeps_the_best_documents_that_fit():
+    documents = [doc("one two three", source="a"), doc("four five six seven", source="b"), doc("eight", source="c")]
+    # The second document does not fit, the smaller third one still does
+    packed = context_packer.pack_context(documents, 5, count_words)
+    assert [d.page_content for d in packed] == ["one two three", "eight"]
+
+
+def test_pack_counts_the_separator():
+    separator_tokens = []
+
+    def count(text):
+        if text == context_packer.DOCUMENT_SEPARATOR:
+            separator_tokens.append(text)
+            return 2
+        return count_words(text)
+
+    documents = [doc("one two", source="a"), doc("three four", source="b")]
+    assert len(context_packer.pack_context(documents, 5, count)) == 1
+    assert len(context_packer.pack_context(documents, 6, count)) == 2
+    assert separator_tokens
+
+
+def test_pack_counts_all_documents_in_one_batch():
+    batches = []
+
+    class ServerLLM:
+        def count_tokens(self, texts):
+            batches.append(list(texts))
+            return [count_words(text) for text in texts]
+
+    count_tokens = context_packer.make_token_counter(ServerLLM())
+    assert count_tokens("one two") == 2
+    batches.clear()
+
+    documents = [doc(f"chunk {name}", source=name) for name in "abcd"]
+    assert len(context_packer.pack_context(documents, 100, count_tokens)) == 4
+    assert len(batches) == 1 and len(batches[0]) == 5
+
+
+def test_token_counter_of_a_pipeline_uses_its_tokenizer():
+    class Tokenizer:
+        def encode(self, text, add_special_tokens=True):
+            return list(text) + ([0] if add_special_tokens else [])
+
+    class Pipeline:
+        tokenizer = Tokenizer()
+
+    class PipelineLLM:
+        pipeline = Pipeline()
+
+    assert context_packer.make_token_counter(PipelineLLM())("abc") == 3
+
+
+def test_budget_leaves_room_for_prompt_and_answer(monkeypatch):
+    monkeypatch.setattr(context_packer, "CONTEXT_WINDOW_SIZE", 100)
+    monkeypatch.setattr(context_packer, "CONTEXT_RESERVED_GENERATION_TOKENS", 30)
+    monkeypatch.setattr(context_packer, "CONTEXT_MAX_TOKENS", 0)
+    prompt = PromptTemplate(
+        template="Context: {context} Question: {question}", input_variables=["context", "question"]
+    )
+
+    assert context_packer.context_budget(prompt, "why is the sky blue", count_words) == 100 - 30 - 7
+    monkeypatch.setattr(context_packer, "CONTEXT_MAX_TOKENS", 20)
+    assert context_packer.context_budget(prompt, "why is the sky blue", count_words) == 20
+    monkeypatch.setattr(context_packer, "CONTEXT_RESERVED_GENERATION_TOKENS", 100)
+    assert context_packer.context_budget(prompt, "why is the sky blue", count_words) == 0
@@ -0,0 +1,89 @@
+"""
+Tests of the request filters translated into Chroma where clauses.
+"""
+
+import pytest
+
+metadata_filters = pytest.importorskip("metadata_filters")
+Document = pytest.importorskip("langchain.docstore.document").Document
+
+build_where_filter = metadata_filters.build_where_filter
+parse_filters = metadata_filters.parse_filters
+
+
+def test_no_filters():
+    assert build_where_filter(None) is None
+    assert build_where_filter({}) is None
+    assert parse_filters(None) is None
+    assert parse_filters("  ") is None
+
+
+def test_single_value():
+    assert build_where_filter({"folder": "Module3"}) == {"folder": {"$eq": "Module3"}}
+    assert build_where_filter({"page": [2]}) == {"page": {"$eq": 2}}
+
+
+def test_list_of_values_matches_any():
+    assert build_where_filter({"file_type": [".pdf", ".pptx"]}) == {
+        "$or": [{"file_type": {"$eq": ".pdf"}}, {"file_type": {"$eq": ".pptx"}}]
+    }
+
+
+def test_several_filters_are_combined():
+    assert build_where_filter(
+        {"folder": "Module3", "ingested_after": 1700000000, "ingested_before": 1800000000.5}
+    ) == {
+        "$and": [
+            {"folder": {"$eq": "Module3"}},
+            {"ingested_at": {"$gte": 1700000000}},
+            {"ingested_at": {"$lte": 1800000000.5}},
+        ]
+    }
+
+
+@pytest.mark.parametrize(
+    "filters",
+    [
+        {"unknown": "value"},
+        {"folder": []},
+        {"folder": {"$ne": "Module3"}},
+        {"folder": [None]},
+        {"folder": True},
+        {"page": [1, False]},
+        {"ingested_after": "yesterday"},
+        {"ingested_after": None},
+        {"ingested_after": True},
+        {"ingested_before": False},
+    ],
+)
+def test_invalid_filters_are_rejected(filters):
+    with pytest.raises(ValueError):
+        build_where_filter(filters)
+
+
+def test_parse_filters():
+    assert parse_filters('{"folder": "Module3"}') == {"folder": "Module3"}
+    for raw in ['["Module3"]', "{not json"]:
+        with pytest.raises(ValueError):
+            parse_filters(raw)
+
+
+def test_filter_metadata_of_documents(tmp_path):
+    source_dir = str(tmp_path)
+    documents = [
+        Document(page_content="Slides", metadata={"source": str(tmp_path / "Module3" / "Week1" / "Intro.PPTX")}),
+        None,
+        Document(page_content="Notes", metadata={"source": str(tmp_path / "notes.txt")}),
+    ]
+    metadata_filters.add_filter_metadata(documents, source_dir)
+
+    slides, _, notes = documents
+    assert slides.metadata["file_name"] == "Intro.PPTX"
+    assert slides.metadata["file_type"] == ".pptx"
+    assert slides.metadata["folder"] == "Module3/Week1"
+    assert notes.metadata["folder"] == ""
+    assert isinstance(notes.metadata["ingested_at"], int)
+    # Only the filterable fields go to the vector index
+    assert metadata_filters.index_metadata({**notes.metadata, "parent_id": "p1"}) == {
+        key: notes.metadata[key] for key in ["source", "file_name", "file_type", "folder", "ingested_at"]
+    }
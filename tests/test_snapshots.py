@@ -0,0 +1,157 @@
+"""
+Tests of the index versions of a database: publishing, leasing, collecting old versions and rolling back.
+"""
+
+import json
+import os
+
+import pytest
+
+snapshots = pytest.importorskip("snapshots")
+ann_tuning = pytest.importorskip("ann_tuning")
+
+SnapshotManager = snapshots.SnapshotManager
+
+TUNED = {"hnsw:M": 32, "hnsw:construction_ef": 200, "hnsw:search_ef": 64}
+
+
+@pytest.fixture
+def manager(tmp_path):
+    return SnapshotManager(persist_directory=str(tmp_path), keep_versions=1)
+
+
+def build(manager, name="Biology", count=1):
+    # Build and publish new versions of a database, returning their directories
+    versions = []
+    for _ in range(count):
+        version_dir = snapshots.new_version_dir(manager.database_dir(name))
+        snapshots.publish(manager.database_dir(name), version_dir)
+        versions.append(version_dir)
+    return versions
+
+
+class Retriever:
+    def __init__(self, persist_directory):
+        self.persist_directory = persist_directory
+
+
+class Pool(dict):
+    def __init__(self, manager):
+        super().__init__()
+        self.manager = manager
+
+    def opener(self, name):
+        return Retriever(self.manager.current(name))
+
+    def __missing__(self, name):
+        self[name] = self.opener(name)
+        return self[name]
+
+
+def test_unversioned_database_is_used_in_place(manager):
+    database_dir = manager.database_dir("Biology")
+    os.makedirs(database_dir)
+    assert snapshots.current_version_dir(database_dir) == database_dir
+    assert snapshots.is_servable(database_dir)
+
+
+def test_publish_makes_the_new_version_live(manager):
+    database_dir = manager.database_dir("Biology")
+    first = snapshots.new_version_dir(database_dir)
+    # The first version is not searchable before it is published
+    assert not snapshots.is_servable(database_dir)
+    snapshots.publish(database_dir, first)
+    second = snapshots.new_version_dir(database_dir)
+    assert manager.current("Biology") == first
+    snapshots.publish(database_dir, second)
+    assert manager.current("Biology") == second
+    assert snapshots.list_versions(database_dir) == ["v1", "v2"]
+    assert snapshots.collection_name(second) == "Biology"
+
+
+def test_collect_keeps_the_live_and_rollback_versions(manager):
+    versions = build(manager, count=4)
+    assert manager.collect("Biology") == versions[:2]
+    assert snapshots.list_versions(manager.database_dir("Biology")) == ["v3", "v4"]
+
+
+def test_collect_keeps_versions_after_the_live_one(manager):
+    versions = build(manager, count=3)
+    # A rolled back version, or one being built, is never collected
+    manager.rollback("Biology", "v1")
+    assert manager.collect("Biology") == []
+    assert snapshots.list_versions(manager.database_dir("Biology")) == ["v1", "v2", "v3"]
+    assert manager.current("Biology") == versions[0]
+
+
+def test_leased_version_is_deleted_on_release(manager):
+    pool = Pool(manager)
+    build(manager, count=1)
+    with manager.checkout(pool, ["Biology"]) as retrievers:
+        leased = retrievers["Biology"].persist_directory
+        build(manager, count=2)
+        assert manager.collect("Biology") == []
+        assert os.path.isdir(leased)
+    assert not os.path.exists(leased)
+
+
+def test_checkout_opens_the_live_version(manager):
+    pool = Pool(manager)
+    build(manager, count=1)
+    with manager.checkout(pool, ["Biology"]):
+        pass
+    live = build(manager, count=1)[0]
+    with manager.checkout(pool, ["Biology"]) as retrievers:
+        assert retrievers["Biology"].persist_directory == live
+
+
+def test_rollback(manager):
+    versions = build(manager, count=3)
+    assert manager.rollback("Biology") == versions[1]
+    assert manager.current("Biology") == versions[1]
+    with pytest.raises(ValueError):
+        manager.rollback("Biology", "v9")
+    manager.rollback("Biology", "v1")
+    with pytest.raises(ValueError):
+        manager.rollback("Biology")
+
+
+def test_collect_keeps_tuned_parameters_of_a_database_ingested_before_versioning(manager):
+    database_dir = manager.database_dir("Biology")
+    os.makedirs(os.path.join(database_dir, "0a1b2c3d-0000-4000-8000-000000000000"))
+    with open(os.path.join(database_dir, "chroma.sqlite3"), "w") as file:
+        file.write("legacy")
+    with open(os.path.join(database_dir, "ann_params.json"), "w") as file:
+        json.dump({"metadata": TUNED}, file)
+
+    build(manager, count=2)
+    manager.collect("Biology")
+
+    # The Chroma files of the legacy index are removed, the tuned parameters stay
+    assert sorted(os.listdir(database_dir)) == ["CURRENT", "ann_params.json", "v1", "v2"]
+    assert ann_tuning.load_ann_params(manager.current("Biology")) == TUNED
+
+
+def ingest(manager, name="Biology"):
+    # Build a version as ingest.py does, with the tuned parameters of the live one
+    version_dir = snapshots.new_version_dir(manager.database_dir(name))
+    ann_tuning.save_ann_params(version_dir, ann_tuning.load_ann_params(version_dir))
+    snapshots.publish(manager.database_dir(name), version_dir)
+    return version_dir
+
+
+def test_tuned_parameters_move_with_the_versions(manager):
+    first = build(manager, count=1)[0]
+    ann_tuning.save_ann_params(first, TUNED, {"tuning": []})
+    ingest(manager)
+    ingest(manager)
+
+    assert manager.collect("Biology") == [first]
+    assert ann_tuning.load_ann_params(manager.current("Biology")) == TUNED
+
+
+def test_untuned_database_has_no_parameters(manager):
+    version_dir = build(manager, count=1)[0]
+    ann_tuning.save_ann_params(version_dir, None)
+    assert ann_tuning.load_ann_params(version_dir) is None
+    assert not os.path.exists(os.path.join(version_dir, "ann_params.json"))